@@ -14,6 +14,8 @@ class AutoRoute:
         self.tobase = ["ccw", 150, "forward", 50]
         self.checkpoint = [[1, "cw", 90, "forward", 100], [2, "ccw", 90, "forward", 80], [3, "ccw", 90, "forward", 40],
                            [4, "ccw", 90, "forward", 40], [5, "cw", 90, "forward", 60], [0, "ccw", 90, "forward", 40]]
+        self.checkpoint_pause = 0  # seconds to hover at every checkpoint, commands already wait for the drone
+        self.mission_start = None  # (time, copy of tello.command_stats) when the sweep took off
 
     def restart(self):
         if self.counter >= 16:
@@ -38,6 +40,8 @@ class AutoRoute:
             return
         # Send the takeoff command
         if self.counter == 0:
+            self.mission_start = (time.time(), dict(self.tello.command_stats))
+            self.report_state("Before takeoff")
             if self.tello.height == 0:
                 self.tello.send("takeoff", 7)
             self.counter += 1
@@ -72,7 +76,9 @@ class AutoRoute:
                     self.tello.send(self.checkpoint[i][3] + " " + str(self.checkpoint[i][4]), 4)
                     self.counter += 1
                     print("Arrived at current location: Checkpoint " + str(self.checkpoint[i][0]) + "\n")
-                    time.sleep(4)
+                    self.report_state("Checkpoint " + str(self.checkpoint[i][0]))
+                    if self.checkpoint_pause:
+                        time.sleep(self.checkpoint_pause)
 
         # Reach back at Checkpoint 0
         elif self.counter == 13:
@@ -95,3 +101,42 @@ class AutoRoute:
             self.tello.send("land", 3)
             self.counter += 1
             print("The drone has landed.")
+            self.print_mission_time()
+
+    def report_state(self, label):
+        # Print the height and battery the drone itself reports, averaged over the last second
+        if self.tello.state_receiver is None:
+            return
+        states = self.tello.state_receiver.window(1.0)
+        if len(states) == 0:
+            print(label + ": no state received from the drone\n")
+            return
+        print("%s: height %.0f cm (tof %.0f cm), battery %d%%\n" % (
+            label, states['h'].mean(), states['tof'].mean(), states['bat'][-1]))
+
+    def mission(self):
+        """Return the commands of the whole sweep, in the order flyingLogic sends them."""
+        commands = ["takeoff",
+                    self.frombase[0] + " " + str(self.frombase[1]),
+                    self.frombase[2] + " " + str(self.frombase[3])]
+        for checkpoint in self.checkpoint:
+            commands.append(checkpoint[1] + " " + str(checkpoint[2]))
+            commands.append(checkpoint[3] + " " + str(checkpoint[4]))
+        # the checkpoint loop of flyingLogic already counts up to 15, so its tobase steps (counter 13
+        # and 14) are never reached and the drone turns around right at checkpoint 0
+        commands += ["cw 180",
+                     "land"]
+        return commands
+
+    def print_mission_time(self):
+        # Compare the sweep's wall time with what the fixed per-command delays used to take
+        if self.mission_start is None:
+            return
+        start_time, start_stats = self.mission_start
+        stats = self.tello.command_stats
+        wall_time = time.time() - start_time
+        # the sweep used to sleep for each command's delay, plus 4 s at every checkpoint
+        fixed_delay = stats['fixed_delay'] - start_stats['fixed_delay'] + 4 * len(self.checkpoint)
+        print("Mission took %.1f s, fixed delays would have taken %.1f s, saved %.1f s (%d commands, %d timeouts)\n" % (
+            wall_time, fixed_delay, fixed_delay - wall_time,
+            stats['commands'] - start_stats['commands'], stats['timeouts'] - start_stats['timeouts']))
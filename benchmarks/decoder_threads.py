@@ -0,0 +1,100 @@
+"""
+Per-frame decode latency versus throughput for each libavcodec threading setting.
+
+Frame threading decodes several frames in parallel, which raises throughput
+but holds every frame back until the pipeline is full. Slice threading keeps
+latency low but only helps streams with several slices per frame.
+
+Usage:
+    python benchmarks/decoder_threads.py capture.h264 [--repeat 3]
+
+capture.h264 is a raw Annex-B h264 stream, e.g. a recording of the Tello video.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import libh264decoder
+from tello_video import split_access_units
+
+# (thread count, thread type) pairs to compare, thread count 0 means one thread per core
+SETTINGS = [
+    (1, libh264decoder.THREAD_DEFAULT),
+    (2, libh264decoder.THREAD_SLICE),
+    (4, libh264decoder.THREAD_SLICE),
+    (0, libh264decoder.THREAD_SLICE),
+    (2, libh264decoder.THREAD_FRAME),
+    (4, libh264decoder.THREAD_FRAME),
+    (0, libh264decoder.THREAD_FRAME),
+]
+
+
+def percentile(values, pct):
+    """Return the pct percentile of values, 0.0 for an empty list."""
+    if not values:
+        return 0.0
+    return float(np.percentile(values, pct))
+
+
+def run(stream, units, thread_count, thread_type, repeat, width, height):
+    """
+    Decode the stream repeat times with one threading setting.
+
+    Every access unit is fed on its own, as Tello does, and each decoded
+    frame is matched to the access unit it came from by order.
+
+    :return: dict with the measured fps, latency percentiles in ms and the frame delay of the pipeline.
+    """
+    decoder = libh264decoder.H264Decoder(thread_count, thread_type)
+    decoder.set_output(width, height, libh264decoder.RGB24, libh264decoder.BILINEAR)
+    out = np.empty(decoder.predict_size(width, height), dtype=np.ubyte)
+    view = memoryview(stream)
+
+    fed_at = []
+    latencies = []
+    start = time.time()
+    for _ in range(repeat):
+        for unit_start, unit_end in units:
+            fed_at.append(time.time())
+            count = decoder.decode_into(view[unit_start:unit_end], out)[0]
+            now = time.time()
+            for _ in range(count):
+                latencies.append(now - fed_at[len(latencies)])
+    elapsed = time.time() - start
+
+    return {'threads': decoder.threading()[0], 'fps': len(latencies) / elapsed,
+            'p50': percentile(latencies, 50) * 1000, 'p95': percentile(latencies, 95) * 1000,
+            'max': max(latencies) * 1000 if latencies else 0.0,
+            'delay': len(fed_at) - len(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('stream', help='raw Annex-B h264 file')
+    parser.add_argument('--repeat', type=int, default=3, help='times the stream is decoded per setting')
+    parser.add_argument('--width', type=int, default=960)
+    parser.add_argument('--height', type=int, default=720)
+    args = parser.parse_args()
+
+    with open(args.stream, 'rb') as f:
+        stream = bytearray(f.read())
+    units = split_access_units(stream)
+    print('%d access units, %d bytes' % (len(units), len(stream)))
+
+    libh264decoder.disable_logging()
+    print('%-8s %-14s %8s %9s %9s %9s %6s' % ('threads', 'type', 'fps', 'p50 ms', 'p95 ms', 'max ms', 'delay'))
+    for thread_count, thread_type in SETTINGS:
+        result = run(stream, units, thread_count, thread_type, args.repeat, args.width, args.height)
+        print('%-8s %-14s %8.1f %9.2f %9.2f %9.2f %6d' % (
+            '%d/%d' % (thread_count, result['threads']), thread_type, result['fps'],
+            result['p50'], result['p95'], result['max'], result['delay']))
+
+
+if __name__ == '__main__':
+    main()
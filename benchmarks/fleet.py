@@ -0,0 +1,137 @@
+"""
+How many drones one core can drive with tello_fleet.
+
+For every fleet size, that many tello_sim.py processes are started on
+127.0.0.11, 127.0.0.12, ... (all of 127/8 is loopback on Linux), each
+streaming the same capture file, and the whole fleet flies the AutoRoute
+sweep from a single select() loop in this process. The simulators run in
+their own processes, so the CPU figures only cover the fleet controller.
+
+Reports, per fleet size: CPU use of the controller as a fraction of one
+core, mission time, command round-trip percentiles and the access units
+received per drone per second. A fleet size is sustainable while CPU use
+stays below one core and no drone falls behind the others' video rate; the
+last column extrapolates the drones one core would carry.
+
+Usage:
+    python benchmarks/fleet.py capture.tcap [--drones 1 2 4 8 16] [--decode] [--video-ports per-drone]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from tello_fleet import Fleet
+
+
+def cpu_seconds():
+    """User plus system CPU time of this process, None where resource is unavailable."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentiles_ms(values):
+    """Return the p50 and p95 of values in milliseconds."""
+    if not values:
+        return 0.0, 0.0
+    return tuple(float(np.percentile(values, p)) * 1000 for p in (50, 95))
+
+
+def start_simulators(count, capture, time_scale):
+    """Start count simulators on 127.0.0.11 upwards and return (ips, processes)."""
+    ips = ['127.0.0.%d' % (11 + i) for i in range(count)]
+    processes = []
+    for ip in ips:
+        command = [sys.executable, os.path.join(ROOT, 'tello_sim.py'), '--host', ip,
+                   '--time-scale', str(time_scale), '--quiet']
+        if capture:
+            command += ['--video', capture]
+        processes.append(subprocess.Popen(command, stdout=subprocess.PIPE))
+    for process in processes:
+        process.stdout.readline()  # "simulated Tello listening on ..."
+    return ips, processes
+
+
+def attach_decoder(drone, width, height):
+    """Decode every access unit of the drone in the fleet loop, as a ground station showing the video would."""
+    import libh264decoder
+    decoder = libh264decoder.H264Decoder()
+    decoder.set_output(width, height, libh264decoder.RGB24, libh264decoder.BILINEAR)
+    out = np.empty(decoder.predict_size(width, height), dtype=np.ubyte)
+    drone.on_access_unit = lambda drone, access_unit: decoder.decode_into(access_unit, out)
+
+
+def run(count, args):
+    """Fly one fleet of count drones and return a dict of its measurements."""
+    ips, processes = start_simulators(count, args.capture, args.time_scale)
+    fleet = Fleet('127.0.0.1', args.command_port, args.capture is not None, args.video_ports,
+                  args.video_port)
+    try:
+        for ip in ips:
+            drone = fleet.add(ip)
+            if args.decode:
+                attach_decoder(drone, args.width, args.height)
+        fleet.fly()
+        cpu_start = cpu_seconds()
+        start = time.time()
+        finished = fleet.run(args.timeout)
+        elapsed = time.time() - start
+        cpu = cpu_seconds()
+    finally:
+        fleet.close()
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    latencies = []
+    rates = []
+    for drone in fleet.drones:
+        latencies.extend(drone.command_latencies)
+        if drone.finished_at is not None:
+            rates.append(drone.stats['access_units'] / (drone.finished_at - drone.started_at))
+    load = (cpu - cpu_start) / elapsed if cpu is not None else float('nan')
+    return {'finished': finished, 'elapsed': elapsed, 'load': load, 'rtt': percentiles_ms(latencies),
+            'min_rate': min(rates) if rates else 0.0, 'max_rate': max(rates) if rates else 0.0,
+            'timeouts': sum(drone.stats['timeouts'] for drone in fleet.drones)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='How many drones one core can drive with tello_fleet.')
+    parser.add_argument('capture', nargs='?', default=None, help='capture file the simulators stream, none for no video')
+    parser.add_argument('--drones', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='fleet sizes to try')
+    parser.add_argument('--time-scale', type=float, default=0.25, help='passed to the simulators, 0.1 flies ten times faster')
+    parser.add_argument('--video-ports', choices=(Fleet.SHARED, Fleet.PER_DRONE), default=Fleet.SHARED)
+    parser.add_argument('--command-port', type=int, default=9000)
+    parser.add_argument('--video-port', type=int, default=11111)
+    parser.add_argument('--decode', action='store_true', help='decode every stream in the fleet loop')
+    parser.add_argument('--width', type=int, default=960)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds a mission may take')
+    args = parser.parse_args()
+
+    print('%6s %8s %9s %8s %9s %9s %14s %9s %10s' % ('drones', 'done', 'mission s', 'cpu', 'rtt p50', 'rtt p95',
+                                                    'AU/s per drone', 'timeouts', 'per core'))
+    for count in args.drones:
+        result = run(count, args)
+        print('%6d %8s %9.1f %7.0f%% %9.2f %9.2f %6.1f..%-6.1f %9d %10.0f' % (
+            count, result['finished'], result['elapsed'], result['load'] * 100, result['rtt'][0], result['rtt'][1],
+            result['min_rate'], result['max_rate'], result['timeouts'],
+            count / result['load'] if result['load'] > 0 else float('inf')))
+
+
+if __name__ == '__main__':
+    main()
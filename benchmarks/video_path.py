@@ -0,0 +1,172 @@
+"""
+Offline benchmark of the Tello video path.
+
+A capture file is replayed over loopback, with its packet sizes and timing,
+into a Tello instance, i.e. through _receive_video_thread, the decode queue
+and _h264_decode, exactly as a live stream would go. The replay runs in a
+separate process so the CPU figures only cover the receiving side.
+
+Reports decode fps, per-frame latency percentiles (last packet received to
+frame published, and decode time alone), CPU time per frame and the memory
+high-water mark. --min-fps and --max-p95-ms turn it into a regression check
+that exits non-zero, for CI.
+
+With --loss, datagrams are dropped at random and the resync figures show
+how many access units were skipped and how long the video took to recover.
+The replay cannot answer the keyframe requests Tello sends after a loss;
+with --sim the capture is streamed by tello_sim.py instead, which does,
+like the drone. Compare with --no-keyframe-requests to see what they save.
+
+Usage:
+    python benchmarks/video_path.py capture.tcap [--speed 1.0] [--min-fps 25] [--max-p95-ms 50]
+    python benchmarks/video_path.py capture.tcap --sim --loss 0.01 [--no-keyframe-requests]
+    python benchmarks/video_path.py capture.tcap --native
+
+--native runs the whole video path in libh264decoder.StreamSession instead
+(Tello(native_video=True)); latency and decode time are then only measured
+inside the session, see its stats.
+
+Capture files come from tello_replay.py (capture from a drone, or convert a raw .h264 file).
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import tello
+from tello_replay import read_capture
+
+
+def cpu_seconds():
+    """User plus system CPU time of this process, None where resource is unavailable."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def max_rss_mb():
+    """Memory high-water mark of this process in MB (ru_maxrss is KB on Linux, bytes on macOS)."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def percentiles_ms(values):
+    """Return the p50, p95 and p99 of values in milliseconds."""
+    if not values:
+        return 0.0, 0.0, 0.0
+    return tuple(float(np.percentile(values, p)) * 1000 for p in (50, 95, 99))
+
+
+def wait_until_drained(drone, timeout=5.0):
+    """Wait until the decode queue is empty and no frame arrived for a moment."""
+    deadline = time.time() + timeout
+    last_decoded = -1
+    while time.time() < deadline:
+        decoded = drone.video_stats['decoded']
+        if decoded == last_decoded and drone.video_queue.stats()['depth'] == 0:
+            return
+        last_decoded = decoded
+        time.sleep(0.2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the Tello video path.')
+    parser.add_argument('capture', help='capture file written by tello_replay.py')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 for as fast as possible')
+    parser.add_argument('--loss', type=float, default=0.0, help='fraction of datagrams dropped by the replay')
+    parser.add_argument('--sim', action='store_true',
+                        help='stream through tello_sim.py, which answers keyframe requests (real time only)')
+    parser.add_argument('--no-keyframe-requests', action='store_true',
+                        help='do not ask for a keyframe after a loss, wait for the next one in the stream')
+    parser.add_argument('--native', action='store_true', help='receive and decode in libh264decoder.StreamSession')
+    parser.add_argument('--min-fps', type=float, default=None, help='fail if decode fps is lower')
+    parser.add_argument('--max-p95-ms', type=float, default=None, help='fail if p95 frame latency is higher')
+    args = parser.parse_args()
+
+    packets = read_capture(args.capture)
+    print('%d datagrams, %.1f s of video' % (len(packets), packets[-1][0] if packets else 0.0))
+
+    options = {'tello_ip': '127.0.0.1', 'native_video': args.native,
+               'keyframe_request_interval': None if args.no_keyframe_requests else 1.0}
+    if args.sim:
+        # streams from the "streamon" sent by Tello's constructor on
+        sim = subprocess.Popen([sys.executable, os.path.join(ROOT, 'tello_sim.py'), '--host', '127.0.0.1',
+                                '--video', args.capture, '--video-loss', str(args.loss), '--quiet'],
+                               stdout=subprocess.PIPE)
+        sim.stdout.readline()  # "simulated Tello listening on ..."
+        drone = tello.Tello('127.0.0.1', 0, **options)
+        cpu_start = cpu_seconds()
+        start = time.time()
+        time.sleep(packets[-1][0] if packets else 0.0)
+        sim.terminate()
+        sim.wait()
+    else:
+        drone = tello.Tello('127.0.0.1', 0, **options)
+        cpu_start = cpu_seconds()
+        start = time.time()
+        replay = subprocess.Popen([sys.executable, os.path.join(ROOT, 'tello_replay.py'), 'replay', args.capture,
+                                   '--host', '127.0.0.1', '--port', str(drone.local_video_port),
+                                   '--speed', str(args.speed), '--loss', str(args.loss), '--seed', '1'])
+        replay.wait()
+    wait_until_drained(drone)
+    cpu = cpu_seconds()
+    # up to the last published frame, not including the wait for the queue to drain
+    elapsed = (drone.frame_slot.timestamp or time.time()) - start
+
+    decoded = drone.video_stats['decoded']
+    latency = percentiles_ms(list(drone.frame_latencies))
+    decode = percentiles_ms(list(drone.decode_times))
+    if drone.video_session is not None:
+        received = drone.video_session.stats()['access_units']
+    else:
+        received = drone.video_stats['frames']
+    print('access units received  %d' % received)
+    print('frames decoded         %d' % decoded)
+    print('decode fps             %.1f' % (decoded / elapsed))
+    print('frame latency ms       p50 %.2f  p95 %.2f  p99 %.2f' % latency)
+    print('decode time ms         p50 %.2f  p95 %.2f  p99 %.2f' % decode)
+    if cpu is not None and decoded:
+        print('cpu per frame ms       %.2f' % ((cpu - cpu_start) / decoded * 1000))
+        print('memory high-water MB   %.1f' % max_rss_mb())
+    print('decode queue           %s' % drone.video_queue.stats())
+    print('frame pool             %s' % drone.frame_pool.stats())
+    if drone.video_session is not None:
+        print('stream session         %s' % drone.video_session.stats())
+    else:
+        print('bytes copied           %d of %d received (recvmmsg: %s)' % (
+            drone.video_stats['bytes_copied'], drone.video_stats['bytes_received'], drone.video_receiver.native))
+        resync = drone.resync.stats()
+        print('resync                 %d resyncs, %d access units skipped, losses %s' % (
+            resync['resyncs'], resync['dropped'], resync['losses']))
+        print('time to recover ms     mean %.1f  max %.1f' % (resync['mean_recover'] * 1000,
+                                                              resync['max_recover'] * 1000))
+    if drone.keyframe_requester is not None:
+        print('keyframe requests      %s' % drone.keyframe_requester.stats())
+
+    failed = False
+    if args.min_fps is not None and decoded / elapsed < args.min_fps:
+        print('FAIL: decode fps below %.1f' % args.min_fps)
+        failed = True
+    if args.max_p95_ms is not None and latency[1] > args.max_p95_ms:
+        print('FAIL: p95 frame latency above %.1f ms' % args.max_p95_ms)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
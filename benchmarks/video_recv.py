@@ -0,0 +1,166 @@
+"""
+Benchmark of the video socket receive path: system calls and packet loss per bitrate.
+
+For every bitrate a synthetic capture is written, Tello sized datagrams
+(1460 bytes, the last one of each access unit shorter) sent in a burst per
+frame, and replayed over loopback by tello_replay.py in its own process.
+This process receives it the way Tello._receive_video_thread does, through
+tello_video.BatchReceiver into a PacketRing, with the receive modes:
+
+    single  -- one blocking recv_into per datagram (batch of 1), straight into the ring
+    loop    -- blocking recv_into, then non-blocking ones until the socket is empty, straight into the ring
+    recvmmsg -- one recvmmsg call per wakeup, without the GIL (Linux builds of libh264decoder),
+               then a copy of each datagram into the ring
+
+Reports, per bitrate and mode: receive system calls per second, datagrams
+per call, datagrams lost (sent but never received, i.e. dropped by a full
+socket buffer) and the CPU use of the receiving process. --busy-threads
+adds Python threads spinning on the GIL, like a decoder or UI would, which
+is when per-datagram calls fall behind.
+
+Usage:
+    python benchmarks/video_recv.py [--mbps 4 12 24 48] [--rcvbuf 212992 1048576] [--busy-threads 2]
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from tello_replay import TELLO_PACKET_SIZE, write_capture
+from tello_video import BatchReceiver, PacketRing, recv_batch, set_receive_buffer
+
+
+def cpu_seconds():
+    """User plus system CPU time of this process, None where resource is unavailable."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def synthetic_capture(path, mbps, seconds, fps=30.0):
+    """Write a capture of seconds of access units adding up to mbps megabit/s, return the datagram count."""
+    frame_bytes = int(mbps * 1e6 / 8 / fps)
+    access_unit = b'\x00\x00\x00\x01\x41\x9a' + b'\x78' * max(frame_bytes - 6, 0)
+    if len(access_unit) % TELLO_PACKET_SIZE == 0:
+        access_unit += b'\x78'  # keep a short datagram at the end, like the drone's
+    packets = []
+    for i in range(int(seconds * fps)):
+        for offset in range(0, len(access_unit), TELLO_PACKET_SIZE):
+            packets.append((i / fps, access_unit[offset:offset + TELLO_PACKET_SIZE]))
+    write_capture(path, packets)
+    return len(packets)
+
+
+def busy(stop):
+    """Spin in Python, holding the GIL whenever the interpreter lets it."""
+    n = 0
+    while not stop.is_set():
+        n += 1
+
+
+def receive(receiver, ring):
+    """Receive into the ring, as Tello does, until an empty datagram arrives."""
+    while True:
+        for nbytes in receiver.receive_into(ring):
+            if nbytes == 0:
+                return
+            boundary = ring.scan()
+            if boundary:
+                slot, _ = ring.commit(boundary)
+                if slot is not None:
+                    ring.release(slot)
+            if nbytes != TELLO_PACKET_SIZE:
+                slot, _ = ring.commit()
+                if slot is not None:
+                    ring.release(slot)
+
+
+def run(mode, rcvbuf, args, capture, sent):
+    """Replay the capture into one receiver and return a dict of its measurements."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    granted = set_receive_buffer(sock, rcvbuf)
+    receiver = BatchReceiver(sock, 1 if mode == 'single' else args.batch, native=(mode == 'recvmmsg'))
+    ring = PacketRing(slots=8)
+    thread = threading.Thread(target=receive, args=(receiver, ring))
+    thread.daemon = True
+    stop = threading.Event()
+    spinners = [threading.Thread(target=busy, args=(stop,)) for _ in range(args.busy_threads)]
+    for spinner in spinners:
+        spinner.daemon = True
+        spinner.start()
+
+    thread.start()
+    cpu_start = cpu_seconds()
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, os.path.join(ROOT, 'tello_replay.py'), 'replay', capture,
+                               '--host', '127.0.0.1', '--port', str(sock.getsockname()[1])], stdout=devnull)
+    time.sleep(0.5)  # let the receiver drain its buffer
+    elapsed = time.time() - start
+    cpu = cpu_seconds()
+    # an empty datagram ends the receive loop
+    sock.sendto(b'', sock.getsockname())
+    thread.join(5.0)
+    stop.set()
+    for spinner in spinners:
+        spinner.join()
+    sock.close()
+
+    stats = receiver.stats()
+    received = stats['datagrams'] - 1
+    return {'rcvbuf': granted, 'calls_per_s': stats['calls'] / elapsed, 'per_call': stats['per_call'],
+            'loss': 1.0 - float(received) / sent if sent else 0.0,
+            'load': (cpu - cpu_start) / elapsed if cpu is not None else float('nan')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the video socket receive path.')
+    parser.add_argument('--mbps', type=float, nargs='+', default=[4, 12, 24, 48], help='bitrates to try')
+    parser.add_argument('--rcvbuf', type=int, nargs='+', default=[212992, 1024 * 1024],
+                        help='receive buffer sizes to request, in bytes')
+    parser.add_argument('--modes', nargs='+', default=['single', 'loop', 'recvmmsg'],
+                        choices=('single', 'loop', 'recvmmsg'))
+    parser.add_argument('--batch', type=int, default=32, help='datagrams per batch for loop and recvmmsg')
+    parser.add_argument('--seconds', type=float, default=5.0, help='length of each run')
+    parser.add_argument('--busy-threads', type=int, default=0, help='Python threads competing for the GIL')
+    args = parser.parse_args()
+
+    modes = list(args.modes)
+    if 'recvmmsg' in modes and recv_batch is None:
+        print('libh264decoder has no recv_batch (not a Linux build), skipping recvmmsg')
+        modes.remove('recvmmsg')
+
+    directory = tempfile.mkdtemp()
+    try:
+        print('%6s %9s %9s %12s %9s %8s %6s' % ('Mbit/s', 'mode', 'rcvbuf', 'syscalls/s', 'per call', 'lost', 'cpu'))
+        for mbps in args.mbps:
+            capture = os.path.join(directory, '%g.tcap' % mbps)
+            sent = synthetic_capture(capture, mbps, args.seconds)
+            for rcvbuf in args.rcvbuf:
+                for mode in modes:
+                    result = run(mode, rcvbuf, args, capture, sent)
+                    print('%6g %9s %9d %12.0f %9.1f %7.2f%% %5.0f%%' % (
+                        mbps, mode, result['rcvbuf'], result['calls_per_s'], result['per_call'],
+                        result['loss'] * 100, result['load'] * 100))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,8 @@ extern "C" {
 
 #include "h264decoder.hpp"
 #include <utility>
+#include <tuple>
+#include <cstring>
 
 typedef unsigned char ubyte;
 
@@ -29,7 +31,7 @@ typedef unsigned char ubyte;
 #endif
 
 
-H264Decoder::H264Decoder()
+H264Decoder::H264Decoder(int thread_count, ThreadType thread_type)
 {
   avcodec_register_all();
 
@@ -45,6 +47,16 @@ H264Decoder::H264Decoder()
     context->flags |= CODEC_FLAG_TRUNCATED;
   }  
 
+  // Threading has to be configured before the codec is opened.
+  if (thread_count < 0)
+    throw H264InitFailure("thread count must not be negative");
+  context->thread_count = thread_count;
+  if (thread_type != THREAD_DEFAULT)
+  {
+    context->thread_type = ((thread_type & THREAD_FRAME) ? FF_THREAD_FRAME : 0) |
+                           ((thread_type & THREAD_SLICE) ? FF_THREAD_SLICE : 0);
+  }
+
   int err = avcodec_open2(context, codec, nullptr);
   if (err < 0)
     throw H264InitFailure("cannot open context");
@@ -78,6 +90,14 @@ H264Decoder::~H264Decoder()
 }
 
 
+std::pair<int, int> H264Decoder::threading() const
+{
+  int type = ((context->active_thread_type & FF_THREAD_FRAME) ? THREAD_FRAME : 0) |
+             ((context->active_thread_type & FF_THREAD_SLICE) ? THREAD_SLICE : 0);
+  return std::make_pair(context->thread_count, type);
+}
+
+
 ssize_t H264Decoder::parse(const ubyte* in_data, ssize_t in_size)
 {
   auto nread = av_parser_parse2(parser, context, &pkt->data, &pkt->size, 
@@ -93,52 +113,127 @@ bool H264Decoder::is_frame_available() const
 }
 
 
-const AVFrame& H264Decoder::decode_frame()
+const AVFrame* H264Decoder::decode_frame()
 {
   int got_picture = 0;
   int nread = avcodec_decode_video2(context, frame, &got_picture, pkt);
-  if (nread < 0 || got_picture == 0)
+  if (nread < 0)
+  {
+    ++decode_errors;
     throw H264DecodeFailure("error decoding frame\n");
-  return *frame;
+  }
+  // not an error, the packet just did not finish a picture
+  if (got_picture == 0)
+    return nullptr;
+  // error concealment filled in missing or damaged slices
+  if (frame->decode_error_flags)
+    ++corrupt_frames;
+  return frame;
 }
 
 
-ConverterRGB24::ConverterRGB24()
+void H264Decoder::flush()
 {
-  framergb = av_frame_alloc();
-  if (!framergb)
+  avcodec_flush_buffers(context);
+  av_parser_close(parser);
+  parser = av_parser_init(AV_CODEC_ID_H264);
+  if (!parser)
+    throw H264InitFailure("cannot init parser");
+  pkt->data = nullptr;
+  pkt->size = 0;
+}
+
+
+std::pair<long, long> H264Decoder::error_counts() const
+{
+  return std::make_pair(decode_errors, corrupt_frames);
+}
+
+
+static AVPixelFormat output_pix_fmt(OutputFormat format)
+{
+  switch (format)
+  {
+    case OUTPUT_BGR24:   return AV_PIX_FMT_BGR24;
+    case OUTPUT_GRAY8:   return AV_PIX_FMT_GRAY8;
+    case OUTPUT_YUV420P: return AV_PIX_FMT_YUV420P;
+    case OUTPUT_RGB24:
+    default:             return PIX_FMT_RGB24;
+  }
+}
+
+
+static int sws_scaling_flags(Scaling scaling)
+{
+  switch (scaling)
+  {
+    case SCALING_FAST_BILINEAR: return SWS_FAST_BILINEAR;
+    case SCALING_BICUBIC:       return SWS_BICUBIC;
+    case SCALING_POINT:         return SWS_POINT;
+    case SCALING_AREA:          return SWS_AREA;
+    case SCALING_BILINEAR:
+    default:                    return SWS_BILINEAR;
+  }
+}
+
+
+OutputStage::OutputStage()
+  : context(nullptr), out_width(0), out_height(0), format(OUTPUT_RGB24), scaling(SCALING_BILINEAR)
+{
+  frameout = av_frame_alloc();
+  if (!frameout)
     throw H264DecodeFailure("cannot allocate frame");
-  context = nullptr;
 }
 
-ConverterRGB24::~ConverterRGB24()
+OutputStage::~OutputStage()
 {
   sws_freeContext(context);
-  av_frame_free(&framergb);
+  av_frame_free(&frameout);
+}
+
+
+void OutputStage::set_output(int width, int height, OutputFormat format_, Scaling scaling_)
+{
+  if (width < 0 || height < 0)
+    throw std::invalid_argument("output size must not be negative");
+  out_width = width;
+  out_height = height;
+  format = format_;
+  scaling = scaling_;
 }
 
 
-const AVFrame& ConverterRGB24::convert(const AVFrame &frame, ubyte* out_rgb)
+std::pair<int, int> OutputStage::output_size(int w, int h) const
+{
+  return std::make_pair(out_width > 0 ? out_width : w, out_height > 0 ? out_height : h);
+}
+
+
+const AVFrame& OutputStage::convert(const AVFrame &frame, ubyte* out)
 {
   int w = frame.width;
   int h = frame.height;
   int pix_fmt = frame.format;
+  int ow, oh; std::tie(ow, oh) = output_size(w, h);
+  AVPixelFormat out_fmt = output_pix_fmt(format);
   
+  // The context is only rebuilt when sizes, formats or flags change.
   context = sws_getCachedContext(context, 
                                  w, h, (AVPixelFormat)pix_fmt, 
-                                 w, h, PIX_FMT_RGB24, SWS_BILINEAR, 
+                                 ow, oh, out_fmt, sws_scaling_flags(scaling), 
                                  nullptr, nullptr, nullptr);
   if (!context)
     throw H264DecodeFailure("cannot allocate context");
   
-  // Setup framergb with out_rgb as external buffer. Also say that we want RGB24 output.
-  avpicture_fill((AVPicture*)framergb, out_rgb, PIX_FMT_RGB24, w, h);
-  // Do the conversion.
+  // Setup frameout with out as external buffer in the requested output format.
+  avpicture_fill((AVPicture*)frameout, out, out_fmt, ow, oh);
+  // Do the conversion and scaling in one pass.
   sws_scale(context, frame.data, frame.linesize, 0, h,
-            framergb->data, framergb->linesize);
-  framergb->width = w;
-  framergb->height = h;
-  return *framergb;
+            frameout->data, frameout->linesize);
+  frameout->width = ow;
+  frameout->height = oh;
+  frameout->format = out_fmt;
+  return *frameout;
 }
 
 /*
@@ -149,9 +244,10 @@ to do this. However, avpicture_get_size returns the size of a compact
 representation, without padding bytes. Since we use avpicture_fill to 
 fill the buffer we should also use it to determine the required size.
 */
-int ConverterRGB24::predict_size(int w, int h)
+int OutputStage::predict_size(int w, int h)
 {
-  return avpicture_fill((AVPicture*)framergb, nullptr, PIX_FMT_RGB24, w, h);  
+  int ow, oh; std::tie(ow, oh) = output_size(w, h);
+  return avpicture_fill((AVPicture*)frameout, nullptr, output_pix_fmt(format), ow, oh);  
 }
 
 
@@ -167,6 +263,36 @@ int row_size(const AVFrame& f)
 }
 
 
+int plane_row_size(const AVFrame& f, int i)
+{
+  return f.linesize[i];
+}
+
+
+ssize_t yuv420_planes_size(const AVFrame& f)
+{
+  if (f.format != AV_PIX_FMT_YUV420P && f.format != AV_PIX_FMT_YUVJ420P)
+    throw std::invalid_argument("decoded frame is not planar YUV 4:2:0");
+  ssize_t chroma_height = (f.height + 1) / 2;
+  return (ssize_t)f.linesize[0] * f.height + ((ssize_t)f.linesize[1] + f.linesize[2]) * chroma_height;
+}
+
+
+void copy_yuv420_planes(const AVFrame& f, ubyte* out)
+{
+  ssize_t chroma_height = (f.height + 1) / 2;
+  ssize_t sizes[3] = { (ssize_t)f.linesize[0] * f.height, 
+                       (ssize_t)f.linesize[1] * chroma_height, 
+                       (ssize_t)f.linesize[2] * chroma_height };
+  // each plane is a single block of linesize * rows bytes, so whole planes are copied at once
+  for (int i = 0; i < 3; ++i)
+  {
+    memcpy(out, f.data[i], sizes[i]);
+    out += sizes[i];
+  }
+}
+
+
 void disable_logging()
 {
   av_log_set_level(AV_LOG_QUIET);
@@ -19,6 +19,7 @@ mechanisms of boost::python.
 // for ssize_t (signed int type as large as pointer type)
 #include <cstdlib>
 #include <stdexcept>
+#include <utility>
 
 struct AVCodecContext;
 struct AVFrame;
@@ -47,6 +48,18 @@ public:
 };
 
 
+/* Threading of libavcodec, see FF_THREAD_FRAME and FF_THREAD_SLICE. Frame 
+threading adds one frame of latency per extra thread, slice threading 
+only helps if the stream has several slices per frame. */
+enum ThreadType
+{
+  THREAD_DEFAULT = 0,
+  THREAD_FRAME = 1,
+  THREAD_SLICE = 2,
+  THREAD_FRAME_SLICE = 3
+};
+
+
 class H264Decoder
 {
   /* Persistent things here, using RAII for cleanup. */
@@ -60,9 +73,17 @@ to the encoded data, which must be kept around  between calls to
 parse- and decode frame. In release 11 it is put on the stack, too. 
   */
   AVPacket              *pkt;
+  /* Packets libavcodec failed to decode, and pictures it returned with
+concealed errors, see error_counts. */
+  long decode_errors = 0;
+  long corrupt_frames = 0;
 public:
-  H264Decoder();
+  /* thread_count 0 lets libavcodec pick one thread per core, THREAD_DEFAULT
+  keeps libavcodec's choice of thread type. */
+  H264Decoder(int thread_count = 1, ThreadType thread_type = THREAD_DEFAULT);
   ~H264Decoder();
+  /* Number of threads and thread type (a ThreadType value) in effect once the codec is open. */
+  std::pair<int, int> threading() const;
   /* First, parse a continuous data stream, dividing it into 
 packets. When there is enough data to form a new frame, decode 
 the data and return the frame. parse returns the number 
@@ -71,27 +92,68 @@ bytes at frame boundaries.
   */
   ssize_t parse(const unsigned char* in_data, ssize_t in_size);
   bool is_frame_available() const;
-  const AVFrame& decode_frame();
+  /* Decode the packet found by parse. Returns nullptr if it did not
+complete a picture, e.g. parameter sets only or a frame held back by
+frame threading. Throws H264DecodeFailure if libavcodec rejects it. */
+  const AVFrame* decode_frame();
+  /* Drop the pictures held by the codec, references included, and any
+partial packet in the parser, e.g. before resuming at a keyframe after
+packet loss. */
+  void flush();
+  /* (packets that failed to decode, pictures decoded with concealed
+errors) since construction. */
+  std::pair<long, long> error_counts() const;
+};
+
+/* Pixel formats the output stage can produce. Kept separate from AVPixelFormat,
+so we don't have to include libav headers. */
+enum OutputFormat
+{
+  OUTPUT_RGB24,
+  OUTPUT_BGR24,
+  OUTPUT_GRAY8,
+  OUTPUT_YUV420P
+};
+
+/* Scaling algorithms of libswscale, see SWS_FAST_BILINEAR and friends. */
+enum Scaling
+{
+  SCALING_FAST_BILINEAR,
+  SCALING_BILINEAR,
+  SCALING_BICUBIC,
+  SCALING_POINT,
+  SCALING_AREA
 };
 
-// TODO: Rename to OutputStage or so?!
-class ConverterRGB24
+
+class OutputStage
 {
   SwsContext *context;
-  AVFrame *framergb;
+  AVFrame *frameout;
+  /* Output size, 0 means the size of the decoded frame. */
+  int out_width, out_height;
+  OutputFormat format;
+  Scaling scaling;
   
 public:
-  ConverterRGB24();
-  ~ConverterRGB24();
-   
-  /*  Returns, given a width and height, 
-      how many bytes the frame buffer is going to need. */
+  OutputStage();
+  ~OutputStage();
+
+  /*  Select size, pixel format and scaling algorithm of the output. The conversion
+      is done in a single sws_scale pass. A width or height of 0 keeps the size
+      of the decoded frame. */
+  void set_output(int width, int height, OutputFormat format, Scaling scaling);
+  /*  Returns, given the width and height of a decoded frame, the size
+      of the output frame. */
+  std::pair<int, int> output_size(int w, int h) const;
+  /*  Returns, given the width and height of a decoded frame,
+      how many bytes the output frame buffer is going to need. */
   int predict_size(int w, int h);
-  /*  Given a decoded frame, convert it to RGB format and fill 
-out_rgb with the result. Returns a AVFrame structure holding 
-additional information about the RGB frame, such as the number of
-bytes in a row and so on. */
-  const AVFrame& convert(const AVFrame &frame, unsigned char* out_rgb);
+  /*  Given a decoded frame, convert it to the output format and fill 
+out with the result. Returns a AVFrame structure holding 
+additional information about the output frame, such as its size and
+the number of bytes in a row. */
+  const AVFrame& convert(const AVFrame &frame, unsigned char* out);
 };
 
 void disable_logging();
@@ -99,6 +161,15 @@ void disable_logging();
 /* Wrappers, so we don't have to include libav headers. */
 std::pair<int, int> width_height(const AVFrame&);
 int row_size(const AVFrame&);
+/* Byte size of the Y, U and V planes of a decoded YUV 4:2:0 frame, including
+row padding. Throws std::invalid_argument for any other pixel format. */
+ssize_t yuv420_planes_size(const AVFrame&);
+/* Copy the Y, U and V planes of a decoded YUV 4:2:0 frame one after another 
+into out, rows keep the padding given by the frame's linesize. No color 
+conversion or scaling takes place. */
+void copy_yuv420_planes(const AVFrame&, unsigned char* out);
+/* Linesize of plane i. */
+int plane_row_size(const AVFrame&, int i);
 
 /* all the documentation links
  * My version of libav on ubuntu 16 appears to be from the release/11 branch on github
@@ -2,9 +2,17 @@
 #include <cstdlib>
 #include <stdexcept>
 #include <cassert>
+#include <cerrno>
+#include <cstdint>
+#include <algorithm>
 
-// python string api, see
+#ifdef __linux__
+#include <sys/socket.h>
+#endif
+
+// python string and buffer api, see
 // https://docs.python.org/2/c-api/string.html
+// https://docs.python.org/2/c-api/buffer.html
 extern "C" {
   #include <Python.h>
 }
@@ -17,6 +25,9 @@ extern "C" {
 namespace py = boost::python;
 
 #include "h264decoder.hpp"
+#ifndef _WIN32
+#include "stream_session.hpp"
+#endif
 
 using ubyte = unsigned char;
 
@@ -62,11 +73,41 @@ private:
 };
 
 
+class PyBufferView
+{
+  // Pins the memory of any object supporting the buffer protocol (str, bytearray,
+  // memoryview, numpy arrays, ...) for the lifetime of the view, so it can be
+  // accessed without holding the GIL.
+public:
+  PyBufferView(const py::object &obj, bool writable)
+  {
+    if (PyObject_GetBuffer(obj.ptr(), &view, writable ? PyBUF_WRITABLE : PyBUF_SIMPLE) != 0)
+      py::throw_error_already_set();
+  }
+
+  ~PyBufferView()
+  {
+    PyBuffer_Release(&view);
+  }
+
+  const ubyte* data() const { return (const ubyte*)view.buf; }
+  ubyte* mutable_data() { return (ubyte*)view.buf; }
+  ssize_t size() const { return view.len; }
+
+  PyBufferView(const PyBufferView &) = delete;
+  PyBufferView(const PyBufferView &&) = delete;
+  PyBufferView operator=(const PyBufferView &) = delete;
+  PyBufferView operator=(const PyBufferView &&) = delete;
+private:
+  Py_buffer view;
+};
+
+
 /* The class wrapped in python via boost::python */
 class PyH264Decoder
 {
   H264Decoder decoder;
-  ConverterRGB24 converter;
+  OutputStage converter;
 
   /* Extract frames from input stream. Stops at frame boundaries and returns the number of consumed bytes
    * in num_consumed.
@@ -78,13 +119,65 @@ class PyH264Decoder
    * contains dummy data.
    */ 
   py::tuple decode_frame_impl(const ubyte *data, ssize_t num, ssize_t &num_consumed, bool &is_frame_available);
+  /* Same as above, but the converted frame is written to the caller supplied buffer out. Returns true
+   * if a frame was written, in which case w, h and linesize describe its layout. Runs without the GIL
+   * held, so data and out must be pinned by the caller.
+   */
+  bool decode_frame_into_impl(const ubyte *data, ssize_t num, ssize_t &num_consumed,
+                              ubyte *out, ssize_t out_size, int &w, int &h, int &linesize);
+  /* Same as above, but the Y, U and V planes of the decoded frame are copied to out as they are,
+   * skipping the output stage. linesizes receives the linesize of each plane. */
+  bool decode_planes_into_impl(const ubyte *data, ssize_t num, ssize_t &num_consumed,
+                               ubyte *out, ssize_t out_size, int &w, int &h, int linesizes[3]);
   
 public:
+  PyH264Decoder(int thread_count = 1, ThreadType thread_type = THREAD_DEFAULT)
+    : decoder(thread_count, thread_type)
+  {}
+
   /* Decoding style analogous to c/c++ way. Stop at frame boundaries. 
-   * Return tuple containing frame data as above as nested tuple, and an integer telling how many bytes were consumed.  */
-  py::tuple decode_frame(const py::str &data_in_str);
+   * Return tuple containing frame data as above as nested tuple, and an integer telling how many bytes were consumed.
+   * data_in may be any object supporting the buffer protocol. */
+  py::tuple decode_frame(const py::object &data_in);
   /* Process all the input data and return a list of all contained frames. */
-  py::list  decode(const py::str &data_in_str);
+  py::list  decode(const py::object &data_in);
+  /* Process all the input data and convert every decoded frame straight into the writable, contiguous 
+   * buffer out (e.g. a numpy array), so the last frame wins. No python objects are allocated per frame.
+   * Returns a tuple (number of frames decoded, width, height, linesize) describing the buffer contents. */
+  py::tuple decode_into(const py::object &data_in, const py::object &out);
+  /* Like decode_into, but without any color conversion or scaling: the Y, U and V planes of the decoded 
+   * YUV 4:2:0 frame are placed one after another in out, each row padded to the linesize of its plane.
+   * Returns a tuple (number of frames decoded, width, height, (Y linesize, U linesize, V linesize)). */
+  py::tuple decode_planes_into(const py::object &data_in, const py::object &out);
+  /* Select size (0 keeps the decoded size), pixel format and scaling algorithm of the frames returned
+   * by the decode functions. */
+  void set_output(int width, int height, OutputFormat format, Scaling scaling)
+  {
+    converter.set_output(width, height, format, scaling);
+  }
+  /* Tuple (thread count, ThreadType flags) libavcodec actually uses. */
+  py::tuple threading() const
+  {
+    int count, type; std::tie(count, type) = decoder.threading();
+    return py::make_tuple(count, type);
+  }
+  /* Forget the pictures and partial packet the decoder holds, see H264Decoder::flush. */
+  void flush()
+  {
+    decoder.flush();
+  }
+  /* Tuple (packets that failed to decode, pictures decoded with concealed errors) so far. Compare
+   * before and after a decode call to tell whether its input was damaged. */
+  py::tuple error_counts() const
+  {
+    long errors, corrupt; std::tie(errors, corrupt) = decoder.error_counts();
+    return py::make_tuple(errors, corrupt);
+  }
+  /* Number of bytes an output frame needs, given the size of the decoded frame. */
+  int predict_size(int w, int h)
+  {
+    return converter.predict_size(w, h);
+  }
 };
 
 
@@ -93,22 +186,27 @@ py::tuple PyH264Decoder::decode_frame_impl(const ubyte *data_in, ssize_t len, ss
   GILScopedReverseLock gilguard;
   num_consumed = decoder.parse((ubyte*)data_in, len);
   
-  if (is_frame_available = decoder.is_frame_available())
+  const AVFrame *decoded = nullptr;
+  if (decoder.is_frame_available())
+    decoded = decoder.decode_frame();
+  if (is_frame_available = (decoded != nullptr))
   {
-    const auto &frame = decoder.decode_frame();
+    const auto &frame = *decoded;
     int w, h; std::tie(w,h) = width_height(frame);
     Py_ssize_t out_size = converter.predict_size(w,h);
 
     gilguard.lock();
     //   Construction of py::handle causes ... TODO: WHAT? No increase of ref count ?!
-    py::object py_out_str(py::handle<>(PyString_FromStringAndSize(NULL, out_size)));
-    char* out_buffer = PyString_AsString(py_out_str.ptr());
+    // bytes on Python 3, str on Python 2 (where PyBytes_* are aliases of PyString_*)
+    py::object py_out_str(py::handle<>(PyBytes_FromStringAndSize(NULL, out_size)));
+    char* out_buffer = PyBytes_AsString(py_out_str.ptr());
 
     gilguard.unlock();
-    const auto &rgbframe = converter.convert(frame, (ubyte*)out_buffer);
+    const auto &outframe = converter.convert(frame, (ubyte*)out_buffer);
+    std::tie(w,h) = width_height(outframe);
     
     gilguard.lock();
-    return py::make_tuple(py_out_str, w, h, row_size(rgbframe));
+    return py::make_tuple(py_out_str, w, h, row_size(outframe));
   }
   else
   {
@@ -118,10 +216,59 @@ py::tuple PyH264Decoder::decode_frame_impl(const ubyte *data_in, ssize_t len, ss
 }
 
 
-py::tuple PyH264Decoder::decode_frame(const py::str &data_in_str)
+bool PyH264Decoder::decode_frame_into_impl(const ubyte *data_in, ssize_t len, ssize_t &num_consumed,
+                                           ubyte *out, ssize_t out_size, int &w, int &h, int &linesize)
+{
+  GILScopedReverseLock gilguard;
+  num_consumed = decoder.parse(data_in, len);
+
+  if (!decoder.is_frame_available())
+    return false;
+
+  const AVFrame *decoded = decoder.decode_frame();
+  if (!decoded)
+    return false;
+  const auto &frame = *decoded;
+  std::tie(w,h) = width_height(frame);
+  if (converter.predict_size(w,h) > out_size)
+    throw std::invalid_argument("output buffer is too small for the decoded frame");
+
+  const auto &outframe = converter.convert(frame, out);
+  std::tie(w,h) = width_height(outframe);
+  linesize = row_size(outframe);
+  return true;
+}
+
+
+bool PyH264Decoder::decode_planes_into_impl(const ubyte *data_in, ssize_t len, ssize_t &num_consumed,
+                                            ubyte *out, ssize_t out_size, int &w, int &h, int linesizes[3])
+{
+  GILScopedReverseLock gilguard;
+  num_consumed = decoder.parse(data_in, len);
+
+  if (!decoder.is_frame_available())
+    return false;
+
+  const AVFrame *decoded = decoder.decode_frame();
+  if (!decoded)
+    return false;
+  const auto &frame = *decoded;
+  if (yuv420_planes_size(frame) > out_size)
+    throw std::invalid_argument("output buffer is too small for the decoded planes");
+
+  copy_yuv420_planes(frame, out);
+  std::tie(w,h) = width_height(frame);
+  for (int i = 0; i < 3; ++i)
+    linesizes[i] = plane_row_size(frame, i);
+  return true;
+}
+
+
+py::tuple PyH264Decoder::decode_frame(const py::object &data_in_obj)
 {
-  ssize_t len = PyString_Size(data_in_str.ptr());
-  const ubyte* data_in = (const ubyte*)(PyString_AsString(data_in_str.ptr()));
+  PyBufferView in_view(data_in_obj, false);
+  ssize_t len = in_view.size();
+  const ubyte* data_in = in_view.data();
 
   ssize_t num_consumed = 0;
   bool is_frame_available = false;
@@ -131,10 +278,11 @@ py::tuple PyH264Decoder::decode_frame(const py::str &data_in_str)
 }
 
 
-py::list PyH264Decoder::decode(const py::str &data_in_str)
+py::list PyH264Decoder::decode(const py::object &data_in_obj)
 {
-  ssize_t len = PyString_Size(data_in_str.ptr());
-  const ubyte* data_in = (const ubyte*)(PyString_AsString(data_in_str.ptr()));
+  PyBufferView in_view(data_in_obj, false);
+  ssize_t len = in_view.size();
+  const ubyte* data_in = in_view.data();
   
   py::list out;
   
@@ -172,11 +320,259 @@ py::list PyH264Decoder::decode(const py::str &data_in_str)
 }
 
 
+py::tuple PyH264Decoder::decode_into(const py::object &data_in_obj, const py::object &out_obj)
+{
+  PyBufferView in_view(data_in_obj, false);
+  PyBufferView out_view(out_obj, true);
+  ssize_t len = in_view.size();
+  const ubyte* data_in = in_view.data();
+
+  int num_frames = 0, w = 0, h = 0, linesize = 0;
+
+  try
+  {
+    while (len > 0)
+    {
+      ssize_t num_consumed = 0;
+
+      try
+      {
+        if (decode_frame_into_impl(data_in, len, num_consumed, out_view.mutable_data(), out_view.size(), w, h, linesize))
+          ++num_frames;
+      }
+      catch (const H264DecodeFailure &e)
+      {
+        if (num_consumed <= 0)
+          // This case is fatal because we cannot continue to move ahead in the stream.
+          throw e;
+      }
+
+      len -= num_consumed;
+      data_in += num_consumed;
+    }
+  }
+  catch (const H264DecodeFailure &e)
+  {
+  }
+
+  return py::make_tuple(num_frames, w, h, linesize);
+}
+
+
+py::tuple PyH264Decoder::decode_planes_into(const py::object &data_in_obj, const py::object &out_obj)
+{
+  PyBufferView in_view(data_in_obj, false);
+  PyBufferView out_view(out_obj, true);
+  ssize_t len = in_view.size();
+  const ubyte* data_in = in_view.data();
+
+  int num_frames = 0, w = 0, h = 0;
+  int linesizes[3] = {0, 0, 0};
+
+  try
+  {
+    while (len > 0)
+    {
+      ssize_t num_consumed = 0;
+
+      try
+      {
+        if (decode_planes_into_impl(data_in, len, num_consumed, out_view.mutable_data(), out_view.size(), w, h, linesizes))
+          ++num_frames;
+      }
+      catch (const H264DecodeFailure &e)
+      {
+        if (num_consumed <= 0)
+          // This case is fatal because we cannot continue to move ahead in the stream.
+          throw e;
+      }
+
+      len -= num_consumed;
+      data_in += num_consumed;
+    }
+  }
+  catch (const H264DecodeFailure &e)
+  {
+  }
+
+  return py::make_tuple(num_frames, w, h, py::make_tuple(linesizes[0], linesizes[1], linesizes[2]));
+}
+
+
+#ifndef _WIN32
+/* The whole video pipeline in a C++ thread, see stream_session.hpp. Python only copies out the latest frame. */
+class PyStreamSession
+{
+  StreamSession session;
+public:
+  PyStreamSession(const std::string &local_ip, int port, int width, int height, OutputFormat format,
+                  Scaling scaling, int thread_count = 1, ThreadType thread_type = THREAD_DEFAULT,
+                  int receive_buffer = 0)
+    : session(local_ip, port, width, height, format, scaling, thread_count, thread_type, receive_buffer)
+  {}
+
+  /* Wait up to timeout seconds for a frame newer than after_seq and copy it into out. Returns the tuple
+   * (seq, width, height, linesize, received_at, decode_time, access_unit_bytes), seq is 0 if no newer
+   * frame arrived and -1 once the session is closed. */
+  py::tuple latest_frame(const py::object &out_obj, long after_seq, double timeout)
+  {
+    PyBufferView out_view(out_obj, true);
+    int w = 0, h = 0, linesize = 0;
+    FrameTimes times;
+    long seq;
+    {
+      GILScopedReverseLock gilguard;
+      seq = session.latest_frame(out_view.mutable_data(), out_view.size(), after_seq, timeout,
+                                 w, h, linesize, times);
+    }
+    return py::make_tuple(seq, w, h, linesize, times.received_at, times.decode_time, times.access_unit_bytes);
+  }
+
+  /* Seconds since the loss the stream waits to recover from, None while it is synced. Lets
+   * tello_video.KeyframeRequester poll the session like a StreamResync. */
+  py::object waiting(double now) const
+  {
+    double waited = session.waiting(now);
+    return waited < 0 ? py::object() : py::object(waited);
+  }
+
+  py::dict stats() const
+  {
+    StreamStats stats = session.stats();
+    py::dict out;
+    out["datagrams"] = stats.datagrams;
+    out["bytes"] = stats.bytes;
+    out["access_units"] = stats.access_units;
+    out["frames"] = stats.frames;
+    out["fragments"] = stats.fragments;
+    out["overflows"] = stats.overflows;
+    out["skipped"] = stats.skipped;
+    out["resyncs"] = stats.resyncs;
+    out["decode_errors"] = stats.decode_errors;
+    out["corrupt_frames"] = stats.corrupt_frames;
+    out["decode_time"] = stats.decode_time;
+    return out;
+  }
+
+  int port() const
+  {
+    return session.port();
+  }
+
+  int frame_size() const
+  {
+    return session.frame_size();
+  }
+
+  void close()
+  {
+    GILScopedReverseLock gilguard;
+    session.close();
+  }
+};
+#endif
+
+
+#ifdef __linux__
+/* Receive as many datagrams as are queued on the socket fd, at least one, with a single recvmmsg call
+ * made without the GIL. Datagram i is written to buffer at i * packet_size and its length to lengths[i],
+ * a writable buffer of int32. Returns the number of datagrams received. The socket must be blocking.
+ */
+int recv_batch(int fd, const py::object &buffer_obj, int packet_size, const py::object &lengths_obj)
+{
+  const int MAX_BATCH = 64;
+  if (packet_size <= 0)
+    throw std::invalid_argument("packet_size must be positive");
+  PyBufferView buffer(buffer_obj, true);
+  PyBufferView lengths_view(lengths_obj, true);
+  int max_packets = (int)std::min<ssize_t>(std::min<ssize_t>(buffer.size() / packet_size,
+                                                             lengths_view.size() / sizeof(int32_t)), MAX_BATCH);
+  if (max_packets <= 0)
+    throw std::invalid_argument("buffer or lengths too small for a single datagram");
+
+  struct mmsghdr msgs[MAX_BATCH];
+  struct iovec iovecs[MAX_BATCH];
+  for (int i = 0; i < max_packets; ++i)
+  {
+    iovecs[i].iov_base = buffer.mutable_data() + (ssize_t)i * packet_size;
+    iovecs[i].iov_len = packet_size;
+    msgs[i] = mmsghdr();
+    msgs[i].msg_hdr.msg_iov = &iovecs[i];
+    msgs[i].msg_hdr.msg_iovlen = 1;
+  }
+
+  int count, error = 0;
+  {
+    GILScopedReverseLock gilguard;
+    // blocks until the first datagram arrives, then takes whatever else is already queued
+    do
+      count = recvmmsg(fd, msgs, max_packets, MSG_WAITFORONE, nullptr);
+    while (count < 0 && errno == EINTR);
+    if (count < 0)
+      error = errno;
+  }
+  if (count < 0)
+  {
+    // raise socket.error, like the socket methods this replaces
+    py::object socket_error = py::import("socket").attr("error");
+    errno = error;
+    PyErr_SetFromErrno(socket_error.ptr());
+    py::throw_error_already_set();
+  }
+
+  int32_t *lengths = (int32_t*)lengths_view.mutable_data();
+  for (int i = 0; i < count; ++i)
+    lengths[i] = msgs[i].msg_len;
+  return count;
+}
+#endif
+
+
 BOOST_PYTHON_MODULE(libh264decoder)
 {
   PyEval_InitThreads(); // need for release of the GIL (http://stackoverflow.com/questions/8009613/boost-python-not-supporting-parallelism)
-  py::class_<PyH264Decoder>("H264Decoder")
+  py::enum_<OutputFormat>("OutputFormat")
+                            .value("RGB24", OUTPUT_RGB24)
+                            .value("BGR24", OUTPUT_BGR24)
+                            .value("GRAY8", OUTPUT_GRAY8)
+                            .value("YUV420P", OUTPUT_YUV420P)
+                            .export_values();
+  py::enum_<Scaling>("Scaling")
+                            .value("FAST_BILINEAR", SCALING_FAST_BILINEAR)
+                            .value("BILINEAR", SCALING_BILINEAR)
+                            .value("BICUBIC", SCALING_BICUBIC)
+                            .value("POINT", SCALING_POINT)
+                            .value("AREA", SCALING_AREA)
+                            .export_values();
+  py::enum_<ThreadType>("ThreadType")
+                            .value("THREAD_DEFAULT", THREAD_DEFAULT)
+                            .value("THREAD_FRAME", THREAD_FRAME)
+                            .value("THREAD_SLICE", THREAD_SLICE)
+                            .value("THREAD_FRAME_SLICE", THREAD_FRAME_SLICE)
+                            .export_values();
+  py::class_<PyH264Decoder>("H264Decoder", py::init<py::optional<int, ThreadType> >())
                             .def("decode_frame", &PyH264Decoder::decode_frame)
-                            .def("decode", &PyH264Decoder::decode);
+                            .def("decode", &PyH264Decoder::decode)
+                            .def("decode_into", &PyH264Decoder::decode_into)
+                            .def("decode_planes_into", &PyH264Decoder::decode_planes_into)
+                            .def("set_output", &PyH264Decoder::set_output)
+                            .def("predict_size", &PyH264Decoder::predict_size)
+                            .def("threading", &PyH264Decoder::threading)
+                            .def("flush", &PyH264Decoder::flush)
+                            .def("error_counts", &PyH264Decoder::error_counts);
   py::def("disable_logging", disable_logging);
+#ifdef __linux__
+  py::def("recv_batch", recv_batch);
+#endif
+#ifndef _WIN32
+  py::class_<PyStreamSession, boost::noncopyable>("StreamSession",
+                            py::init<std::string, int, int, int, OutputFormat, Scaling,
+                                     py::optional<int, ThreadType, int> >())
+                            .def("latest_frame", &PyStreamSession::latest_frame)
+                            .def("waiting", &PyStreamSession::waiting)
+                            .def("stats", &PyStreamSession::stats)
+                            .def("port", &PyStreamSession::port)
+                            .def("frame_size", &PyStreamSession::frame_size)
+                            .def("close", &PyStreamSession::close);
+#endif
 }
\ No newline at end of file
@@ -0,0 +1,335 @@
+#ifndef _WIN32
+
+#include "stream_session.hpp"
+
+#include <arpa/inet.h>
+#include <netinet/in.h>
+#include <sys/socket.h>
+#include <sys/time.h>
+#include <unistd.h>
+
+#include <cerrno>
+#include <chrono>
+#include <cstring>
+#include <tuple>
+
+typedef unsigned char ubyte;
+
+// the Tello cuts every access unit into datagrams of this size, a shorter one ends it
+static const ssize_t TELLO_PACKET_SIZE = 1460;
+static const ssize_t PACKET_SIZE = 2048;
+static const ssize_t ACCESS_UNIT_SIZE = 256 * 1024;
+static const int TELLO_WIDTH = 960, TELLO_HEIGHT = 720;  // size of the video the Tello streams
+
+
+static double now_seconds()
+{
+  using namespace std::chrono;
+  return duration_cast<duration<double> >(system_clock::now().time_since_epoch()).count();
+}
+
+
+static std::runtime_error socket_error(const char *what)
+{
+  return std::runtime_error(std::string(what) + ": " + strerror(errno));
+}
+
+
+/* Offset of the NAL header after a start code at the beginning of data, 0 if there is none. */
+static ssize_t nal_header_offset(const ubyte *data, ssize_t len)
+{
+  if (len >= 4 && data[0] == 0 && data[1] == 0 && data[2] == 1)
+    return 3;
+  if (len >= 5 && data[0] == 0 && data[1] == 0 && data[2] == 0 && data[3] == 1)
+    return 4;
+  return 0;
+}
+
+
+/* Whether a datagram begins a new access unit (H.264 7.4.1.2.3), see tello_video._nal_starts_access_unit. */
+static bool starts_access_unit(const ubyte *data, ssize_t len)
+{
+  ssize_t pos = nal_header_offset(data, len);
+  if (pos == 0 || pos + 1 >= len)
+    return false;
+  int nal_type = data[pos] & 0x1f;
+  if (nal_type == 6 || nal_type == 7 || nal_type == 8 || nal_type == 9)
+    return true;
+  // first slice of a picture, first_mb_in_slice is 0
+  return (nal_type == 1 || nal_type == 5) && (data[pos + 1] & 0x80);
+}
+
+
+/* Whether an access unit carries an IDR picture or sequence parameter set, see tello_video.is_keyframe. */
+static bool is_keyframe(const ubyte *data, ssize_t len)
+{
+  for (ssize_t pos = 0; pos + 3 < len; ++pos)
+  {
+    if (data[pos] != 0 || data[pos + 1] != 0 || data[pos + 2] != 1)
+      continue;
+    int nal_type = data[pos + 3] & 0x1f;
+    if (nal_type == 5 || nal_type == 7)
+      return true;
+    if (nal_type >= 1 && nal_type <= 4)
+      return false;
+    pos += 2;
+  }
+  return false;
+}
+
+
+StreamSession::StreamSession(const std::string &local_ip, int port, int width, int height, OutputFormat format,
+                             Scaling scaling, int thread_count, ThreadType thread_type, int receive_buffer)
+  : decoder(thread_count, thread_type), access_unit(ACCESS_UNIT_SIZE), started_at(now_seconds())
+{
+  converter.set_output(width, height, format, scaling);
+  // computed before the thread starts, predict_size and convert share the converter's output frame
+  frame_bytes = converter.predict_size(TELLO_WIDTH, TELLO_HEIGHT);
+
+  fd = socket(AF_INET, SOCK_DGRAM, 0);
+  if (fd < 0)
+    throw socket_error("cannot create socket");
+  if (receive_buffer > 0)
+    setsockopt(fd, SOL_SOCKET, SO_RCVBUF, &receive_buffer, sizeof(receive_buffer));
+  // lets the thread notice close()
+  struct timeval timeout = {0, 100 * 1000};
+  setsockopt(fd, SOL_SOCKET, SO_RCVTIMEO, &timeout, sizeof(timeout));
+
+  struct sockaddr_in address;
+  std::memset(&address, 0, sizeof(address));
+  address.sin_family = AF_INET;
+  address.sin_port = htons(port);
+  address.sin_addr.s_addr = htonl(INADDR_ANY);
+  if (!local_ip.empty() && inet_pton(AF_INET, local_ip.c_str(), &address.sin_addr) != 1)
+  {
+    ::close(fd);
+    throw std::invalid_argument("not an IPv4 address: " + local_ip);
+  }
+  if (bind(fd, (struct sockaddr*)&address, sizeof(address)) < 0)
+  {
+    auto error = socket_error("cannot bind video socket");
+    ::close(fd);
+    throw error;
+  }
+  socklen_t address_size = sizeof(address);
+  getsockname(fd, (struct sockaddr*)&address, &address_size);
+  bound_port = ntohs(address.sin_port);
+
+  thread = std::thread(&StreamSession::run, this);
+}
+
+
+StreamSession::~StreamSession()
+{
+  close();
+}
+
+
+void StreamSession::close()
+{
+  {
+    std::lock_guard<std::mutex> lock(mutex);
+    if (stopping)
+      return;
+    stopping = true;
+  }
+  new_frame.notify_all();
+  if (thread.joinable())
+    thread.join();
+  ::close(fd);
+}
+
+
+int StreamSession::port() const
+{
+  return bound_port;
+}
+
+
+int StreamSession::frame_size() const
+{
+  return frame_bytes;
+}
+
+
+void StreamSession::run()
+{
+  ubyte *buffer = access_unit.data();
+  while (true)
+  {
+    {
+      std::lock_guard<std::mutex> lock(mutex);
+      if (stopping)
+        return;
+      if (length + PACKET_SIZE > ACCESS_UNIT_SIZE)
+      {
+        // the access unit outgrew the buffer -- drop it and start over
+        length = 0;
+        ++counters.overflows;
+        lost();
+      }
+    }
+    ubyte *packet = buffer + length;
+    ssize_t nbytes = recv(fd, packet, PACKET_SIZE, 0);
+    if (nbytes < 0)
+      continue;  // timeout, close() is checked above
+    {
+      std::lock_guard<std::mutex> lock(mutex);
+      ++counters.datagrams;
+      counters.bytes += nbytes;
+    }
+    if (length > 0 && starts_access_unit(packet, nbytes))
+    {
+      // the previous access unit was a multiple of the datagram size, so its end went unnoticed
+      end_access_unit(length);
+      std::memmove(buffer, packet, nbytes);
+      length = 0;
+    }
+    length += nbytes;
+    // end of frame
+    if (nbytes != TELLO_PACKET_SIZE)
+    {
+      end_access_unit(length);
+      length = 0;
+    }
+  }
+}
+
+
+void StreamSession::lost()
+{
+  if (lost_at == 0.)
+    lost_at = now_seconds();
+  waiting_for_keyframe = true;
+}
+
+
+void StreamSession::end_access_unit(ssize_t len)
+{
+  const ubyte *data = access_unit.data();
+  FrameTimes times;
+  times.received_at = now_seconds();
+  times.access_unit_bytes = len;
+  bool resync = false;
+  {
+    std::lock_guard<std::mutex> lock(mutex);
+    ++counters.access_units;
+    if (nal_header_offset(data, len) == 0)
+    {
+      // the tail of an access unit whose start was lost, it cannot be decoded
+      ++counters.fragments;
+      lost();
+      return;
+    }
+    if (waiting_for_keyframe)
+    {
+      if (!is_keyframe(data, len))
+      {
+        ++counters.skipped;
+        return;
+      }
+      waiting_for_keyframe = false;
+      // at the start of the stream the decoder holds nothing stale
+      resync = lost_at != 0.;
+      if (resync)
+        ++counters.resyncs;
+    }
+  }
+  if (resync)
+    decoder.flush();
+
+  auto start = std::chrono::steady_clock::now();
+  auto errors = decoder.error_counts();
+  int w = 0, h = 0, linesize = 0;
+  bool converted = false;
+  while (len > 0)
+  {
+    ssize_t consumed = decoder.parse(data, len);
+    if (consumed <= 0)
+      break;
+    const AVFrame *frame = nullptr;
+    try
+    {
+      if (decoder.is_frame_available())
+        frame = decoder.decode_frame();
+    }
+    catch (const H264DecodeFailure &)
+    {
+      // counted by the decoder, see below
+    }
+    if (frame)
+    {
+      std::tie(w, h) = width_height(*frame);
+      back.resize(converter.predict_size(w, h));
+      const auto &outframe = converter.convert(*frame, back.data());
+      std::tie(w, h) = width_height(outframe);
+      linesize = row_size(outframe);
+      converted = true;
+    }
+    len -= consumed;
+    data += consumed;
+  }
+  double decode_time = std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+  times.decode_time = decode_time;
+
+  bool damaged = decoder.error_counts() != errors;
+  {
+    std::lock_guard<std::mutex> lock(mutex);
+    counters.decode_time += decode_time;
+    std::tie(counters.decode_errors, counters.corrupt_frames) = decoder.error_counts();
+    if (damaged)
+    {
+      // damaged data the decoder rejected or concealed, do not show it
+      lost();
+      return;
+    }
+    if (!converted)
+      return;
+    front.swap(back);
+    frame_w = w;
+    frame_h = h;
+    frame_linesize = linesize;
+    frame_times = times;
+    ++seq;
+    ++counters.frames;
+    lost_at = 0.;
+  }
+  new_frame.notify_all();
+}
+
+
+long StreamSession::latest_frame(ubyte *out, ssize_t out_size, long after_seq, double timeout,
+                                 int &w, int &h, int &linesize, FrameTimes &times)
+{
+  std::unique_lock<std::mutex> lock(mutex);
+  new_frame.wait_for(lock, std::chrono::duration<double>(timeout),
+                     [&] { return seq > after_seq || stopping; });
+  if (seq <= after_seq)
+    return stopping ? -1 : 0;
+  if ((ssize_t)front.size() > out_size)
+    throw std::invalid_argument("output buffer is too small for the decoded frame");
+  std::memcpy(out, front.data(), front.size());
+  w = frame_w;
+  h = frame_h;
+  linesize = frame_linesize;
+  times = frame_times;
+  return seq;
+}
+
+
+double StreamSession::waiting(double now) const
+{
+  std::lock_guard<std::mutex> lock(mutex);
+  if (!waiting_for_keyframe)
+    return -1.;
+  return now - (lost_at != 0. ? lost_at : started_at);
+}
+
+
+StreamStats StreamSession::stats() const
+{
+  std::lock_guard<std::mutex> lock(mutex);
+  return counters;
+}
+
+#endif
@@ -0,0 +1,108 @@
+#pragma once
+/*
+A complete video pipeline on a thread of its own: receive the UDP datagrams
+of the Tello stream, assemble them into access units, decode and convert
+them. Nothing in the loop touches Python, so neither the GIL nor slow Python
+code can hold the video back. Only the most recent frame is kept; readers copy
+it out with latest_frame, frames they were too slow for are skipped.
+
+After a loss (a fragment without its start, an oversized access unit or a
+decoder error) access units are skipped up to the next keyframe, where the
+decoder is flushed, the same policy as tello_video.StreamResync.
+
+Uses POSIX sockets, not available on Windows.
+*/
+
+#include <condition_variable>
+#include <mutex>
+#include <string>
+#include <thread>
+#include <vector>
+
+#include "h264decoder.hpp"
+
+
+struct StreamStats
+{
+  long datagrams = 0;
+  long bytes = 0;
+  long access_units = 0;
+  long frames = 0;          // frames published
+  long fragments = 0;       // access units whose start was lost
+  long overflows = 0;       // access units larger than the assembly buffer
+  long skipped = 0;         // access units dropped while waiting for a keyframe
+  long resyncs = 0;
+  long decode_errors = 0;   // see H264Decoder::error_counts
+  long corrupt_frames = 0;
+  double decode_time = 0.;  // seconds spent decoding and converting
+};
+
+
+/* Where a published frame came from, for the telemetry of tello_telemetry. */
+struct FrameTimes
+{
+  double received_at = 0.;     // time its access unit was complete, seconds since the epoch
+  double decode_time = 0.;     // seconds spent decoding and converting it
+  long access_unit_bytes = 0;
+};
+
+
+class StreamSession
+{
+  H264Decoder decoder;
+  OutputStage converter;
+  int fd;
+  int bound_port;
+  int frame_bytes;                         // size of an output frame, see frame_size()
+
+  std::vector<unsigned char> access_unit;  // being assembled, capacity fixed
+  ssize_t length = 0;                      // bytes of it received so far
+  std::vector<unsigned char> back;         // written by the thread, swapped with front when complete
+
+  mutable std::mutex mutex;                // guards everything below
+  bool waiting_for_keyframe = true;
+  double lost_at = 0.;                     // time of the loss waited on, 0 for the start of the stream
+  double started_at;                       // time the session was set up
+  std::condition_variable new_frame;
+  std::vector<unsigned char> front;        // most recent frame
+  long seq = 0;                            // its sequence number, 0 before the first one
+  int frame_w = 0, frame_h = 0, frame_linesize = 0;
+  FrameTimes frame_times;
+  StreamStats counters;
+  bool stopping = false;
+
+  std::thread thread;
+
+  void run();
+  /* Decode the first len bytes of access_unit, publish the frame if one comes out intact. */
+  void end_access_unit(ssize_t len);
+  /* Start waiting for a keyframe. Called with mutex held. */
+  void lost();
+
+public:
+  /* Bind a UDP socket to local_ip:port ("" for any address, port 0 for any port) and start the
+  thread. The output size, pixel format and scaling are those of OutputStage::set_output.
+  receive_buffer asks for that many bytes of kernel buffer, 0 keeps the default. */
+  StreamSession(const std::string &local_ip, int port, int width, int height, OutputFormat format,
+                Scaling scaling, int thread_count = 1, ThreadType thread_type = THREAD_DEFAULT,
+                int receive_buffer = 0);
+  ~StreamSession();
+  /* Stop the thread and close the socket. Later calls do nothing. */
+  void close();
+  /* Port the socket is bound to. */
+  int port() const;
+  /* Bytes an output frame takes, the least out_size latest_frame accepts. */
+  int frame_size() const;
+  /* Wait up to timeout seconds for a frame newer than after_seq and copy it into out.
+  Returns its sequence number and sets w, h, linesize and times, or returns 0 if none arrived
+  and -1 once the session is closed. Throws std::invalid_argument if out_size is too small. */
+  long latest_frame(unsigned char *out, ssize_t out_size, long after_seq, double timeout,
+                    int &w, int &h, int &linesize, FrameTimes &times);
+  /* Seconds since the loss the stream waits to recover from, or since the session was set up while
+  it waits for its first keyframe, at now (seconds since the epoch). A negative value while it is synced. */
+  double waiting(double now) const;
+  StreamStats stats() const;
+
+  StreamSession(const StreamSession &) = delete;
+  StreamSession operator=(const StreamSession &) = delete;
+};
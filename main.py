@@ -1,14 +1,31 @@
+import argparse
+
 import tello
 from tello_control_ui import TelloUI
+from tello_telemetry import TelemetryRecorder
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Tello perimeter sweep controller.')
+    parser.add_argument('--tello-ip', default='192.168.10.1', help='127.0.0.1 to fly tello_sim.py')
+    parser.add_argument('--local-port', type=int, default=8889,
+                        help='local command port, must differ from 8889 when the simulator runs on this machine')
+    parser.add_argument('--record', metavar='DIR', default=None,
+                        help='log commands, responses, frames and state to DIR, read back with tello_telemetry.load')
+    parser.add_argument('--record-video', metavar='DIR', default=None,
+                        help='record the raw h264 stream of the whole flight to DIR')
+    args = parser.parse_args()
 
-    drone = tello.Tello('', 8889)  
+    recorder = TelemetryRecorder(args.record) if args.record else None
+    drone = tello.Tello('', args.local_port, tello_ip=args.tello_ip, recorder=recorder)  
+    if args.record_video:
+        drone.start_recording(args.record_video)
     vplayer = TelloUI(drone,"./img/")
     
 	# start the Tkinter mainloop
     vplayer.root.mainloop() 
+    if recorder is not None:
+        recorder.close()
 
 if __name__ == "__main__":
     main()
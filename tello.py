@@ -1,14 +1,23 @@
+import collections
 import socket
 import threading
 import time
 import numpy as np
 import libh264decoder
+from tello_command import PendingCommands, ack_timeout
+from tello_state import StateReceiver
+from tello_video import (START_CODE, AccessUnitQueue, BatchReceiver, FramePool, FrameSlot, H264Recorder,
+                         KeyframeRequester, PacketRing, StreamResync, ring_slots, set_receive_buffer, yuv_planes)
 
 class Tello:
     """Wrapper class to interact with the Tello drone."""
 
     def __init__(self, local_ip, local_port, imperial=False, command_timeout=.3, tello_ip='192.168.10.1',
-                 tello_port=8889):
+                 tello_port=8889, video_queue_size=4, video_drop_policy=AccessUnitQueue.DROP_OLDEST,
+                 video_size=(960, 720), pixel_format=libh264decoder.RGB24, scaling=libh264decoder.BILINEAR,
+                 decoder_threads=1, decoder_thread_type=libh264decoder.THREAD_DEFAULT, local_video_port=11111,
+                 state_port=8890, recorder=None, keyframe_request_interval=1.0, video_receive_buffer=1024 * 1024,
+                 video_batch_size=32, native_video=False):
         """
         Binds to the local IP/port and puts the Tello into command mode.
 
@@ -19,26 +28,99 @@ class Tello:
         :param command_timeout (int|float): Number of seconds to wait for a response to a command.
         :param tello_ip (str): Tello IP.
         :param tello_port (int): Tello port.
+        :param video_queue_size (int): Number of received access units that may wait for the decoder.
+        :param video_drop_policy (str): AccessUnitQueue.DROP_OLDEST or AccessUnitQueue.DROP_NON_KEYFRAMES,
+                                        what to discard when the decoder falls behind.
+        :param video_size (tuple): (width, height) the decoder scales the video to, (960, 720) is the native size.
+        :param pixel_format: libh264decoder.RGB24, BGR24, GRAY8 or YUV420P -- layout of the frames returned by read().
+                             None skips color conversion and scaling altogether, frames are then (y, u, v)
+                             tuples of the decoder's planes at the native video size.
+        :param scaling: libh264decoder scaling algorithm used when video_size differs from the native size.
+        :param decoder_threads (int): Threads libavcodec decodes with, 0 for one per core.
+        :param decoder_thread_type: libh264decoder.THREAD_FRAME, THREAD_SLICE or THREAD_DEFAULT. Frame threading
+                                    delays every frame by one frame per extra thread, see benchmarks/decoder_threads.py.
+        :param local_video_port (int): Local port the video stream arrives on. The Tello streams to 11111 unless
+                                       told otherwise with the SDK 2.0 "port" command, see tello_fleet.py.
+        :param state_port (int): Local port the drone broadcasts its state string to, None to ignore the state.
+        :param recorder (tello_telemetry.TelemetryRecorder): Logs every command, response, frame and state
+                                                             for post-flight analysis, None not to.
+        :param keyframe_request_interval (float): After video data is lost, ask the drone for a keyframe
+                                                  at most this often (seconds), None never to ask.
+        :param video_receive_buffer (int): Bytes of kernel receive buffer requested for the video socket,
+                                           None to keep the system default. See benchmarks/video_recv.py.
+        :param video_batch_size (int): Most video datagrams taken from the socket per wakeup.
+        :param native_video (bool): Receive, decode and convert the video in a libh264decoder.StreamSession,
+                                    a C++ thread that never takes the GIL; Python only copies out the newest
+                                    frame. Needs a pixel_format, and the raw stream cannot be recorded.
         """
+        if native_video and pixel_format is None:
+            raise ValueError('native_video needs a pixel_format')
 
         self.abort_flag = False
-        self.decoder = libh264decoder.H264Decoder()
+        self.decoder = None  # the session decodes by itself with native_video
+        if not native_video:
+            self.decoder = libh264decoder.H264Decoder(decoder_threads, decoder_thread_type)
+            # size and pixel format are converted in the decoder's single sws_scale pass
+            if pixel_format is not None:
+                self.decoder.set_output(video_size[0], video_size[1], pixel_format, scaling)
+        self.pixel_format = pixel_format
         self.command_timeout = command_timeout
         self.imperial = imperial
         self.response = None  
-        self.frame = None  # numpy array BGR -- current camera output frame
+        self.pending_commands = PendingCommands()  # commands sent and not answered yet, oldest first
+        # held across registering and sending a command, so pending_commands keeps the order of the datagrams
+        self.send_lock = threading.RLock()
+        self.command_latencies = collections.deque(maxlen=1024)  # round-trip time of each answered command
+        self.recorder = recorder
+        self.move_speed = 10.0  # cm/s, slowest speed the Tello moves at -- bounds the wait for a move
+        self.yaw_rate = 30.0  # degree/s, bounds the wait for a rotation
+        # wall time spent waiting for acknowledgements versus the fixed delays callers asked for
+        self.command_stats = {'commands': 0, 'timeouts': 0, 'wall_time': 0.0, 'fixed_delay': 0.0, 'saved': 0.0}
+        self.frame = None  # numpy array in self.pixel_format -- current camera output frame
+        self.frame_slot = FrameSlot()  # self.frame with a sequence number consumers can wait on
         self.is_freeze = False  # freeze current camera output
         self.last_frame = None
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # socket for sending cmd
         self.socket_video = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # socket for receiving video stream
         self.tello_address = (tello_ip, tello_port)
-        self.local_video_port = 11111  # port for receiving video stream
+        self.local_video_port = local_video_port  # port for receiving video stream
+        self.video_size = tuple(video_size)  # width, height of the decoded video stream
+        # preallocated memory the video access units are assembled in, see ring_slots
+        self.packet_ring = PacketRing(slots=ring_slots(video_queue_size))
+        # after video data is lost, skips everything up to the next keyframe
+        self.resync = StreamResync()
+        self.ring_losses = 0  # access units the packet ring dropped so far, see _queue_access_unit
+
+        def on_drop(item, ring=self.packet_ring, resync=self.resync):
+            slot, access_unit = item[0], item[1]
+            # pictures predicted from a dropped reference picture cannot be decoded
+            if ring.is_reference(slot, len(access_unit)):
+                resync.lost('queue')
+            ring.release(slot)
+
+        # access units waiting for the decode worker
+        self.video_queue = AccessUnitQueue(video_queue_size, video_drop_policy, on_drop=on_drop)
+        # reusable buffers the decoded frames are written into, sized by the session with native_video
+        self.frame_pool = None
+        if pixel_format is None:
+            # planes keep the decoder's row padding, leave room for up to 64 bytes per row
+            self.frame_pool = FramePool((self.video_size[0] + 64) * self.video_size[1] * 2)
+        elif not native_video:
+            self.frame_pool = FramePool(self.decoder.predict_size(*self.video_size))
+        self.video_stats = {'frames': 0, 'decoded': 0, 'bytes_received': 0, 'bytes_copied': 0,
+                            'last_frame_bytes_copied': 0, 'fragments': 0}
+        self.video_recorder = None  # H264Recorder the raw stream is teed into, see start_recording
+        self.video_session = None  # libh264decoder.StreamSession doing all the video work with native_video
+        self.decode_times = collections.deque(maxlen=1024)  # seconds spent decoding each access unit
+        self.frame_latencies = collections.deque(maxlen=1024)  # seconds from last packet received to frame published
 
         self.height = 0
         self.manual = True
         self.manual_move = []
         self.move_back_to_perimeter_flag = False
         self.socket.bind((local_ip, local_port))
+        # what the drone itself reports: attitude, height, time of flight sensor, battery...
+        self.state_receiver = StateReceiver(local_ip, state_port, recorder=recorder) if state_port is not None else None
         self.distance = 2
         self.degree = 30
 
@@ -48,48 +130,147 @@ class Tello:
 
         self.receive_thread.start()
 
-        # to receive video -- send cmd: command, streamon
-        self.socket.sendto(b'command', self.tello_address)
-        print ('sent: command')
-        self.socket.sendto(b'streamon', self.tello_address)
-        print ('sent: streamon')
+        # listen for the video before it is turned on, the drone starts the stream with a keyframe
+        if native_video:
+            # the session owns the video socket, receives, decodes and converts without the GIL
+            self.video_session = libh264decoder.StreamSession(local_ip, self.local_video_port, video_size[0],
+                                                              video_size[1], pixel_format, scaling, decoder_threads,
+                                                              decoder_thread_type, video_receive_buffer or 0)
+            self.video_receive_buffer = None  # not known outside the session
+            self.frame_pool = FramePool(self.video_session.frame_size())
 
-        self.socket_video.bind((local_ip, self.local_video_port))
+            # thread copying the newest frame out of the session
+            self.native_video_thread = threading.Thread(target=self._native_video_thread)
+            self.native_video_thread.daemon = True
 
-        # thread for receiving video
-        self.receive_video_thread = threading.Thread(target=self._receive_video_thread)
-        self.receive_video_thread.daemon = True
+            self.native_video_thread.start()
+        else:
+            self.socket_video.bind((local_ip, self.local_video_port))
+            if video_receive_buffer is not None:
+                self.video_receive_buffer = set_receive_buffer(self.socket_video, video_receive_buffer)
+            else:
+                self.video_receive_buffer = self.socket_video.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            # pulls every queued datagram per wakeup, with one recvmmsg call where the extension has it
+            self.video_receiver = BatchReceiver(self.socket_video, video_batch_size, self.packet_ring.packet_size)
 
-        self.receive_video_thread.start()
-        self.send("Command", 3)
+            # thread for receiving video
+            self.receive_video_thread = threading.Thread(target=self._receive_video_thread)
+            self.receive_video_thread.daemon = True
 
-    # Send the preplanned route to Tello and allow for a delay in seconds
-    def send_preplanned_route(self, message, delay):
-        # Try to send the message otherwise print the exception
-        try:
-            self.socket.sendto(message.encode(), self.tello_address)
-            print("Sending message: " + message)
-        except Exception as e:
-            print("Error sending: " + str(e))
+            self.receive_video_thread.start()
+
+            # thread for decoding the received video
+            self.decode_video_thread = threading.Thread(target=self._decode_video_thread)
+            self.decode_video_thread.daemon = True
+
+            self.decode_video_thread.start()
+
+        # to receive video -- send cmd: command, streamon
+        # (through send, so their responses are consumed before the next command goes out)
+        self.send('command')
+        if self.local_video_port != 11111 or state_port not in (None, 8890):
+            # SDK 2.0: the drone streams to 8890/11111 unless told otherwise (state port, video port)
+            self.send('port %d %d' % (state_port or 8890, self.local_video_port))
+        self.send('streamon')
+
+        # thread asking for a keyframe while the video waits for one
+        # (the session tracks the stream itself, and answers waiting() like a StreamResync)
+        self.keyframe_requester = None
+        if keyframe_request_interval is not None:
+            resync = self.video_session if self.video_session is not None else self.resync
+            self.keyframe_requester = KeyframeRequester(resync, self._request_keyframe, keyframe_request_interval)
+            # "streamon" just asked for the first keyframe, ask again only if it does not come
+            self.keyframe_requester.sent()
+
+            self.keyframe_request_thread = threading.Thread(target=self._keyframe_request_thread)
+            self.keyframe_request_thread.daemon = True
+
+            self.keyframe_request_thread.start()
+        self.send("Command", 3)
 
-        # Delay for a user-defined period of time
-        time.sleep(delay)
+    # Send the preplanned route to Tello and wait for its response, see send
+    def send_preplanned_route(self, message, delay=None):
+        return self._send_and_wait(message, delay)
 
-    # Send the message to Tello and allow for a delay in seconds
-    def send(self, message, delay):
+    # Send the message to Tello and wait until it acknowledges the command.
+    # delay is the number of seconds the caller used to sleep after the command; it is only used
+    # to account for the time saved by returning on the acknowledgement, see command_stats.
+    # Returns the response, or None if none arrived before the timeout of the command.
+    def send(self, message, delay=None):
         if message.lower() == "land":
             self.height = 0
         elif message.lower() == "takeoff":
             self.height += 30
-        # Try to send the message otherwise print the exception
-        try:
-            self.socket.sendto(message.encode(), self.tello_address)
+        return self._send_and_wait(message, delay)
+
+    def send_async(self, message):
+        """
+        Send a command without waiting for its response.
+
+        Commands sent back to back are queued by the drone and answered in
+        order; the returned future resolves to this command's own response.
+
+        :param message (str): Command for the Tello.
+
+        :return: a tello_command.CommandFuture, call result(timeout) on it to get the response.
+        """
+        with self.send_lock:
+            future = self.pending_commands.add(message)
+            # Try to send the message otherwise print the exception
+            try:
+                self.socket.sendto(message.encode(), self.tello_address)
+            except Exception as e:
+                self.pending_commands.discard(future)
+                future.set_error(e)
+        if self.recorder is not None:
+            self.recorder.record_command(message)
+        if future.error is not None:
+            print("Error sending: " + str(future.error))
+        else:
             print("Sending message: " + message)
-        except Exception as e:
-            print("Error sending: " + str(e))
+        return future
+
+    def _send_and_wait(self, message, delay):
+        """
+        Send a command and block until its response arrives or it times out.
+
+        :param message (str): Command for the Tello.
+        :param delay (int|float): Fixed delay the caller budgeted for the command, or None.
+
+        :return: the response string, None on timeout or send error.
+        """
+        future = self.send_async(message)
+        if future.error is not None:
+            return None
+        response = future.result(self.ack_timeout(message))
+        elapsed = time.time() - future.sent_at
+
+        stats = self.command_stats
+        stats['commands'] += 1
+        stats['wall_time'] += elapsed
+        if delay is not None:
+            stats['fixed_delay'] += delay
+            stats['saved'] += max(0.0, delay - elapsed)
+        if response is None:
+            # a late response to it is dropped, not taken for the next command's
+            self.pending_commands.abandon(future)
+            if self.recorder is not None:
+                self.recorder.record_ack(message, None, None)
+            stats['timeouts'] += 1
+            print("No response to: " + message)
+            return None
+        print("Received message: %s (%.2f s)" % (response, future.rtt))
+        return response
+
+    def ack_timeout(self, message):
+        """
+        Longest time a command may take before its response is given up on, see tello_command.ack_timeout.
 
-        # Delay for a user-defined period of time
-        time.sleep(delay)
+        :param message (str): Command for the Tello.
+
+        :return: timeout in seconds.
+        """
+        return ack_timeout(message, self.command_timeout, self.move_speed, self.yaw_rate)
 
     # Receive the message from Tello
     def receive(self):
@@ -110,6 +291,8 @@ class Tello:
 
         self.socket.close()
         self.socket_video.close()
+        if self.video_session is not None:
+            self.video_session.close()
     
     def read(self):
         """Return the last frame from camera."""
@@ -118,6 +301,50 @@ class Tello:
         else:
             return self.frame
 
+    def read_next(self, seq, timeout=None):
+        """
+        Wait for a frame newer than the one with sequence number seq.
+
+        :param seq (int): Sequence number of the last frame the caller has seen, 0 for none.
+        :param timeout (float): Seconds to wait, or None to wait forever.
+
+        :return: (seq, frame) -- frame is None if no new frame arrived in time or the video is frozen.
+        """
+        seq, frame = self.frame_slot.wait_next(seq, timeout)
+        if self.is_freeze:
+            return seq, None
+        return seq, frame
+
+    def get_state(self):
+        """
+        Return the last state the drone broadcast, fields by name (e.g. state['h'] in cm, state['bat'] in %),
+        see tello_state.STATE_FIELDS. None before the first state packet or when the state is ignored.
+        """
+        if self.state_receiver is None:
+            return None
+        return self.state_receiver.latest()
+
+    def start_recording(self, directory, **kwargs):
+        """
+        Record the raw h264 stream to directory, starting at the next keyframe.
+
+        :param directory (str): Directory the .h264 files go to.
+        :param kwargs: Passed to H264Recorder, e.g. max_bytes or max_seconds for file rotation.
+
+        :return: the H264Recorder.
+        """
+        if self.video_session is not None:
+            raise ValueError('the raw stream cannot be recorded with native_video')
+        self.stop_recording()
+        self.video_recorder = H264Recorder(directory, **kwargs)
+        return self.video_recorder
+
+    def stop_recording(self):
+        """Finish the recording started by start_recording, if any."""
+        recorder, self.video_recorder = self.video_recorder, None
+        if recorder is not None:
+            recorder.close()
+
     def video_freeze(self, is_freeze=True):
         """Pause video output -- set is_freeze to True"""
         self.is_freeze = is_freeze
@@ -127,13 +354,19 @@ class Tello:
     def _receive_thread(self):
         """Listen to responses from the Tello.
 
-        Runs as a thread, sets self.response to whatever the Tello last returned.
+        Runs as a thread, sets self.response to whatever the Tello last returned
+        and resolves the future of the oldest command still waiting for a response.
 
         """
         while True:
             try:
                 self.response, ip = self.socket.recvfrom(3000)
                 #print(self.response)
+                future = self.pending_commands.resolve(self.response.decode('utf-8', 'replace').strip())
+                if future is not None:
+                    self.command_latencies.append(future.rtt)
+                    if self.recorder is not None:
+                        self.recorder.record_ack(future.message, future.response, future.rtt)
             except socket.error as exc:
                 print ("Caught exception socket.error : %s" % exc)
 
@@ -141,45 +374,235 @@ class Tello:
         """
         Listens for video streaming (raw h264) from the Tello.
 
-        Runs as a thread, sets self.frame to the most recent frame Tello captured.
+        Runs as a thread, hands every complete access unit to the decode worker
+        through self.video_queue. It never decodes itself, so a slow decode
+        cannot back up the socket.
 
         """
-        packet_data = ""
+        ring = self.packet_ring
+        receiver = self.video_receiver
+        carried = 0  # bytes of the access unit being assembled that were moved over from the previous slot
         while True:
             try:
-                res_string, ip = self.socket_video.recvfrom(2048)
-                packet_data += res_string
-                # end of frame
-                if len(res_string) != 1460:
-                    for frame in self._h264_decode(packet_data):
-                        self.frame = frame
-                    packet_data = ""
+                for nbytes in receiver.receive_into(ring):
+                    self.video_stats['bytes_received'] += nbytes
+                    if receiver.native:
+                        # recvmmsg filled the batch buffer, the datagram was copied from there
+                        self.video_stats['bytes_copied'] += nbytes
+                    # a new access unit starting inside the slot completes the previous one, even when
+                    # all its datagrams were full size and the short datagram rule below cannot see its end
+                    boundary = ring.scan()
+                    if boundary:
+                        moved = ring.bytes_moved
+                        slot, access_unit = ring.commit(boundary)
+                        self._queue_access_unit(slot, access_unit, carried)
+                        # the start of the next access unit is copied to its own slot
+                        carried = ring.bytes_moved - moved
+                        self.video_stats['bytes_copied'] += carried
+                    # end of frame
+                    if nbytes != 1460:
+                        slot, access_unit = ring.commit()
+                        self._queue_access_unit(slot, access_unit, carried)
+                        carried = 0
 
             except socket.error as exc:
                 print ("Caught exception socket.error : %s" % exc)
-    
+
+    def _queue_access_unit(self, slot, access_unit, copied):
+        """
+        Hand an access unit committed in self.packet_ring to the recorder and the decode worker.
+
+        :param copied (int): Bytes of it that had to be moved between slots.
+        """
+        ring = self.packet_ring
+        ring_losses = ring.overflows + ring.stalls
+        if ring_losses != self.ring_losses:
+            self.ring_losses = ring_losses
+            self.resync.lost('ring')
+        if access_unit is None:
+            return
+        start = slot * ring.slot_size
+        if ring.buffer.find(START_CODE, start, start + 4) < 0:
+            # the tail of an access unit whose start was lost, e.g. to reordering -- it cannot be decoded
+            self.video_stats['fragments'] += 1
+            self.resync.lost('fragment')
+            ring.release(slot)
+            return
+        self.video_stats['frames'] += 1
+        if self.video_receiver.native:
+            # recvmmsg received it into the batch buffer, every byte was copied into the ring once more
+            copied += len(access_unit)
+        self.video_stats['last_frame_bytes_copied'] = copied
+        keyframe = ring.is_keyframe(slot, len(access_unit))
+        # tee the undecoded stream to disk, a buffered copy and nothing more
+        recorder = self.video_recorder
+        if recorder is not None:
+            recorder.write(access_unit, keyframe)
+        self.video_queue.put((slot, access_unit, time.time(), keyframe), keyframe)
+
+    def _decode_video_thread(self):
+        """
+        Decodes the access units queued by _receive_video_thread.
+
+        Runs as a thread, sets self.frame to the most recent frame Tello captured
+        and publishes it to self.frame_slot. After video data was lost, access
+        units are skipped up to the next keyframe, see self.resync.
+
+        """
+        while True:
+            item = self.video_queue.get()
+            if item is None:
+                continue
+            slot, access_unit, received_at, keyframe = item
+            try:
+                action = self.resync.admit(keyframe)
+                if action == StreamResync.DROP:
+                    continue
+                if action == StreamResync.RESYNC:
+                    # forget the pictures decoded before the loss
+                    self.decoder.flush()
+                errors = self.decoder.error_counts()
+                # the decoder reads the access unit straight out of the ring
+                start = time.time()
+                frames = self._h264_decode(access_unit)
+                decode_time = time.time() - start
+                self.decode_times.append(decode_time)
+                if self.decoder.error_counts() != errors:
+                    # damaged data the decoder rejected or concealed, do not show it
+                    self.resync.lost('decode')
+                    continue
+                for frame in frames:
+                    self.video_stats['decoded'] += 1
+                    self.frame = frame
+                    self.frame_slot.publish(frame)
+                    published_at = time.time()
+                    self.frame_latencies.append(published_at - received_at)
+                    if self.recorder is not None:
+                        self.recorder.record_frame(received_at, published_at, decode_time, len(access_unit))
+                if frames:
+                    self.resync.decoded()
+            except Exception as exc:
+                # e.g. ValueError from a frame larger than the pool's buffers -- keep the video running
+                print("Error decoding video: %s" % exc)
+                self.resync.lost('decode')
+            finally:
+                self.packet_ring.release(slot)
+
+    def _native_video_thread(self):
+        """
+        Copies the newest frame out of self.video_session.
+
+        Runs as a thread, sets self.frame and publishes it to self.frame_slot.
+        Frames the session decoded while this thread was busy are skipped,
+        never queued, so Python cannot hold the video back. Returns once the
+        session is closed.
+
+        """
+        seq = 0
+        while True:
+            buf = self.frame_pool.acquire()
+            newest, w, h, ls, received_at, decode_time, nbytes = self.video_session.latest_frame(buf, seq, 1.0)
+            if newest <= 0:
+                self.frame_pool.release(buf)
+                if newest < 0:
+                    return
+                continue
+            seq = newest
+            frame = self.frame_from_buffer(buf, w, h, ls, self.pixel_format)
+            self.video_stats['decoded'] += 1
+            self.frame = frame
+            self.frame_slot.publish(frame)
+            published_at = time.time()
+            # only frames that were published, the session counts every decode in its stats
+            self.decode_times.append(decode_time)
+            self.frame_latencies.append(published_at - received_at)
+            if self.recorder is not None:
+                self.recorder.record_frame(received_at, published_at, decode_time, nbytes)
+
+    def _keyframe_request_thread(self):
+        """
+        Polls self.keyframe_requester, which asks for a keyframe when video data was lost
+        and none arrived after a short grace period.
+
+        """
+        while True:
+            time.sleep(self.keyframe_requester.grace / 2)
+            self.keyframe_requester.poll()
+
+    def _request_keyframe(self):
+        """
+        Send "streamon" again, the drone answers it with a keyframe.
+
+        Only while no other command waits for its response: one queued behind a
+        long manoeuvre would come too late to help.
+
+        :return: False if the request was not sent.
+        """
+        # checked and sent under one lock, so no command can slip in between; not a command of
+        # the caller's, so it stays out of command_stats
+        with self.send_lock:
+            if len(self.pending_commands):
+                return False
+            future = self.send_async('streamon')
+        if future.error is not None:
+            return False
+        if future.result(self.ack_timeout('streamon')) is None:
+            # its late response must not be taken for the next command's
+            self.pending_commands.abandon(future)
+        return True
+
     def _h264_decode(self, packet_data):
         """
         decode raw h264 format data from Tello
         
-        :param packet_data: raw h264 data array
+        :param packet_data: raw h264 data, any object supporting the buffer protocol
        
         :return: a list of decoded frame
         """
         res_frame_list = []
-        frames = self.decoder.decode(packet_data)
-        for framedata in frames:
-            (frame, w, h, ls) = framedata
-            if frame is not None:
-                # print 'frame size %i bytes, w %i, h %i, linesize %i' % (len(frame), w, h, ls)
-
-                frame = np.fromstring(frame, dtype=np.ubyte, count=len(frame), sep='')
-                frame = (frame.reshape((h, ls / 3, 3)))
-                frame = frame[:, :w, :]
-                res_frame_list.append(frame)
+        # the decoder converts straight into a pooled buffer, so each frame is written exactly once.
+        # The buffer goes back to the pool once the returned frame is no longer referenced.
+        buf = self.frame_pool.acquire()
+        try:
+            if self.pixel_format is None:
+                (count, w, h, ls) = self.decoder.decode_planes_into(packet_data, buf)
+            else:
+                (count, w, h, ls) = self.decoder.decode_into(packet_data, buf)
+        except Exception:
+            self.frame_pool.release(buf)
+            raise
+        if count:
+            res_frame_list.append(self.frame_from_buffer(buf, w, h, ls, self.pixel_format))
+        else:
+            self.frame_pool.release(buf)
 
         return res_frame_list
 
+    @staticmethod
+    def frame_from_buffer(buf, w, h, ls, pixel_format):
+        """
+        View a buffer filled by decode_into/decode_planes_into as a frame, without copying.
+
+        :param buf (numpy.ndarray): The flat uint8 buffer the decoder wrote into.
+        :param w (int): Frame width returned by the decoder.
+        :param h (int): Frame height returned by the decoder.
+        :param ls: Linesize returned by the decoder, a (y, u, v) tuple for decode_planes_into.
+        :param pixel_format: The decoder's output format, None for decode_planes_into.
+
+        :return: numpy array of the frame, (y, u, v) arrays when pixel_format is None.
+        """
+        if pixel_format is None:
+            # (y, u, v) views straight on the decoder's planes, no conversion at all
+            return yuv_planes(buf, w, h, ls)
+        if pixel_format == libh264decoder.GRAY8:
+            frame = buf[:h * ls].reshape((h, ls))
+            return frame[:, :w]
+        if pixel_format == libh264decoder.YUV420P:
+            # I420 planes one after another, the layout cv2.COLOR_YUV2*_I420 expects
+            return buf[:w * h * 3 // 2].reshape((h * 3 // 2, w))
+        frame = buf[:h * ls].reshape((h, ls // 3, 3))
+        return frame[:, :w, :]
+
     def takeoff(self):
         if self.height != 0:
             print("Drone already took off!")
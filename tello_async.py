@@ -0,0 +1,341 @@
+"""
+asyncio client for the Tello, next to the threaded tello.Tello.
+
+Commands, state and video each run on an asyncio datagram endpoint, so a
+single event loop can drive many drones without a thread per socket and
+without sleeps blocking the loop:
+
+    async with AsyncTello(local_port=9000) as drone:
+        await drone.takeoff()
+        await drone.forward(50)
+        async for frame in drone.frames():
+            ...
+
+Responses are matched to commands in the order the drone answers them, as in
+tello_command, so commands may also be pipelined with send_nowait(). Decoding
+runs in a single worker thread through run_in_executor, the libh264decoder
+object is not safe to share between threads.
+
+Requires Python 3.6 or later (async generators), and libh264decoder built
+for that Python: cmake -DPYTHON_VERSION=3.8 .. (see h264decoder/readme.md).
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+
+import libh264decoder
+from tello import Tello
+from tello_command import PendingCommands, ack_timeout
+from tello_state import StateRing
+from tello_video import FramePool, PacketRing, ring_slots
+
+TELLO_PACKET_SIZE = 1460  # a shorter datagram ends the access unit
+
+
+class _Endpoint(asyncio.DatagramProtocol):
+    """Datagram protocol forwarding every datagram to a callback."""
+
+    def __init__(self, name, callback):
+        self.name = name
+        self.callback = callback
+
+    def datagram_received(self, data, addr):
+        self.callback(data, addr)
+
+    def error_received(self, exc):
+        print('%s socket error: %s' % (self.name, exc))
+
+
+class AsyncTello(object):
+    """Tello client driven by an asyncio event loop."""
+
+    def __init__(self, local_ip='0.0.0.0', local_port=9000, tello_ip='192.168.10.1', tello_port=8889,
+                 video_port=11111, state_port=8890, command_timeout=.3, video=True, video_queue_size=4,
+                 video_size=(960, 720), pixel_format=libh264decoder.RGB24, scaling=libh264decoder.BILINEAR):
+        """
+        Nothing is bound until connect() (or entering the async with block).
+
+        :param local_ip (str): Local IP address to bind, '' or '0.0.0.0' for every interface.
+        :param local_port (int): Local port the commands are sent from.
+        :param tello_ip (str): Tello IP.
+        :param tello_port (int): Tello port.
+        :param video_port (int): Local port the video stream arrives on.
+        :param state_port (int): Local port the state string arrives on, None to ignore the state.
+        :param command_timeout (float): Seconds to wait for the response to a command that does not move the drone.
+        :param video (bool): Turn the video stream on and decode it.
+        :param video_queue_size (int): Access units that may wait for the decoder before the oldest is dropped.
+        :param video_size (tuple): (width, height) the decoder scales the video to.
+        :param pixel_format: libh264decoder.RGB24, BGR24, GRAY8 or YUV420P, None for (y, u, v) planes.
+        :param scaling: libh264decoder scaling algorithm used when video_size differs from the native size.
+        """
+        # asyncio resolves the address to bind, it does not take '' for any address like socket.bind
+        self.local_address = (local_ip or '0.0.0.0', local_port)
+        self.tello_address = (tello_ip, tello_port)
+        self.video_port = video_port
+        self.state_port = state_port
+        self.command_timeout = command_timeout
+        self.move_speed = 10.0  # cm/s, bounds the wait for a move, see tello_command.ack_timeout
+        self.yaw_rate = 30.0  # degree/s, bounds the wait for a rotation
+        self.video = video
+        self.video_size = tuple(video_size)
+        self.pixel_format = pixel_format
+        self.scaling = scaling
+        self.video_queue_size = video_queue_size
+
+        # commands sent and not answered yet, oldest first; only touched on the event loop thread
+        self.pending_commands = PendingCommands()
+        self.command_latencies = collections.deque(maxlen=1024)
+        self.state_ring = StateRing()  # every state string received, see tello_state
+        self.frame = None
+        self.frame_seq = 0
+        self.video_stats = {'frames': 0, 'decoded': 0, 'dropped': 0}
+
+        self.loop = None
+        self.transports = []
+        self.command_transport = None
+        self.packet_ring = None
+        self.video_queue = None
+        self.frame_cond = None
+        self.decode_task = None
+        self.executor = None
+        self.decoder = None
+        self.frame_pool = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def connect(self):
+        """Bind the endpoints, put the drone in command mode and start the video stream if wanted."""
+        self.loop = asyncio.get_event_loop()
+        self.command_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _Endpoint('command', self._on_response), local_addr=self.local_address)
+        self.transports.append(self.command_transport)
+        if self.state_port is not None:
+            transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: _Endpoint('state', self._on_state), local_addr=(self.local_address[0], self.state_port))
+            self.transports.append(transport)
+
+        await self.send('command')
+        if self.video:
+            self._start_video()
+            transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: _Endpoint('video', self._on_video), local_addr=(self.local_address[0], self.video_port))
+            self.transports.append(transport)
+            await self.send('streamon')
+
+    async def close(self):
+        """Stop decoding and close every endpoint."""
+        if self.decode_task is not None:
+            self.decode_task.cancel()
+            try:
+                await self.decode_task
+            except asyncio.CancelledError:
+                pass
+            self.decode_task = None
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        for command in list(self.pending_commands.futures):
+            self.pending_commands.discard(command)
+            command.set_error(asyncio.CancelledError())
+
+    # commands
+
+    def send_nowait(self, message):
+        """
+        Send a command without waiting for its response.
+
+        :param message (str): Command for the Tello.
+
+        :return: an asyncio.Future resolving to the response string.
+        """
+        return self._send(message)[1]
+
+    def _send(self, message):
+        """
+        :return: (tello_command.CommandFuture, asyncio.Future) of the command.
+        """
+        command = self.pending_commands.add(message)
+        waiter = self.loop.create_future()
+
+        def wake(command):
+            # completed on the event loop thread, by _on_response or close
+            if waiter.done():
+                return
+            if command.error is not None:
+                waiter.cancel()
+            else:
+                waiter.set_result(command.response)
+
+        command.add_done_callback(wake)
+        self.command_transport.sendto(message.encode(), self.tello_address)
+        return command, waiter
+
+    async def send(self, message, timeout=None):
+        """
+        Send a command and wait for its response.
+
+        :param message (str): Command for the Tello.
+        :param timeout (float): Seconds to wait, None derives it from the command, see tello_command.ack_timeout.
+
+        :return: the response string, None if it did not arrive in time.
+        """
+        command, waiter = self._send(message)
+        if timeout is None:
+            timeout = ack_timeout(message, self.command_timeout, self.move_speed, self.yaw_rate)
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            # the drone may still answer, that late response must not be taken for the next command's
+            self.pending_commands.abandon(command)
+            waiter.cancel()
+            print('No response to: ' + message)
+            return None
+
+    def _on_response(self, data, addr):
+        command = self.pending_commands.resolve(data.decode('utf-8', 'replace').strip())
+        if command is not None:
+            self.command_latencies.append(command.rtt)
+
+    async def takeoff(self):
+        return await self.send('takeoff')
+
+    async def land(self):
+        return await self.send('land')
+
+    async def stop(self):
+        return await self.send('stop')
+
+    async def up(self, distance):
+        return await self.send('up %d' % distance)
+
+    async def down(self, distance):
+        return await self.send('down %d' % distance)
+
+    async def left(self, distance):
+        return await self.send('left %d' % distance)
+
+    async def right(self, distance):
+        return await self.send('right %d' % distance)
+
+    async def forward(self, distance):
+        return await self.send('forward %d' % distance)
+
+    async def back(self, distance):
+        return await self.send('back %d' % distance)
+
+    async def cw(self, degree):
+        return await self.send('cw %d' % degree)
+
+    async def ccw(self, degree):
+        return await self.send('ccw %d' % degree)
+
+    # state
+
+    @property
+    def state(self):
+        """The last state the drone broadcast, fields by name (e.g. state['h']), None before the first one."""
+        return self.state_ring.latest()
+
+    def _on_state(self, data, addr):
+        self.state_ring.feed(data)
+
+    # video
+
+    def _start_video(self):
+        self.decoder = libh264decoder.H264Decoder()
+        if self.pixel_format is not None:
+            self.decoder.set_output(self.video_size[0], self.video_size[1], self.pixel_format, self.scaling)
+            self.frame_pool = FramePool(self.decoder.predict_size(*self.video_size))
+        else:
+            self.frame_pool = FramePool((self.video_size[0] + 64) * self.video_size[1] * 2)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # access units are assembled in place, the decoder reads them straight out of the ring
+        self.packet_ring = PacketRing(slots=ring_slots(self.video_queue_size))
+        self.video_queue = asyncio.Queue(self.video_queue_size)
+        self.frame_cond = asyncio.Condition()
+        self.decode_task = self.loop.create_task(self._decode_loop())
+
+    def _on_video(self, data, addr):
+        ring = self.packet_ring
+        nbytes = ring.write(data)
+        # same access unit boundaries as tello.Tello._receive_video_thread
+        boundary = ring.scan()
+        if boundary:
+            self._queue_access_unit(*ring.commit(boundary))
+        if nbytes != TELLO_PACKET_SIZE:
+            self._queue_access_unit(*ring.commit())
+
+    def _queue_access_unit(self, slot, access_unit):
+        if access_unit is None:
+            return
+        self.video_stats['frames'] += 1
+        if self.video_queue.full():
+            # the decoder fell behind, drop the oldest access unit like tello.Tello does
+            dropped_slot, _ = self.video_queue.get_nowait()
+            self.packet_ring.release(dropped_slot)
+            self.video_stats['dropped'] += 1
+        self.video_queue.put_nowait((slot, access_unit))
+
+    def _decode(self, access_unit):
+        """Decode one access unit, runs in the executor thread."""
+        buf = self.frame_pool.acquire()
+        try:
+            if self.pixel_format is None:
+                count, w, h, ls = self.decoder.decode_planes_into(access_unit, buf)
+            else:
+                count, w, h, ls = self.decoder.decode_into(access_unit, buf)
+            if not count:
+                self.frame_pool.release(buf)
+                return None
+            return Tello.frame_from_buffer(buf, w, h, ls, self.pixel_format)
+        except Exception:
+            self.frame_pool.release(buf)
+            raise
+
+    async def _decode_loop(self):
+        while True:
+            slot, access_unit = await self.video_queue.get()
+            try:
+                frame = await self.loop.run_in_executor(self.executor, self._decode, access_unit)
+            except Exception as exc:
+                # like tello.Tello, one bad access unit must not stop the video
+                print('Error decoding video: %s' % exc)
+                continue
+            finally:
+                # the ring is only touched on the event loop thread
+                self.packet_ring.release(slot)
+            if frame is None:
+                continue
+            self.video_stats['decoded'] += 1
+            async with self.frame_cond:
+                self.frame = frame
+                self.frame_seq += 1
+                self.frame_cond.notify_all()
+
+    async def next_frame(self, seq=0):
+        """
+        Wait for a frame newer than the one with sequence number seq.
+
+        :param seq (int): Sequence number of the last frame the caller has seen, 0 for none.
+
+        :return: (seq, frame) of the newest frame.
+        """
+        async with self.frame_cond:
+            await self.frame_cond.wait_for(lambda: self.frame_seq > seq)
+            return self.frame_seq, self.frame
+
+    async def frames(self):
+        """Async iterator over decoded frames; a slow consumer skips to the newest frame."""
+        seq = 0
+        while True:
+            seq, frame = await self.next_frame(seq)
+            yield frame
@@ -0,0 +1,214 @@
+"""
+Matching of Tello command responses to the commands they answer.
+
+The drone executes commands one after another and answers each of them on
+the command socket, in order. Every command that goes out registers a
+CommandFuture at the tail of a PendingCommands FIFO and every response that
+comes in resolves the oldest one, so callers can send several commands
+without waiting and still get exactly their own response, together with its
+round-trip time.
+
+A command that timed out keeps its place in the FIFO for a while: the drone
+may still answer it, and that late response must be dropped rather than
+taken for the response of the command after it.
+"""
+
+import collections
+import threading
+import time
+
+MOVES = ('up', 'down', 'left', 'right', 'forward', 'back')
+ROTATIONS = ('cw', 'ccw')
+LATE_RESPONSE_WINDOW = 5.0  # seconds after its timeout a command's response is still expected
+
+
+def ack_timeout(message, command_timeout, move_speed, yaw_rate):
+    """
+    Longest time a command may take before its response is given up on.
+
+    Manoeuvres take the time the drone needs to fly them, derived from the
+    distance or angle and the assumed speeds, plus a safety margin.
+
+    :param message (str): Command for the Tello.
+    :param command_timeout (float): Seconds allowed for a command that does not move the drone.
+    :param move_speed (float): Slowest speed the drone moves at, in cm/s.
+    :param yaw_rate (float): Slowest rotation speed, in degree/s.
+
+    :return: timeout in seconds.
+    """
+    parts = message.lower().split()
+    name = parts[0] if parts else ''
+    if name in ('takeoff', 'land'):
+        return command_timeout + 20.0
+    try:
+        amount = abs(float(parts[1]))
+    except (IndexError, ValueError):
+        return command_timeout
+    if name in MOVES:
+        return command_timeout + 2.0 + amount / move_speed
+    if name in ROTATIONS:
+        return command_timeout + 2.0 + amount / yaw_rate
+    return command_timeout
+
+
+class CommandFuture(object):
+    """Response to one command, filled in by the receive thread when it arrives."""
+
+    def __init__(self, message, sent_at=None):
+        """
+        :param message (str): The command that was sent.
+        :param sent_at (float): When it was sent, time.time() by default.
+        """
+        self.message = message
+        self.sent_at = sent_at if sent_at is not None else time.time()
+        self.received_at = None
+        self.response = None
+        self.error = None  # exception raised while sending, if any
+        self.event = threading.Event()
+        self.expires_at = None  # set when it timed out, see PendingCommands.abandon
+        # a response was dropped as the late one of an earlier command while this one waited,
+        # it may have been this command's own
+        self.maybe_answered = False
+        self.callbacks = []
+
+    def done(self):
+        """Return True once the response arrived or sending failed."""
+        return self.event.is_set()
+
+    def set_result(self, response, received_at=None):
+        """Store the response and wake whoever waits for it."""
+        self.response = response
+        self.received_at = received_at if received_at is not None else time.time()
+        self.event.set()
+        for callback in self.callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(future) once the response arrived or sending failed, from the thread that
+        completes the future, e.g. to wake an asyncio waiter. A timeout does not complete it.
+        """
+        self.callbacks.append(callback)
+
+    def set_error(self, error):
+        """Mark the command as failed, e.g. when the datagram could not be sent."""
+        self.error = error
+        self.event.set()
+        for callback in self.callbacks:
+            callback(self)
+
+    def result(self, timeout=None):
+        """
+        Wait for the response.
+
+        :param timeout (float): Seconds to wait, or None to wait forever.
+
+        :return: the response string, or None if it did not arrive in time or sending failed.
+        """
+        if not self.event.wait(timeout) or self.error is not None:
+            return None
+        return self.response
+
+    @property
+    def rtt(self):
+        """Seconds from sending the command to receiving its response, None while pending."""
+        if self.received_at is None:
+            return None
+        return self.received_at - self.sent_at
+
+
+class PendingCommands(object):
+    """FIFO of the commands still waiting for their response."""
+
+    def __init__(self, late_window=LATE_RESPONSE_WINDOW):
+        """
+        :param late_window (float): Seconds after its timeout a command's response is still dropped
+                                    as late, see abandon().
+        """
+        self.lock = threading.Lock()
+        self.futures = collections.deque()  # waiting and timed-out commands, oldest first
+        self.late_window = late_window
+        self.unmatched = 0  # responses that arrived while no command was pending
+        self.late = 0  # responses to commands that had already timed out, dropped
+
+    def add(self, message, now=None):
+        """
+        Register a command about to be sent.
+
+        Register before sending, so a fast response cannot arrive ahead of its future. Callers
+        sending from several threads have to add and send under one lock, so the FIFO keeps the
+        order of the datagrams.
+
+        :param message (str): The command.
+        :param now (float): Time it is sent at, time.time() by default.
+
+        :return: its CommandFuture.
+        """
+        future = CommandFuture(message, now)
+        with self.lock:
+            self.futures.append(future)
+        return future
+
+    def resolve(self, response, now=None):
+        """
+        Hand a response to the oldest pending command.
+
+        :param response (str): The decoded response.
+        :param now (float): Time it arrived, time.time() by default.
+
+        :return: the resolved CommandFuture, or None if nothing was pending or the response
+                 belonged to a command that had timed out.
+        """
+        received_at = now if now is not None else time.time()
+        with self.lock:
+            futures = self.futures
+            while futures and futures[0].expires_at is not None and futures[0].expires_at <= received_at:
+                # no response came for it after all
+                futures.popleft()
+            if not futures:
+                self.unmatched += 1
+                return None
+            future = futures.popleft()
+            if future.expires_at is not None:
+                self.late += 1
+                if futures:
+                    futures[0].maybe_answered = True
+                return None
+        future.set_result(response, received_at)
+        return future
+
+    def discard(self, future):
+        """
+        Stop waiting for a command that will never be answered, e.g. because it failed to send.
+
+        It must leave the FIFO, otherwise every later response would be
+        attributed to the command before it.
+        """
+        with self.lock:
+            try:
+                self.futures.remove(future)
+            except ValueError:
+                pass
+
+    def abandon(self, future, now=None):
+        """
+        Stop waiting for a command that timed out.
+
+        The drone may still answer it, so it stays in the FIFO for late_window
+        seconds and a response reaching it there is dropped. If a response
+        was already dropped as a late one while this command waited, that
+        response was probably this command's own, and it leaves the FIFO at
+        once; otherwise one lost response would shift every later one.
+        """
+        with self.lock:
+            if future not in self.futures:
+                return
+            if future.maybe_answered or self.late_window <= 0:
+                self.futures.remove(future)
+            else:
+                future.expires_at = (now if now is not None else time.time()) + self.late_window
+
+    def __len__(self):
+        """Number of commands still waiting for their response, the timed-out ones not counted."""
+        with self.lock:
+            return sum(1 for future in self.futures if future.expires_at is None)
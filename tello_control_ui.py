@@ -2,24 +2,28 @@ from PIL import Image
 from PIL import ImageTk
 import Tkinter as tki
 from Tkinter import Toplevel, Scale
+import tkMessageBox
 import threading
-import datetime
 import cv2
-import os
+import libh264decoder
+import numpy as np
 import time
 import platform
 
 from Perimeter_Sweep import AutoRoute
+from tello_snapshot import SnapshotWriter
 
 
 class TelloUI:
     """Wrapper class to enable the GUI."""
 
-    def __init__(self,tello,outputpath):
+    def __init__(self,tello,outputpath,preview_size=None):
         """
         Initial all the element of the GUI,support by Tkinter
 
         :param tello: class interacts with the Tello drone.
+        :param outputpath: the path that save pictures created by clicking the takeSnapshot button
+        :param preview_size: (width, height) the video is shown at, None for the size of the video stream.
 
         Raises:
             RuntimeError: If the Tello rejects the attempt to enter command mode.
@@ -30,6 +34,17 @@ class TelloUI:
         self.frame = None  # frame read from h264decoder and used for pose recognition 
         self.thread = None # thread of the Tkinter mainloop
         self.stopEvent = None
+        self.system = platform.system()  # decides how the GUI image is updated, see videoLoop
+        self.fps_report_interval = 5.0  # seconds between display/received fps reports
+        self.display_fps = 0.0  # frames drawn per second
+        self.received_fps = 0.0  # frames delivered by the decoder per second
+        self.preview_size = preview_size  # (width, height) of the video panel, None for full size
+        self.preview = None  # reusable buffer the frame is downscaled into
+        self.photo = None  # Tk image shown by the panel, updated in place for every frame
+        # JPEG encoding runs on worker threads, the button callback only copies the frame
+        self.snapshots = SnapshotWriter(self.tello.frame_slot, self.outputPath, convert=self._toBGR)
+        self.burst_count = 10  # snapshots taken by the Burst button
+        self.burst_interval = 0.2  # seconds between them
 
         # control variables
         self.distance = self.tello.distance  # default distance for 'move' cmd
@@ -52,6 +67,14 @@ class TelloUI:
         self.btn_snapshot.pack(side="bottom", fill="both",
                                expand="yes", padx=10, pady=5)
 
+        self.btn_burst = tki.Button(self.root, text="Burst Snapshot", command=self.takeBurst)
+        self.btn_burst.pack(side="bottom", fill="both",
+                            expand="yes", padx=10, pady=5)
+
+        self.btn_record = tki.Button(self.root, text="Record Video", relief="raised", command=self.recordVideo)
+        self.btn_record.pack(side="bottom", fill="both",
+                             expand="yes", padx=10, pady=5)
+
         self.btn_pause = tki.Button(self.root, text="Pause Video", relief="raised", command=self.pauseVideo)
         self.btn_pause.pack(side="bottom", fill="both",
                             expand="yes", padx=10, pady=5)
@@ -65,6 +88,12 @@ class TelloUI:
             self.root, text="Restart Preplanned Route", relief="raised", command=self.restart)
         self.btn_restart.pack(side="bottom", fill="both",
                               expand="yes", padx=10, pady=5)
+
+        # what the drone reports about itself, refreshed from the Tk mainloop
+        self.state_interval_ms = 500
+        self.state_label = tki.Label(self.root, text="Waiting for drone state...", justify="left")
+        self.state_label.pack(side="bottom", fill="both", padx=10, pady=5)
+        self.root.after(self.state_interval_ms, self._updateStateLabel)
         
         # start a thread that constantly pools the video sensor for
         # the most recently read frame
@@ -92,45 +121,119 @@ class TelloUI:
         try:
             # start the thread that get GUI image and drwa skeleton 
             time.sleep(0.5)
+            seq = 0
+            displayed = 0
+            fps_start = time.time()
+            fps_start_seq = self.tello.frame_slot.seq
             while not self.stopEvent.is_set():
-                system = platform.system()
 
-            # read the frame for GUI show
-                self.frame = self.tello.read()
-                if self.frame is None or self.frame.size == 0:
-                    continue 
-            
+            # block until the decoder publishes a frame we have not shown yet
+                seq, frame = self.tello.read_next(seq, timeout=0.5)
+                if frame is None:
+                    continue
+                self.frame = frame
+
             # transfer the format from frame to image         
-                image = Image.fromarray(self.frame)
+                image = Image.fromarray(self._scaleToPreview(self._toRGB(self.frame)))
 
             # we found compatibility problem between Tkinter,PIL and Macos,and it will 
             # sometimes result the very long preriod of the "ImageTk.PhotoImage" function,
             # so for Macos,we start a new thread to execute the _updateGUIImage function.
-                if system =="Windows" or system =="Linux":                
+                if self.system =="Windows" or self.system =="Linux":                
                     self._updateGUIImage(image)
 
                 else:
-                    thread_tmp = threading.Thread(target=self._updateGUIImage,args=(image,))
+                    # the image may share its pixels with self.preview or the decoder's pooled frame, both
+                    # overwritten by the next frame while the thread still shows this one -- give it a copy
+                    thread_tmp = threading.Thread(target=self._updateGUIImage,args=(image.copy(),))
                     thread_tmp.start()
                     time.sleep(0.03)
+
+            # compare how many frames we drew with how many the decoder delivered
+                displayed += 1
+                elapsed = time.time() - fps_start
+                if elapsed >= self.fps_report_interval:
+                    self.display_fps = displayed / elapsed
+                    self.received_fps = (seq - fps_start_seq) / elapsed
+                    print("[INFO] display %.1f fps, received %.1f fps" % (self.display_fps, self.received_fps))
+                    displayed = 0
+                    fps_start = time.time()
+                    fps_start_seq = seq
         except RuntimeError, e:
             print("[INFO] caught a RuntimeError")
 
            
+    def _scaleToPreview(self, frame):
+        """
+        Downscale the frame to the preview size, reusing one preallocated output buffer
+        """
+        if self.preview_size is None or tuple(self.preview_size) == (frame.shape[1], frame.shape[0]):
+            return frame
+        width, height = self.preview_size
+        if self.preview is None:
+            self.preview = np.empty((height, width) + frame.shape[2:], dtype=frame.dtype)
+        cv2.resize(frame, (width, height), dst=self.preview, interpolation=cv2.INTER_AREA)
+        return self.preview
+
+    def _toRGB(self, frame):
+        """
+        Convert a frame in the pixel format of the Tello decoder to something PIL can show
+        """
+        if self.tello.pixel_format is None:
+            # (y, u, v) planes -- the luma plane is enough for a preview
+            return frame[0]
+        if self.tello.pixel_format == libh264decoder.BGR24:
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if self.tello.pixel_format == libh264decoder.YUV420P:
+            return cv2.cvtColor(frame, cv2.COLOR_YUV2RGB_I420)
+        # RGB24 and GRAY8 are shown as they are
+        return frame
+
+    def _toBGR(self, frame):
+        """
+        Convert a frame in the pixel format of the Tello decoder to what cv2.imwrite expects
+        """
+        if self.tello.pixel_format is None:
+            return frame[0]
+        if self.tello.pixel_format == libh264decoder.RGB24:
+            return cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        if self.tello.pixel_format == libh264decoder.YUV420P:
+            return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420)
+        # BGR24 and GRAY8 are written as they are
+        return frame
+
     def _updateGUIImage(self,image):
         """
         Main operation to initial the object of image,and update the GUI panel 
         """  
-        image = ImageTk.PhotoImage(image)
         # if the panel none ,we need to initial it
         if self.panel is None:
-            self.panel = tki.Label(image=image)
-            self.panel.image = image
+            self.photo = ImageTk.PhotoImage(image)
+            self.panel = tki.Label(image=self.photo)
+            self.panel.image = self.photo
             self.panel.pack(side="left", padx=10, pady=10)
-        # otherwise, simply update the panel
+        # if the frame size changed, the Tk image has to be rebuilt
+        elif (self.photo.width(), self.photo.height()) != image.size:
+            self.photo = ImageTk.PhotoImage(image)
+            self.panel.configure(image=self.photo)
+            self.panel.image = self.photo
+        # otherwise, simply copy the pixels into the existing Tk image
         else:
-            self.panel.configure(image=image)
-            self.panel.image = image
+            self.photo.paste(image)
+
+    def _updateStateLabel(self):
+        """
+        Show the latest state broadcast by the drone, runs every state_interval_ms on the Tk mainloop
+        """
+        state = self.tello.get_state()
+        if state is not None:
+            # the height over the last second smooths out the 10 Hz barometer/tof jitter
+            recent = self.tello.state_receiver.window(1.0)
+            height = recent['h'].mean() if len(recent) else state['h']
+            self.state_label.config(text="Battery %d%%   Height %.0f cm   ToF %.0f cm   Yaw %d   Temp %d-%d C" % (
+                state['bat'], height, state['tof'], state['yaw'], state['templ'], state['temph']))
+        if not self.stopEvent.is_set():
+            self.root.after(self.state_interval_ms, self._updateStateLabel)
 
     def _setQuitWaitingFlag(self):  
         """
@@ -210,18 +313,43 @@ class TelloUI:
     def takeSnapshot(self):
         """
         save the current frame of the video as a jpg file and put it into outputpath
-        """
 
-        # grab the current timestamp and use it to construct the filename
-        ts = datetime.datetime.now()
-        filename = "{}.jpg".format(ts.strftime("%Y-%m-%d_%H-%M-%S"))
+        the frame is copied here and encoded by self.snapshots in the background
+        """
+        # the decoder can be set to BGR24 to skip the conversion, see Tello(pixel_format=...)
+        filename = self.snapshots.capture()
+        if filename is None:
+            print("[INFO] snapshot skipped, no frame yet or {} snapshots still queued".format(self.snapshots.depth()))
+        else:
+            print("[INFO] saving {} (queue depth {})".format(filename, self.snapshots.depth()))
 
-        p = os.path.sep.join((self.outputPath, filename))
+    def takeBurst(self):
+        """
+        save burst_count consecutive frames, burst_interval seconds apart, into outputpath
+        """
+        self.snapshots.burst(self.burst_count, self.burst_interval)
+        print("[INFO] burst of {} snapshots every {} s (queue depth {})".format(
+            self.burst_count, self.burst_interval, self.snapshots.depth()))
 
-        # save the file
-        cv2.imwrite(p, cv2.cvtColor(self.frame, cv2.COLOR_RGB2BGR))
-        print("[INFO] saved {}".format(filename))
 
+    def recordVideo(self):
+        """
+        Toggle recording of the raw h264 stream into outputpath, decodable later at full quality
+        """
+        if self.btn_record.config('relief')[-1] == 'sunken':
+            self.btn_record.config(relief="raised", text="Record Video")
+            self.tello.stop_recording()
+            print("[INFO] recording stopped")
+        else:
+            try:
+                self.tello.start_recording(self.outputPath)
+            except (ValueError, OSError, IOError) as e:
+                # e.g. a native_video Tello, which never sees the raw stream
+                print("[INFO] cannot record: {}".format(e))
+                tkMessageBox.showerror("Record Video", "Cannot record: {}".format(e), parent=self.root)
+                return
+            self.btn_record.config(relief="sunken", text="Stop Recording")
+            print("[INFO] recording to {}".format(self.outputPath))
 
     def pauseVideo(self):
         """
@@ -310,6 +438,8 @@ class TelloUI:
         print("[INFO] closing...")
         self.auto_route.stop()
         self.stopEvent.set()
+        self.tello.stop_recording()
+        self.snapshots.close()
         del self.tello
         self.root.quit()
 
@@ -0,0 +1,387 @@
+"""
+Single-process controller for several Tellos in station mode.
+
+Every drone gets its own local command port and, where the firmware accepts
+the SDK 2.0 "port" command, its own local video port. Otherwise all drones
+stream to the one port 11111 and the datagrams are told apart by their
+source IP. One select() loop serves every socket, and each drone flies its
+mission as a small state machine driven by responses and timeouts, so no
+thread is needed per drone and a slow drone never holds up the others.
+
+Usage:
+    python tello_fleet.py 192.168.10.11 192.168.10.12 [--video-ports per-drone]
+
+Missions are lists of SDK commands, by default the sweep of
+Perimeter_Sweep.AutoRoute. See benchmarks/fleet.py for how many drones one
+core keeps up with.
+"""
+
+import argparse
+import collections
+import errno
+import select
+import socket
+import time
+
+from Perimeter_Sweep import AutoRoute
+from tello_command import PendingCommands, ack_timeout
+from tello_state import StateRing
+from tello_video import PacketRing
+
+VIDEO_PORT = 11111  # where the Tello streams unless told otherwise
+STATE_PORT = 8890
+TELLO_PACKET_SIZE = 1460  # a shorter datagram ends the access unit
+
+
+def _would_block(exc):
+    return exc.args and exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class FleetDrone(object):
+    """One drone of a Fleet: its command socket, the mission it flies and its video."""
+
+    IDLE = 'idle'
+    RUNNING = 'running'
+    DONE = 'done'
+
+    def __init__(self, name, tello_address, command_socket, video_port, command_timeout=.3):
+        """
+        :param name (str): Name used in log lines.
+        :param tello_address (tuple): (ip, port) of the drone.
+        :param command_socket (socket.socket): Non-blocking socket bound to this drone's local command port.
+        :param video_port (int): Local port the drone streams to.
+        :param command_timeout (float): Seconds to wait for the response to a command that does not move the drone.
+        """
+        self.name = name
+        self.tello_address = tello_address
+        self.socket = command_socket
+        self.video_port = video_port
+        self.command_timeout = command_timeout
+        self.move_speed = 10.0  # cm/s, bounds the wait for a move, see tello_command.ack_timeout
+        self.yaw_rate = 30.0  # degree/s, bounds the wait for a rotation
+        self.pause = 0.0  # seconds between a response and the next command
+
+        self.state = self.IDLE
+        self.commands = []
+        self.step = 0  # index of the next command to send
+        # commands waiting for a response, including the ones that timed out, see tello_command
+        self.pending_commands = PendingCommands()
+        self.in_flight = None  # CommandFuture of the command waiting for its response
+        self.deadline = None  # until when in_flight's response is waited for
+        self.next_send_at = None
+        self.started_at = None
+        self.finished_at = None
+        self.command_latencies = collections.deque(maxlen=1024)
+        self.packet_ring = PacketRing(slots=2)
+        self.state_ring = StateRing()  # the drone's state broadcasts, see tello_state
+        self.on_access_unit = None  # called with (drone, memoryview) for every complete access unit
+        self.stats = {'commands': 0, 'timeouts': 0, 'errors': 0, 'unmatched': 0, 'late': 0,
+                      'access_units': 0, 'video_bytes': 0}
+
+    def fly(self, commands, now=None):
+        """Start flying a list of SDK commands, one after another."""
+        self.commands = list(commands)
+        self.step = 0
+        self.state = self.RUNNING
+        self.started_at = now if now is not None else time.time()
+        self.finished_at = None
+        self.next_send_at = self.started_at
+
+    def poll(self, now):
+        """
+        Send the next command or give up on the current one when its time has come.
+
+        :return: the time poll should be called again, None when nothing is scheduled.
+        """
+        if self.state != self.RUNNING:
+            return None
+        if self.in_flight is not None:
+            if now < self.deadline:
+                return self.deadline
+            # like Tello.send, log the missing response and carry on with the mission
+            print('%s: no response to: %s' % (self.name, self.in_flight.message))
+            self.stats['timeouts'] += 1
+            # its response may still come, and must not be taken for the next command's
+            self.pending_commands.abandon(self.in_flight, now)
+            self._advance(now)
+        if now < self.next_send_at:
+            return self.next_send_at
+        if self.step >= len(self.commands):
+            self.state = self.DONE
+            self.finished_at = now
+            return None
+        message = self.commands[self.step]
+        self.step += 1
+        future = self.pending_commands.add(message, now)
+        try:
+            self.socket.sendto(message.encode(), self.tello_address)
+        except socket.error as exc:
+            self.pending_commands.discard(future)
+            print('%s: error sending %s: %s' % (self.name, message, exc))
+            self._advance(now)
+            return now
+        self.stats['commands'] += 1
+        self.in_flight = future
+        self.deadline = now + ack_timeout(message, self.command_timeout, self.move_speed, self.yaw_rate)
+        return self.deadline
+
+    def on_response(self, response, now):
+        """Handle a datagram from the drone's command port."""
+        future = self.pending_commands.resolve(response, now)
+        self.stats['unmatched'] = self.pending_commands.unmatched
+        self.stats['late'] = self.pending_commands.late
+        if future is None:
+            # the answer to a command that already timed out, or to none at all
+            return
+        self.command_latencies.append(future.rtt)
+        if response.startswith('error'):
+            print('%s: %s -> %s' % (self.name, future.message, response))
+            self.stats['errors'] += 1
+        self._advance(now)
+
+    def _advance(self, now):
+        self.in_flight = None
+        self.deadline = None
+        self.next_send_at = now + self.pause
+
+    def on_video(self, nbytes):
+        """Account for a datagram that was just received into packet_ring."""
+        self.stats['video_bytes'] += nbytes
+        # same access unit boundaries as Tello._receive_video_thread
+        boundary = self.packet_ring.scan()
+        if boundary:
+            self._emit(*self.packet_ring.commit(boundary))
+        if nbytes != TELLO_PACKET_SIZE:
+            self._emit(*self.packet_ring.commit())
+
+    def _emit(self, slot, access_unit):
+        if access_unit is None:
+            return
+        try:
+            self.stats['access_units'] += 1
+            if self.on_access_unit is not None:
+                self.on_access_unit(self, access_unit)
+        finally:
+            self.packet_ring.release(slot)
+
+
+class Fleet(object):
+    """Drives several drones from one select() loop."""
+
+    SHARED = 'shared'
+    PER_DRONE = 'per-drone'
+
+    def __init__(self, local_ip='', base_command_port=9000, video=True, video_ports=SHARED,
+                 base_video_port=VIDEO_PORT, command_timeout=.3, state_port=STATE_PORT):
+        """
+        :param local_ip (str): Local IP address every socket binds to.
+        :param base_command_port (int): Local command port of the first drone, the next drones count up from it.
+        :param video (bool): Turn the video streams on.
+        :param video_ports (str): SHARED -- every drone streams to base_video_port and the datagrams are
+                                  demultiplexed by source IP, works with any firmware. PER_DRONE -- every
+                                  drone is told to stream to its own port with the SDK 2.0 "port" command.
+        :param base_video_port (int): Shared video port, or the video port of the first drone.
+        :param command_timeout (float): Seconds to wait for the response to a command that does not move a drone.
+        :param state_port (int): Port every drone broadcasts its state to, demultiplexed by source IP.
+                                 None to ignore the state.
+        """
+        if video_ports not in (self.SHARED, self.PER_DRONE):
+            raise ValueError('unknown video port mode %r' % video_ports)
+        self.local_ip = local_ip
+        self.base_command_port = base_command_port
+        self.video = video
+        self.video_ports = video_ports
+        self.base_video_port = base_video_port
+        self.command_timeout = command_timeout
+        self.state_port = state_port
+        self.drones = []
+        self.by_ip = {}  # drone ip -> FleetDrone, to demultiplex the shared video socket
+        self.handlers = {}  # socket -> callable reading it
+        self.shared_video_socket = None
+        self.state_socket = None
+        self.scratch = bytearray(2048)  # datagrams of the shared video socket land here first
+        self.loop_stats = {'iterations': 0, 'datagrams': 0, 'unknown_sources': 0}
+
+    def _bind(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.local_ip, port))
+        sock.setblocking(False)
+        return sock
+
+    def add(self, tello_ip, name=None, tello_port=8889):
+        """
+        Add a drone and bind its sockets.
+
+        :param tello_ip (str): IP of the drone in station mode.
+        :param name (str): Name used in log lines, defaults to the IP.
+        :param tello_port (int): Command port of the drone.
+
+        :return: the FleetDrone.
+        """
+        index = len(self.drones)
+        command_socket = self._bind(self.base_command_port + index)
+        if self.video_ports == self.PER_DRONE:
+            video_port = self.base_video_port + index
+        else:
+            video_port = self.base_video_port
+        drone = FleetDrone(name or tello_ip, (tello_ip, tello_port), command_socket, video_port,
+                           self.command_timeout)
+        self.drones.append(drone)
+        self.by_ip[tello_ip] = drone
+        self.handlers[command_socket] = lambda: self._read_commands(drone)
+
+        if self.state_port is not None and self.state_socket is None:
+            self.state_socket = self._bind(self.state_port)
+            self.handlers[self.state_socket] = self._read_state
+        if self.video:
+            if self.video_ports == self.PER_DRONE:
+                video_socket = self._bind(video_port)
+                self.handlers[video_socket] = lambda: self._read_video(drone, video_socket)
+            elif self.shared_video_socket is None:
+                self.shared_video_socket = self._bind(video_port)
+                self.handlers[self.shared_video_socket] = self._read_shared_video
+        return drone
+
+    def setup_commands(self, drone):
+        """Commands sent ahead of every mission: command mode, video port and stream."""
+        commands = ['command']
+        if self.video:
+            if self.video_ports == self.PER_DRONE:
+                commands.append('port %d %d' % (self.state_port or STATE_PORT, drone.video_port))
+            commands.append('streamon')
+        return commands
+
+    def fly(self, mission=None):
+        """
+        Start a mission on every drone.
+
+        :param mission (list): SDK commands, the AutoRoute sweep when None.
+        """
+        now = time.time()
+        for drone in self.drones:
+            commands = mission if mission is not None else AutoRoute(drone).mission()
+            drone.fly(self.setup_commands(drone) + list(commands), now)
+
+    def run(self, timeout=None):
+        """
+        Serve every socket until all missions are done.
+
+        :param timeout (float): Seconds after which to stop anyway, None for no limit.
+
+        :return: True if every mission finished.
+        """
+        stop_at = time.time() + timeout if timeout is not None else None
+        sockets = list(self.handlers)
+        while True:
+            now = time.time()
+            wake_at = stop_at
+            running = False
+            for drone in self.drones:
+                at = drone.poll(now)
+                if drone.state == FleetDrone.RUNNING:
+                    running = True
+                if at is not None and (wake_at is None or at < wake_at):
+                    wake_at = at
+            if not running:
+                return True
+            if stop_at is not None and now >= stop_at:
+                return False
+            wait = max(0.0, wake_at - now) if wake_at is not None else None
+            readable, _, _ = select.select(sockets, [], [], wait)
+            self.loop_stats['iterations'] += 1
+            for sock in readable:
+                self.handlers[sock]()
+
+    def _read_commands(self, drone):
+        while True:
+            try:
+                data, address = drone.socket.recvfrom(1024)
+            except socket.error as exc:
+                if _would_block(exc):
+                    return
+                print('%s: socket error: %s' % (drone.name, exc))
+                return
+            self.loop_stats['datagrams'] += 1
+            if address[0] != drone.tello_address[0]:
+                continue
+            drone.on_response(data.decode('utf-8', 'replace').strip(), time.time())
+
+    def _read_video(self, drone, sock):
+        while True:
+            try:
+                nbytes = drone.packet_ring.recv_into(sock)
+            except socket.error as exc:
+                if not _would_block(exc):
+                    print('%s: video socket error: %s' % (drone.name, exc))
+                return
+            self.loop_stats['datagrams'] += 1
+            drone.on_video(nbytes)
+
+    def _read_state(self):
+        while True:
+            try:
+                data, address = self.state_socket.recvfrom(1024)
+            except socket.error as exc:
+                if not _would_block(exc):
+                    print('state socket error: %s' % exc)
+                return
+            self.loop_stats['datagrams'] += 1
+            drone = self.by_ip.get(address[0])
+            if drone is None:
+                self.loop_stats['unknown_sources'] += 1
+                continue
+            drone.state_ring.feed(data)
+
+    def _read_shared_video(self):
+        view = memoryview(self.scratch)
+        while True:
+            try:
+                nbytes, address = self.shared_video_socket.recvfrom_into(self.scratch)
+            except socket.error as exc:
+                if not _would_block(exc):
+                    print('video socket error: %s' % exc)
+                return
+            self.loop_stats['datagrams'] += 1
+            drone = self.by_ip.get(address[0])
+            if drone is None:
+                self.loop_stats['unknown_sources'] += 1
+                continue
+            drone.packet_ring.write(view[:nbytes])
+            drone.on_video(nbytes)
+
+    def close(self):
+        """Turn the video off and close every socket."""
+        for drone in self.drones:
+            if self.video:
+                try:
+                    drone.socket.sendto(b'streamoff', drone.tello_address)
+                except socket.error:
+                    pass
+        for sock in self.handlers:
+            sock.close()
+        self.handlers = {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fly the perimeter sweep with several Tellos at once.')
+    parser.add_argument('drones', nargs='+', help='IP of every drone in station mode')
+    parser.add_argument('--local-ip', default='')
+    parser.add_argument('--command-port', type=int, default=9000, help='local command port of the first drone')
+    parser.add_argument('--video-ports', choices=(Fleet.SHARED, Fleet.PER_DRONE), default=Fleet.SHARED)
+    parser.add_argument('--no-video', action='store_true')
+    args = parser.parse_args()
+
+    fleet = Fleet(args.local_ip, args.command_port, not args.no_video, args.video_ports)
+    for ip in args.drones:
+        fleet.add(ip)
+    fleet.fly()
+    try:
+        fleet.run()
+    finally:
+        fleet.close()
+    for drone in fleet.drones:
+        print('%s: %s, mission %.1f s' % (drone.name, drone.stats, drone.finished_at - drone.started_at))
+
+
+if __name__ == '__main__':
+    main()
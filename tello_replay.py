@@ -0,0 +1,191 @@
+"""
+Capture and replay of the Tello UDP video stream.
+
+A capture file keeps every datagram the drone sent to port 11111 together
+with the time it arrived, so the stream can later be replayed over loopback
+with the original packet sizes and timing -- no drone needed.
+
+File layout: the 8 byte MAGIC, then one record per datagram made of a
+RECORD header (arrival time in seconds since the first datagram as a double,
+payload length as an unsigned short, little endian) followed by the payload.
+
+Usage:
+    python tello_replay.py capture out.tcap --seconds 30
+    python tello_replay.py convert in.h264 out.tcap --fps 30
+    python tello_replay.py replay in.tcap --host 127.0.0.1 --port 11111 [--loss 0.01]
+"""
+
+import argparse
+import random
+import socket
+import struct
+import time
+
+from tello_video import split_access_units
+
+MAGIC = b'TCAP\x00\x01\x00\x00'
+RECORD = struct.Struct('<dH')
+TELLO_PACKET_SIZE = 1460  # the Tello splits every access unit into datagrams of this size
+
+
+def write_capture(path, packets):
+    """
+    Write (timestamp, payload) pairs to a capture file.
+
+    :param path (str): File to create.
+    :param packets (iterable): (seconds since the first datagram, payload bytes) pairs.
+    """
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        for timestamp, payload in packets:
+            f.write(RECORD.pack(timestamp, len(payload)))
+            f.write(payload)
+
+
+def read_capture(path):
+    """
+    Read a capture file.
+
+    :param path (str): File written by write_capture.
+
+    :return: list of (seconds since the first datagram, payload bytes) pairs.
+    """
+    packets = []
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a Tello capture file' % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            timestamp, length = RECORD.unpack(header)
+            packets.append((timestamp, f.read(length)))
+    return packets
+
+
+def packetize_h264(data, fps=30.0):
+    """
+    Turn a raw Annex-B h264 stream into datagrams the way the Tello sends it.
+
+    Every access unit is cut into TELLO_PACKET_SIZE byte datagrams and access
+    units are spaced 1/fps seconds apart.
+
+    :param data (bytes): The stream.
+    :param fps (float): Frame rate the packets are timed at.
+
+    :return: list of (timestamp, payload) pairs.
+    """
+    packets = []
+    for i, (start, end) in enumerate(split_access_units(data)):
+        for offset in range(start, end, TELLO_PACKET_SIZE):
+            packets.append((i / fps, data[offset:min(offset + TELLO_PACKET_SIZE, end)]))
+    return packets
+
+
+def capture(path, seconds, local_ip='', video_port=11111, tello_address=('192.168.10.1', 8889)):
+    """
+    Record the live video stream of a drone to a capture file.
+
+    :param path (str): File to create.
+    :param seconds (float): How long to record.
+    :param local_ip (str): Local IP address to bind.
+    :param video_port (int): Local port the drone streams to.
+    :param tello_address (tuple): (ip, port) the commands go to.
+    """
+    cmd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    video = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    video.bind((local_ip, video_port))
+    video.settimeout(1.0)
+    cmd.sendto(b'command', tello_address)
+    cmd.sendto(b'streamon', tello_address)
+
+    packets = []
+    start = None
+    deadline = time.time() + seconds
+    try:
+        while time.time() < deadline:
+            try:
+                payload = video.recv(2048)
+            except socket.timeout:
+                continue
+            now = time.time()
+            if start is None:
+                start = now
+            packets.append((now - start, payload))
+    finally:
+        cmd.sendto(b'streamoff', tello_address)
+        cmd.close()
+        video.close()
+    write_capture(path, packets)
+    return len(packets)
+
+
+def replay(packets, address, speed=1.0, loss=0.0, seed=None):
+    """
+    Send captured datagrams to address, keeping their relative timing.
+
+    :param packets (list): (timestamp, payload) pairs from read_capture or packetize_h264.
+    :param address (tuple): (ip, port) to send to, e.g. ('127.0.0.1', 11111).
+    :param speed (float): Playback speed, 2.0 replays twice as fast, 0 sends as fast as possible.
+    :param loss (float): Fraction of datagrams dropped at random, to exercise loss recovery.
+    :param seed (int): Seed for the loss pattern, so runs can be repeated.
+
+    :return: (datagrams sent, datagrams dropped)
+    """
+    rng = random.Random(seed)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sent = dropped = 0
+    start = time.time()
+    try:
+        for timestamp, payload in packets:
+            if speed > 0:
+                delay = start + timestamp / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            if loss and rng.random() < loss:
+                dropped += 1
+                continue
+            sock.sendto(payload, address)
+            sent += 1
+    finally:
+        sock.close()
+    return sent, dropped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Capture and replay of the Tello UDP video stream.')
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('capture', help='record the live stream of a drone')
+    p.add_argument('output')
+    p.add_argument('--seconds', type=float, default=30.0)
+
+    p = commands.add_parser('convert', help='packetize a raw h264 file like the Tello does')
+    p.add_argument('input')
+    p.add_argument('output')
+    p.add_argument('--fps', type=float, default=30.0)
+
+    p = commands.add_parser('replay', help='send a capture file to a UDP port')
+    p.add_argument('input')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=11111)
+    p.add_argument('--speed', type=float, default=1.0)
+    p.add_argument('--loss', type=float, default=0.0)
+    p.add_argument('--seed', type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == 'capture':
+        print('captured %d datagrams' % capture(args.output, args.seconds))
+    elif args.command == 'convert':
+        with open(args.input, 'rb') as f:
+            packets = packetize_h264(f.read(), args.fps)
+        write_capture(args.output, packets)
+        print('wrote %d datagrams' % len(packets))
+    elif args.command == 'replay':
+        sent, dropped = replay(read_capture(args.input), (args.host, args.port),
+                               args.speed, args.loss, args.seed)
+        print('sent %d datagrams, dropped %d' % (sent, dropped))
+
+
+if __name__ == '__main__':
+    main()
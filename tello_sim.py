@@ -0,0 +1,350 @@
+"""
+Local stand-in for a Tello drone.
+
+Speaks the Tello SDK over UDP: answers commands on the command port with
+"ok"/"error" (or a value for read commands) after roughly the time the real
+drone needs, keeps a simple kinematic state that is broadcast on the state
+port, and streams a capture file to port 11111 of the client after
+"streamon". Reply latency and packet loss are configurable, so the control
+and video paths can be load-tested on any Linux box. Like the drone, it
+answers another "streamon" with a keyframe: the stream skips ahead to the
+next keyframe of the capture.
+
+The simulator binds the command port itself, so a client on the same machine
+has to bind a different local port, e.g.:
+    python tello_sim.py --video flight.tcap
+    python main.py --tello-ip 127.0.0.1 --local-port 9000
+
+Capture files come from tello_replay.py.
+"""
+
+import argparse
+import bisect
+import math
+import random
+import socket
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from tello_replay import read_capture
+from tello_video import START_CODE, is_keyframe
+
+MOVES = {'up': (0, 0, 1), 'down': (0, 0, -1), 'left': (0, -1, 0), 'right': (0, 1, 0),
+         'forward': (1, 0, 0), 'back': (-1, 0, 0)}
+STATE_FORMAT = ('pitch:0;roll:0;yaw:%d;vgx:0;vgy:0;vgz:0;templ:60;temph:62;tof:%d;h:%d;bat:%d;'
+                'baro:%.2f;time:%d;agx:0.00;agy:0.00;agz:-1000.00;\r\n')
+
+
+class TelloSimulator(object):
+    """Simulated Tello answering the SDK commands and streaming recorded video."""
+
+    def __init__(self, host='127.0.0.1', command_port=8889, video=None, video_port=11111, state_port=8890,
+                 latency=0.005, jitter=0.002, loss=0.0, time_scale=1.0, speed=50, yaw_rate=90, seed=None,
+                 video_loss=0.0):
+        """
+        :param host (str): Local IP address to bind.
+        :param command_port (int): Port the SDK commands are received on.
+        :param video (str): Capture file streamed after "streamon", None for no video.
+        :param video_port (int): Port on the client the video goes to.
+        :param state_port (int): Port on the client the state string goes to.
+        :param latency (float): Seconds added to every reply.
+        :param jitter (float): Random extra reply latency, up to this many seconds.
+        :param loss (float): Fraction of commands and replies dropped.
+        :param time_scale (float): Factor applied to how long manoeuvres take, 0.1 flies ten times faster.
+        :param speed (int): Horizontal and vertical speed in cm/s, changed by the "speed" command.
+        :param yaw_rate (int): Rotation speed in degrees per second.
+        :param seed (int): Seed for latency jitter and loss, so runs can be repeated.
+        :param video_loss (float): Fraction of video datagrams dropped.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.video_loss = video_loss
+        self.time_scale = time_scale
+        self.speed = speed
+        self.yaw_rate = yaw_rate
+        self.video_port = video_port
+        self.state_port = state_port
+        self.rng = random.Random(seed)
+        self.packets = read_capture(video) if video else []
+        # datagrams that open a keyframe, where the stream can jump to when a keyframe is asked for
+        self.keyframes = [i for i, (_, payload) in enumerate(self.packets) if payload.find(START_CODE, 0, 4) >= 0
+                          and is_keyframe(bytearray(payload), 0, len(payload))]
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, command_port))
+        self.socket.settimeout(0.5)  # lets the receive thread notice stop()
+        self.address = self.socket.getsockname()
+        self.host = host  # state and video are sent from this address too, so a client can tell drones apart
+        self.client = None  # address of whoever sent the last command
+
+        # kinematic state, positions in cm and yaw in degrees
+        self.flying = False
+        self.x = self.y = self.z = 0.0
+        self.yaw = 0
+        self.battery = 100.0
+        self.flight_time = 0.0
+        self.streaming = threading.Event()
+        self.keyframe_requested = threading.Event()
+        self.stop_event = threading.Event()
+        self.commands = queue.Queue()
+        self.stats = {'received': 0, 'replied': 0, 'dropped': 0, 'errors': 0, 'video_packets': 0,
+                      'video_dropped': 0, 'keyframes_requested': 0}
+
+        self.threads = [threading.Thread(target=target) for target in
+                        (self._receive_thread, self._command_thread, self._state_thread, self._video_thread)]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        """Start answering commands."""
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """Stop all threads and close the command socket."""
+        self.stop_event.set()
+        self.commands.put(None)
+        self.socket.close()
+
+    def _lost(self):
+        return self.loss > 0 and self.rng.random() < self.loss
+
+    def _receive_thread(self):
+        """Queue every command so that long manoeuvres do not block the socket."""
+        while not self.stop_event.is_set():
+            try:
+                data, address = self.socket.recvfrom(1024)
+            except socket.error:
+                continue
+            self.stats['received'] += 1
+            if self._lost():
+                self.stats['dropped'] += 1
+                continue
+            self.client = address
+            self.commands.put((data.decode('utf-8', 'replace').strip(), address))
+
+    def _command_thread(self):
+        """Execute the commands one after another, like the drone does, and reply when done."""
+        while not self.stop_event.is_set():
+            item = self.commands.get()
+            if item is None:
+                return
+            message, address = item
+            reply = self.execute(message)
+            time.sleep(self.latency + self.rng.random() * self.jitter)
+            if reply.startswith('error'):
+                self.stats['errors'] += 1
+            if self._lost():
+                self.stats['dropped'] += 1
+                continue
+            try:
+                self.socket.sendto(reply.encode(), address)
+                self.stats['replied'] += 1
+            except socket.error:
+                pass
+
+    def _fly(self, seconds):
+        """Spend the time a manoeuvre takes, scaled by time_scale."""
+        seconds *= self.time_scale
+        if seconds > 0:
+            time.sleep(seconds)
+        self.flight_time += seconds
+        # a full battery lasts about 13 minutes of flight
+        self.battery = max(0.0, self.battery - seconds * 100.0 / 780.0)
+
+    def execute(self, message):
+        """
+        Apply one SDK command to the simulated state.
+
+        :param message (str): The command, e.g. "forward 50".
+
+        :return: the reply the drone would send.
+        """
+        parts = message.lower().split()
+        if not parts:
+            return 'error'
+        name, args = parts[0], parts[1:]
+
+        if name == 'command':
+            return 'ok'
+        if name == 'streamon':
+            if self.streaming.is_set():
+                self.stats['keyframes_requested'] += 1
+                self.keyframe_requested.set()
+            self.streaming.set()
+            return 'ok'
+        if name == 'streamoff':
+            self.streaming.clear()
+            return 'ok'
+        if name == 'port':
+            return self._set_ports(args)
+        if name.endswith('?'):
+            return self._query(name)
+        if name == 'takeoff':
+            if self.flying:
+                return 'error'
+            self._fly(5.0)
+            self.flying = True
+            self.z = 80.0
+            return 'ok'
+        if name in ('land', 'emergency'):
+            if not self.flying:
+                return 'error'
+            self._fly(self.z / 30.0 if name == 'land' else 0.0)
+            self.flying = False
+            self.z = 0.0
+            return 'ok'
+        if name == 'stop':
+            return 'ok'
+        if name == 'speed':
+            return self._set_speed(args)
+        if name in MOVES:
+            return self._move(name, args)
+        if name in ('cw', 'ccw'):
+            return self._rotate(name, args)
+        return 'error'
+
+    def _query(self, name):
+        values = {'battery?': '%d' % self.battery, 'height?': '%ddm' % (self.z / 10),
+                  'speed?': '%.1f' % self.speed, 'time?': '%ds' % self.flight_time,
+                  'wifi?': '90', 'sdk?': '20', 'sn?': '0TQZSIMULATOR'}
+        return values.get(name, 'error')
+
+    def _set_speed(self, args):
+        try:
+            speed = int(args[0])
+        except (IndexError, ValueError):
+            return 'error'
+        if not 10 <= speed <= 100:
+            return 'error'
+        self.speed = speed
+        return 'ok'
+
+    def _set_ports(self, args):
+        # SDK 2.0 "port <state port> <video port>"
+        try:
+            state_port, video_port = int(args[0]), int(args[1])
+        except (IndexError, ValueError):
+            return 'error'
+        if not (1025 <= state_port <= 65535 and 1025 <= video_port <= 65535):
+            return 'error'
+        self.state_port, self.video_port = state_port, video_port
+        return 'ok'
+
+    def _move(self, name, args):
+        try:
+            distance = int(args[0])
+        except (IndexError, ValueError):
+            return 'error'
+        if not self.flying or not 20 <= distance <= 500:
+            return 'error'
+        self._fly(float(distance) / self.speed)
+        forward, right, up = MOVES[name]
+        heading = math.radians(self.yaw)
+        self.x += distance * (forward * math.cos(heading) - right * math.sin(heading))
+        self.y += distance * (forward * math.sin(heading) + right * math.cos(heading))
+        self.z = max(0.0, self.z + distance * up)
+        return 'ok'
+
+    def _rotate(self, name, args):
+        try:
+            degree = int(args[0])
+        except (IndexError, ValueError):
+            return 'error'
+        if not self.flying or not 1 <= degree <= 360:
+            return 'error'
+        self._fly(float(degree) / self.yaw_rate)
+        self.yaw = (self.yaw + (degree if name == 'cw' else -degree) + 180) % 360 - 180
+        return 'ok'
+
+    def _state_thread(self):
+        """Broadcast the state string to the client at 10 Hz, like the drone does on port 8890."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.host, 0))
+        while not self.stop_event.wait(0.1):
+            if self.client is None:
+                continue
+            state = STATE_FORMAT % (self.yaw, self.z + 10, self.z, self.battery, self.z / 100.0, self.flight_time)
+            try:
+                sock.sendto(state.encode(), (self.client[0], self.state_port))
+            except socket.error:
+                pass
+        sock.close()
+
+    def _video_thread(self):
+        """Loop the capture file to the client's video port while streaming is on."""
+        if not self.packets:
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.host, 0))
+        while not self.stop_event.is_set():
+            if not self.streaming.wait(0.5):
+                continue
+            start = time.time()
+            i = 0
+            while i < len(self.packets):
+                if not self.streaming.is_set() or self.stop_event.is_set():
+                    break
+                if self.keyframe_requested.is_set():
+                    self.keyframe_requested.clear()
+                    # the drone encodes a keyframe right away, carry on from the next one in the capture
+                    i = self._next_keyframe(i)
+                    start = time.time() - self.packets[i][0]
+                timestamp, payload = self.packets[i]
+                i += 1
+                delay = start + timestamp - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                if self.video_loss > 0 and self.rng.random() < self.video_loss:
+                    self.stats['video_dropped'] += 1
+                    continue
+                try:
+                    sock.sendto(payload, (self.client[0], self.video_port))
+                    self.stats['video_packets'] += 1
+                except socket.error:
+                    pass
+        sock.close()
+
+    def _next_keyframe(self, i):
+        """Return the index of the first datagram of the next keyframe at or after datagram i, wrapping around."""
+        if not self.keyframes:
+            return i
+        k = bisect.bisect_left(self.keyframes, i)
+        return self.keyframes[k] if k < len(self.keyframes) else self.keyframes[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for a Tello drone.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8889)
+    parser.add_argument('--video', default=None, help='capture file streamed after streamon')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds added to every reply')
+    parser.add_argument('--loss', type=float, default=0.0, help='fraction of commands and replies dropped')
+    parser.add_argument('--video-loss', type=float, default=0.0, help='fraction of video datagrams dropped')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='0.1 flies ten times faster')
+    parser.add_argument('--quiet', action='store_true', help='do not print the state every 5 s')
+    args = parser.parse_args()
+
+    sim = TelloSimulator(args.host, args.port, video=args.video, latency=args.latency, loss=args.loss,
+                         time_scale=args.time_scale, video_loss=args.video_loss).start()
+    print('simulated Tello listening on %s:%d' % sim.address)
+    try:
+        while True:
+            time.sleep(5)
+            if args.quiet:
+                continue
+            print('%s  position (%.0f, %.0f, %.0f) yaw %d battery %d%%' % (
+                sim.stats, sim.x, sim.y, sim.z, sim.yaw, sim.battery))
+    except KeyboardInterrupt:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main()
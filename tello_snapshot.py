@@ -0,0 +1,146 @@
+"""
+Background JPEG snapshots of the Tello video.
+
+Taking a snapshot only copies the newest frame published to the FrameSlot.
+Frames are published whole and the reference taken keeps the decoder from
+reusing the buffer during the copy, so a snapshot never mixes two frames,
+and the caller (the Tk button callback) returns at once. Color conversion and JPEG
+encoding happen on a small pool of worker threads; cv2 releases the GIL
+while it encodes, so the preview keeps running.
+"""
+
+import datetime
+import os
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import cv2
+import numpy as np
+
+
+def copy_frame(frame):
+    """Return a copy of a frame, a numpy array or a (y, u, v) tuple of arrays."""
+    if isinstance(frame, tuple):
+        return tuple(np.copy(plane) for plane in frame)
+    return np.copy(frame)
+
+
+class SnapshotWriter(object):
+    """Pool of worker threads writing snapshots of the newest frame as JPEG files."""
+
+    def __init__(self, frame_slot, output_path, convert=None, workers=2, max_queue=32, quality=95):
+        """
+        :param frame_slot (tello_video.FrameSlot): Where the frames come from, e.g. Tello.frame_slot.
+        :param output_path (str): Directory the JPEG files go to, created if needed.
+        :param convert (callable): Turns a copied frame into the BGR (or gray) image cv2.imwrite expects,
+                                   runs on the worker. None writes the frame as it is.
+        :param workers (int): Encoder threads.
+        :param max_queue (int): Snapshots that may wait for a worker; more are rejected, not queued.
+        :param quality (int): JPEG quality, 0 to 100.
+        """
+        self.frame_slot = frame_slot
+        self.output_path = output_path
+        self.convert = convert
+        self.quality = quality
+        self.queue = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.count = 0  # snapshots named so far
+        self.stats = {'submitted': 0, 'written': 0, 'rejected': 0, 'failed': 0,
+                      'max_depth': 0, 'encode_time': 0.0}
+        if not os.path.isdir(output_path):
+            os.makedirs(output_path)
+
+        self.workers = [threading.Thread(target=self._worker) for _ in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def depth(self):
+        """Number of snapshots waiting for a worker."""
+        return self.queue.qsize()
+
+    def capture(self, label=''):
+        """
+        Queue a snapshot of the newest frame. Returns at once.
+
+        :param label (str): Added to the file name, e.g. the burst index.
+
+        :return: the file name the snapshot will be written to, None if there is no frame yet or the queue is full.
+        """
+        seq, frame = self.frame_slot.latest()
+        if frame is None:
+            return None
+        return self._submit(seq, frame, label)
+
+    def _submit(self, seq, frame, label):
+        # the copy keeps the snapshot intact once the decoder reuses the frame's buffer
+        frame = copy_frame(frame)
+        with self.lock:
+            self.count += 1
+            count = self.count
+        # the counter keeps names unique when the same frame is snapshot twice within a millisecond
+        now = datetime.datetime.now()
+        filename = '%s_%03d_%04d_frame%d%s.jpg' % (now.strftime('%Y-%m-%d_%H-%M-%S'), now.microsecond // 1000,
+                                                   count, seq, '_' + label if label else '')
+        try:
+            self.queue.put_nowait((filename, frame))
+        except queue.Full:
+            with self.lock:
+                self.stats['rejected'] += 1
+            return None
+        with self.lock:
+            self.stats['submitted'] += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'], self.queue.qsize())
+        return filename
+
+    def burst(self, count, interval):
+        """
+        Take count snapshots, interval seconds apart, each of a frame newer than the one before.
+
+        Runs on its own thread and returns at once.
+
+        :return: the thread taking the burst.
+        """
+        thread = threading.Thread(target=self._burst, args=(count, interval))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _burst(self, count, interval):
+        seq = 0
+        next_at = time.time()
+        for i in range(count):
+            delay = next_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            seq, frame = self.frame_slot.wait_next(seq, timeout=1.0)
+            if frame is None:
+                continue
+            self._submit(seq, frame, 'burst%02d' % i)
+            next_at += interval
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            filename, frame = item
+            start = time.time()
+            image = self.convert(frame) if self.convert is not None else frame
+            ok = cv2.imwrite(os.path.join(self.output_path, filename), image,
+                             [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            with self.lock:
+                self.stats['encode_time'] += time.time() - start
+                self.stats['written' if ok else 'failed'] += 1
+
+    def close(self):
+        """Write the snapshots still queued and stop the workers."""
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
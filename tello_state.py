@@ -0,0 +1,165 @@
+"""
+Receiver for the state string the Tello broadcasts on UDP port 8890.
+
+The drone sends a line such as
+
+    pitch:0;roll:0;yaw:-12;vgx:0;vgy:0;vgz:0;templ:60;temph:62;tof:90;h:80;bat:87;baro:12.43;time:14;agx:...;
+
+about ten times a second. Every packet is parsed with one precompiled
+regular expression into a record of a NumPy structured ring buffer, so the
+history takes fixed memory, appending is O(1), and the latest state or the
+states of the last few seconds can be read at any time.
+"""
+
+import re
+import socket
+import threading
+import time
+
+import numpy as np
+
+STATE_PORT = 8890
+STATE_FIELDS = ('pitch', 'roll', 'yaw', 'vgx', 'vgy', 'vgz', 'templ', 'temph',
+                'tof', 'h', 'bat', 'baro', 'time', 'agx', 'agy', 'agz')
+# 'timestamp' is the local time.time() the packet arrived, the rest are the drone's fields in the order it sends them
+STATE_DTYPE = np.dtype([('timestamp', np.float64)] + [(name, np.float32) for name in STATE_FIELDS])
+
+# the whole packet in one match; search() rather than match() skips the mission pad fields Tello EDU sends first
+_STATE_RE = re.compile(b''.join(name.encode() + b':(-?[0-9.]+);' for name in STATE_FIELDS))
+# fallback for packets with the fields in another order or some missing
+_FIELD_RE = re.compile(b'([a-z]+):(-?[0-9.]+)')
+_FIELD_INDEX = dict((name.encode(), i) for i, name in enumerate(STATE_FIELDS))
+
+
+def parse_state(data):
+    """
+    Parse a state packet.
+
+    :param data (bytes): The datagram as received.
+
+    :return: tuple of floats in STATE_FIELDS order, NaN for fields missing from the packet,
+             or None if no field could be read.
+    """
+    match = _STATE_RE.search(data)
+    if match is not None:
+        return tuple(float(value) for value in match.groups())
+    values = [float('nan')] * len(STATE_FIELDS)
+    found = False
+    for name, value in _FIELD_RE.findall(data):
+        i = _FIELD_INDEX.get(name)
+        if i is not None:
+            values[i] = float(value)
+            found = True
+    return tuple(values) if found else None
+
+
+class StateRing(object):
+    """Fixed-size history of state records, oldest overwritten first."""
+
+    def __init__(self, capacity=1024):
+        """
+        :param capacity (int): Records kept, 1024 is about 100 s at the drone's 10 Hz.
+        """
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype=STATE_DTYPE)
+        self.next = 0  # index the next record is written to
+        self.count = 0  # records written so far, including overwritten ones
+        self.packets = 0  # packets handed to feed()
+        self.parse_errors = 0  # packets feed() could not read a field from
+        self.lock = threading.Lock()
+
+    def feed(self, data, timestamp=None):
+        """
+        Parse one state packet and store it, e.g. a packet received on a socket shared by several drones.
+
+        :return: the stored record as a tuple in STATE_DTYPE order, None if the packet could not be read.
+        """
+        self.packets += 1
+        values = parse_state(data)
+        if values is None:
+            self.parse_errors += 1
+            return None
+        return self.append(values, timestamp)
+
+    def append(self, values, timestamp=None):
+        """
+        Store one state.
+
+        :param values (tuple): Field values in STATE_FIELDS order, as returned by parse_state.
+        :param timestamp (float): Arrival time, time.time() when None.
+
+        :return: the record as a tuple in STATE_DTYPE order.
+        """
+        record = (timestamp if timestamp is not None else time.time(),) + values
+        with self.lock:
+            self.data[self.next] = record
+            self.next = (self.next + 1) % self.capacity
+            self.count += 1
+        return record
+
+    def latest(self):
+        """Return a copy of the most recent record (fields by name, e.g. state['h']), None before the first one."""
+        with self.lock:
+            if not self.count:
+                return None
+            return self.data[self.next - 1].copy()
+
+    def last(self, n):
+        """Return a copy of the n most recent records, oldest first."""
+        with self.lock:
+            n = min(n, self.count, self.capacity)
+            indices = np.arange(self.next - n, self.next) % self.capacity
+            return self.data[indices]
+
+    def window(self, seconds, now=None):
+        """
+        Return a copy of the records that arrived within the last seconds, oldest first.
+
+        :param seconds (float): Length of the window.
+        :param now (float): End of the window, time.time() when None.
+        """
+        since = (now if now is not None else time.time()) - seconds
+        records = self.last(self.capacity)
+        return records[records['timestamp'] >= since]
+
+
+class StateReceiver(object):
+    """Listens on the state port and keeps every state packet in a StateRing."""
+
+    def __init__(self, local_ip='', port=STATE_PORT, capacity=1024, recorder=None):
+        """
+        :param local_ip (str): Local IP address to bind.
+        :param port (int): Local port the drone sends its state to.
+        :param capacity (int): Records kept in the ring.
+        :param recorder (tello_telemetry.TelemetryRecorder): Also log every state there, None not to.
+        """
+        self.ring = StateRing(capacity)
+        self.recorder = recorder
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((local_ip, port))
+
+        self.receive_thread = threading.Thread(target=self._receive_thread)
+        self.receive_thread.daemon = True
+        self.receive_thread.start()
+
+    def latest(self):
+        """Return the most recent state record, None before the first packet."""
+        return self.ring.latest()
+
+    def window(self, seconds):
+        """Return the state records of the last seconds, oldest first."""
+        return self.ring.window(seconds)
+
+    def _receive_thread(self):
+        while True:
+            try:
+                data, _ = self.socket.recvfrom(1024)
+            except socket.error as exc:
+                print("Caught exception socket.error : %s" % exc)
+                return
+            record = self.ring.feed(data)
+            if record is not None and self.recorder is not None:
+                self.recorder.record_state(record)
+
+    def close(self):
+        self.socket.close()
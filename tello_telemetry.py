@@ -0,0 +1,227 @@
+"""
+Batched recorder of everything that happens during a flight, for post-flight analysis.
+
+Records go into preallocated NumPy batches in memory; record() does no I/O
+and no allocation, so it can be called from Tello.send and the video
+threads at full rate. A background thread hands full batches, and every
+flush_interval the partly filled ones, to disk.
+
+On disk every table is stored column by column: the directory holds one
+append-only file per column, <table>.<column>.bin, with the raw values in
+the column's NumPy dtype, plus schema.json naming the dtype of each column.
+A column can be read on its own with numpy.fromfile, or a whole table with
+load().
+
+Tables:
+    commands  -- every command sent
+    acks      -- every response, or timeout, with the round-trip time
+    frames    -- every decoded frame, with its receive/publish times and decode time
+    state     -- every state packet, see tello_state
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from tello_state import STATE_DTYPE
+
+COMMAND_DTYPE = np.dtype([('timestamp', np.float64), ('message', 'S24')])
+# rtt is NaN for commands that timed out
+ACK_DTYPE = np.dtype([('timestamp', np.float64), ('message', 'S24'), ('response', 'S24'), ('rtt', np.float32)])
+FRAME_DTYPE = np.dtype([('received_at', np.float64), ('published_at', np.float64),
+                        ('decode_time', np.float32), ('access_unit_bytes', np.uint32)])
+TABLES = {'commands': COMMAND_DTYPE, 'acks': ACK_DTYPE, 'frames': FRAME_DTYPE, 'state': STATE_DTYPE}
+SCHEMA = 'schema.json'
+
+
+def _column_path(directory, table, column):
+    return os.path.join(directory, '%s.%s.bin' % (table, column))
+
+
+def load(directory, table):
+    """
+    Read a whole table of a recording.
+
+    :param directory (str): Directory a TelemetryRecorder wrote.
+    :param table (str): Table name, e.g. 'acks'.
+
+    :return: numpy structured array with one record per row.
+    """
+    with open(os.path.join(directory, SCHEMA)) as f:
+        columns = json.load(f)[table]
+    dtype = np.dtype([(str(name), str(kind)) for name, kind in columns])
+    data = dict((name, np.fromfile(_column_path(directory, table, name), dtype=dtype[name]))
+                for name in dtype.names)
+    # a crash between two column writes can leave the last batch in some columns only
+    rows = min(len(values) for values in data.values())
+    out = np.empty(rows, dtype=dtype)
+    for name in dtype.names:
+        out[name] = data[name][:rows]
+    return out
+
+
+class TelemetryRecorder(object):
+    """Collects records in memory batches and appends them to a columnar recording in the background."""
+
+    def __init__(self, directory, batch_size=1024, flush_interval=1.0, max_pending=64):
+        """
+        :param directory (str): Directory the recording goes to, created if needed. Recording again
+                                into the same directory appends to the files already there.
+        :param batch_size (int): Records per table held in memory before they are handed to the writer.
+        :param flush_interval (float): Seconds after which partly filled batches are written anyway.
+        :param max_pending (int): Full batches that may wait for the writer; beyond that records are
+                                  dropped and counted rather than blocking the caller.
+        """
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._write_schema()
+
+        self.cond = threading.Condition()
+        self.batches = dict((name, np.empty(batch_size, dtype=dtype)) for name, dtype in TABLES.items())
+        self.fill = dict((name, 0) for name in TABLES)
+        self.spare = dict((name, []) for name in TABLES)  # written batches, reused instead of allocating
+        self.pending = collections.deque()  # (table, batch, count) waiting for the writer
+        self.writing = False
+        self.closed = False
+        self.files = {}
+        self.stats = {'records': 0, 'written': 0, 'dropped': 0, 'flushes': 0, 'write_time': 0.0}
+
+        self.flush_thread = threading.Thread(target=self._flush_thread)
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+
+    def _write_schema(self):
+        schema = dict((name, [(column, dtype[column].str) for column in dtype.names])
+                      for name, dtype in TABLES.items())
+        path = os.path.join(self.directory, SCHEMA)
+        if os.path.exists(path):
+            with open(path) as f:
+                existing = json.load(f)
+            if existing != json.loads(json.dumps(schema)):
+                raise ValueError('%s holds a recording with a different schema' % self.directory)
+            return
+        with open(path, 'w') as f:
+            json.dump(schema, f, indent=1, sort_keys=True)
+
+    def record(self, table, values):
+        """
+        Add one record. Never blocks on I/O.
+
+        :param table (str): One of TABLES.
+        :param values (tuple): Field values in the order of the table's dtype.
+        """
+        with self.cond:
+            if self.closed:
+                return
+            i = self.fill[table]
+            self.batches[table][i] = values
+            self.stats['records'] += 1
+            if i + 1 < self.batch_size:
+                self.fill[table] = i + 1
+            else:
+                self._hand_over(table, self.batch_size)
+                self.cond.notify()
+
+    def record_command(self, message):
+        self.record('commands', (time.time(), message.encode()))
+
+    def record_ack(self, message, response, rtt):
+        """Record a response, response None and rtt None for a command that timed out."""
+        self.record('acks', (time.time(), message.encode(), (response or '').encode(),
+                             rtt if rtt is not None else float('nan')))
+
+    def record_frame(self, received_at, published_at, decode_time, access_unit_bytes):
+        self.record('frames', (received_at, published_at, decode_time, access_unit_bytes))
+
+    def record_state(self, state):
+        """Record a state tuple as returned by tello_state.StateRing.feed."""
+        self.record('state', state)
+
+    def _hand_over(self, table, count):
+        """Queue the current batch of table for the writer and start a new one. Called with cond held."""
+        if len(self.pending) >= self.max_pending:
+            # the disk cannot keep up -- lose this batch rather than stall the caller
+            self.stats['dropped'] += count
+            self.fill[table] = 0
+            return
+        self.pending.append((table, self.batches[table], count))
+        spare = self.spare[table]
+        self.batches[table] = spare.pop() if spare else np.empty(self.batch_size, dtype=TABLES[table])
+        self.fill[table] = 0
+
+    def _hand_over_partial(self):
+        """Queue every partly filled batch. Called with cond held."""
+        for table in TABLES:
+            if self.fill[table]:
+                self._hand_over(table, self.fill[table])
+
+    def flush(self, timeout=5.0):
+        """Write everything recorded so far and wait until it is on disk (flushed to the OS)."""
+        deadline = time.time() + timeout
+        with self.cond:
+            self._hand_over_partial()
+            self.cond.notify_all()
+            while (self.pending or self.writing) and time.time() < deadline:
+                self.cond.wait(0.05)
+
+    def close(self):
+        """Write what is left and close the files. Later records are ignored."""
+        self.flush()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.flush_thread.join()
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def _flush_thread(self):
+        next_flush = time.time() + self.flush_interval
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    wait = next_flush - time.time()
+                    if wait <= 0:
+                        self._hand_over_partial()
+                        next_flush = time.time() + self.flush_interval
+                        if self.pending:
+                            break
+                        continue
+                    self.cond.wait(wait)
+                if self.closed and not self.pending:
+                    return
+                batches = list(self.pending)
+                self.pending.clear()
+                self.writing = True
+
+            start = time.time()
+            for table, batch, count in batches:
+                self._write(table, batch, count)
+            for f in self.files.values():
+                f.flush()
+
+            with self.cond:
+                for table, batch, count in batches:
+                    self.spare[table].append(batch)
+                    self.stats['written'] += count
+                self.stats['flushes'] += 1
+                self.stats['write_time'] += time.time() - start
+                self.writing = False
+                self.cond.notify_all()
+
+    def _write(self, table, batch, count):
+        rows = batch[:count]
+        for column in batch.dtype.names:
+            key = (table, column)
+            f = self.files.get(key)
+            if f is None:
+                f = self.files[key] = open(_column_path(self.directory, table, column), 'ab')
+            f.write(rows[column].tobytes())
@@ -0,0 +1,876 @@
+"""
+Buffers shared by the Tello video pipeline.
+
+The receive path assembles h264 access units in place inside memory that is
+allocated once, so the hot loop does no per-packet allocation or string
+concatenation.
+"""
+
+import collections
+import os
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+try:
+    # recvmmsg wrapper, only in Linux builds of the extension
+    from libh264decoder import recv_batch
+except ImportError:
+    recv_batch = None
+
+START_CODE = b'\x00\x00\x01'
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', None)  # not available on Windows
+
+
+def set_receive_buffer(sock, size):
+    """
+    Ask the kernel for a larger socket receive buffer, so the datagrams of a
+    keyframe survive a moment the receiving thread does not get to run.
+
+    :param sock (socket.socket): The socket.
+    :param size (int): Bytes requested.
+
+    :return: the size the kernel granted. Linux doubles the request for its own bookkeeping and caps
+             it at net.core.rmem_max; raise that limit with sysctl for buffers beyond it.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+
+class BatchReceiver(object):
+    """
+    Receives every datagram already queued on a socket per wakeup, straight into a PacketRing.
+
+    With the Linux build of libh264decoder a batch takes a single recvmmsg call
+    made without the GIL, into a buffer allocated once, and every datagram is
+    then copied into the ring. Otherwise the first datagram is waited for with
+    recv_into and the rest are picked up by non-blocking recv_into calls until
+    the socket is empty, each landing in the ring slot without a copy.
+    """
+
+    def __init__(self, sock, batch=32, packet_size=2048, native=True):
+        """
+        :param sock (socket.socket): Blocking datagram socket to read from.
+        :param batch (int): Most datagrams taken per receive_into(), at most 64 with recvmmsg.
+        :param packet_size (int): Largest datagram accepted.
+        :param native (bool): Use recvmmsg where available, False for the recv_into loop.
+        """
+        self.sock = sock
+        self.batch = batch
+        self.packet_size = packet_size
+        self.native = native and recv_batch is not None
+        if self.native:
+            self.buffer = bytearray(batch * packet_size)
+            self.view = memoryview(self.buffer)
+            self.lengths = np.zeros(batch, dtype=np.int32)
+        self.calls = 0  # receive system calls, including the ones that found the socket empty
+        self.datagrams = 0
+        self.batches = 0
+        self.bytes_copied = 0  # bytes receive_into copied from the recvmmsg buffer into the ring
+
+    def receive_into(self, ring):
+        """
+        Wait for a datagram and take every other one already queued, up to batch, into a PacketRing.
+
+        A generator: each datagram is written at the end of the slot being
+        assembled, and the caller has to scan() or commit() it before asking
+        for the next one.
+
+        :param ring (PacketRing): Ring the access units are assembled in.
+
+        :return: iterator over the sizes of the datagrams received.
+        """
+        if self.native:
+            count = recv_batch(self.sock.fileno(), self.buffer, self.packet_size, self.lengths)
+            self.calls += 1
+            self.batches += 1
+            for i, size in enumerate(self.lengths[:count].tolist()):
+                start = i * self.packet_size
+                nbytes = ring.write(self.view[start:start + size])
+                self.bytes_copied += nbytes
+                self.datagrams += 1
+                yield nbytes
+            return
+        nbytes = ring.recv_into(self.sock)
+        self.calls += 1
+        self.batches += 1
+        count = 1
+        while True:
+            self.datagrams += 1
+            yield nbytes
+            if _MSG_DONTWAIT is None or count >= self.batch:
+                return
+            self.calls += 1
+            try:
+                nbytes = ring.recv_into(self.sock, _MSG_DONTWAIT)
+            except socket.error:
+                # nothing queued any more; a real error shows up again on the next blocking call
+                return
+            count += 1
+
+    def stats(self):
+        """Return a dict with the system calls made, datagrams and batches received and bytes copied."""
+        return {'native': self.native, 'calls': self.calls, 'datagrams': self.datagrams, 'batches': self.batches,
+                'per_call': float(self.datagrams) / self.calls if self.calls else 0.0,
+                'bytes_copied': self.bytes_copied}
+
+
+class PacketRing(object):
+    """Preallocated ring of slots used to assemble h264 access units in place."""
+
+    def __init__(self, slots=4, slot_size=256 * 1024, packet_size=2048):
+        """
+        :param slots (int): Number of access units that can be held at the same time.
+        :param slot_size (int): Bytes reserved for a single access unit.
+        :param packet_size (int): Largest datagram accepted from the socket.
+        """
+        self.slot_size = slot_size
+        self.packet_size = packet_size
+        self.buffer = bytearray(slots * slot_size)
+        self.view = memoryview(self.buffer)
+        self.free_slots = collections.deque(range(1, slots))
+        self.slot = 0  # slot currently being assembled
+        self.length = 0  # bytes assembled so far in the current slot
+        self.overflows = 0  # access units dropped because they did not fit in a slot
+        self.stalls = 0  # access units dropped because every other slot was still in use
+        # start code scanner state of the current slot, see scan()
+        self.scan_pos = 0  # offset the next scan resumes from
+        self.seen_vcl = False  # whether the access unit being assembled already holds a slice
+        self.bytes_moved = 0  # bytes of a following access unit moved to a new slot by commit(end)
+
+    def recv_into(self, sock, flags=0):
+        """
+        Receive one datagram straight into the slot being assembled.
+
+        :param sock (socket.socket): Datagram socket to read from.
+        :param flags (int): Passed to sock.recv_into, e.g. socket.MSG_DONTWAIT.
+
+        :return: number of bytes received.
+        """
+        offset = self._offset()
+        start = self.slot * self.slot_size + offset
+        # nothing changes unless a datagram arrived, e.g. a non-blocking call finding the socket empty
+        nbytes = sock.recv_into(self.view[start:start + self.packet_size], self.packet_size, flags)
+        self._append(offset, nbytes)
+        return nbytes
+
+    def write(self, data):
+        """
+        Copy a datagram that was already received elsewhere into the slot being assembled,
+        e.g. from a socket shared by several streams.
+
+        :param data: The datagram, any object supporting the buffer protocol, at most packet_size bytes.
+
+        :return: number of bytes written.
+        """
+        offset = self._offset()
+        start = self.slot * self.slot_size + offset
+        nbytes = len(data)
+        self.view[start:start + nbytes] = data
+        self._append(offset, nbytes)
+        return nbytes
+
+    def _offset(self):
+        """Return the offset in the slot the next datagram goes to, 0 once the access unit outgrew its slot."""
+        return self.length if self.length + self.packet_size <= self.slot_size else 0
+
+    def _append(self, offset, nbytes):
+        """Account for nbytes stored at offset, as returned by _offset()."""
+        if offset != self.length:
+            # the access unit outgrew its slot -- drop it and start over with this datagram
+            self.overflows += 1
+            self._reset(0)
+        self.length += nbytes
+
+    def _reset(self, length):
+        self.length = length
+        self.scan_pos = 0
+        self.seen_vcl = False
+
+    def scan(self):
+        """
+        Look for the start of a new access unit in the bytes received since the last scan.
+
+        The scan resumes where the previous one stopped, backing up over a
+        start code that may straddle two datagrams, so every byte is searched
+        about once however the access unit is split into datagrams.
+
+        :return: offset in the current slot where a new access unit begins, to be passed to commit(),
+                 or None while the slot holds a single access unit.
+        """
+        buf = self.buffer
+        base = self.slot * self.slot_size
+        end = base + self.length
+        pos = buf.find(START_CODE, base + self.scan_pos, end)
+        while pos >= 0:
+            if pos + 5 > end:
+                # NAL header or first slice byte still to come, look at this start code again next time
+                self.scan_pos = pos - base
+                return None
+            nal_type = buf[pos + 3] & 0x1f
+            if _nal_starts_access_unit(nal_type, buf[pos + 4], self.seen_vcl):
+                self.scan_pos = pos - base
+                # a 4 byte start code belongs to the NAL unit that follows it
+                return pos - base - 1 if pos > base and buf[pos - 1] == 0 else pos - base
+            if 1 <= nal_type <= 5:
+                self.seen_vcl = True
+            pos = buf.find(START_CODE, pos + 3, end)
+        self.scan_pos = max(self.scan_pos, self.length - 2)
+        return None
+
+    def commit(self, end=None):
+        """
+        Close the access unit being assembled and move on to a free slot.
+
+        :param end (int): Length of the access unit when the slot already holds the beginning of the
+                          next one, as found by scan(). Those bytes are moved to the new slot.
+
+        :return: (slot, memoryview) of the finished access unit, or (None, None) if it had to be dropped.
+                 The slot must be handed back with release() once the view is no longer used.
+        """
+        if end is None:
+            end = self.length
+        tail = self.length - end
+        if not self.free_slots:
+            self.stalls += 1
+            if tail:
+                # keep the start of the next access unit, drop the finished one
+                start = self.slot * self.slot_size
+                self.view[start:start + tail] = self.view[start + end:start + self.length].tobytes()
+                self.bytes_moved += tail
+            self._reset(tail)
+            return None, None
+        slot = self.slot
+        start = slot * self.slot_size
+        unit = self.view[start:start + end]
+        self.slot = self.free_slots.popleft()
+        if tail:
+            new_start = self.slot * self.slot_size
+            self.view[new_start:new_start + tail] = self.view[start + end:start + end + tail]
+            self.bytes_moved += tail
+        self._reset(tail)
+        return slot, unit
+
+    def release(self, slot):
+        """Return a slot obtained from commit() to the ring."""
+        self.free_slots.append(slot)
+
+    def is_keyframe(self, slot, length):
+        """Return True if the first length bytes of slot hold an IDR picture or sequence parameter set."""
+        start = slot * self.slot_size
+        return is_keyframe(self.buffer, start, start + length)
+
+    def is_reference(self, slot, length):
+        """Return False if the first length bytes of slot hold a picture no other picture is predicted from."""
+        start = slot * self.slot_size
+        return is_reference(self.buffer, start, start + length)
+
+
+def is_keyframe(buf, start, end):
+    """
+    Inspect the NAL units of an Annex-B access unit up to its first slice.
+
+    :param buf (bytearray): Buffer holding the access unit.
+    :param start (int): Offset of the access unit in buf.
+    :param end (int): Offset one past the end of the access unit.
+
+    :return: True if the access unit carries an IDR picture or a sequence parameter set.
+    """
+    pos = buf.find(b'\x00\x00\x01', start, end)
+    while 0 <= pos < end - 3:
+        nal_type = buf[pos + 3] & 0x1f
+        if nal_type in (5, 7):
+            return True
+        if 1 <= nal_type <= 4:
+            # reached the first slice and it is not part of an IDR picture
+            return False
+        pos = buf.find(b'\x00\x00\x01', pos + 3, end)
+    return False
+
+
+def is_reference(buf, start, end):
+    """
+    Inspect the nal_ref_idc of the first slice of an Annex-B access unit.
+
+    :param buf (bytearray): Buffer holding the access unit.
+    :param start (int): Offset of the access unit in buf.
+    :param end (int): Offset one past the end of the access unit.
+
+    :return: False if the picture is not used for reference, i.e. losing it damages no other picture.
+             True when in doubt, e.g. no slice found.
+    """
+    pos = buf.find(START_CODE, start, end)
+    while 0 <= pos < end - 3:
+        header = buf[pos + 3]
+        if 1 <= header & 0x1f <= 5:
+            return header & 0x60 != 0
+        pos = buf.find(START_CODE, pos + 3, end)
+    return True
+
+
+def _nal_starts_access_unit(nal_type, first_payload_byte, seen_vcl):
+    """
+    Decide whether a NAL unit opens a new access unit (H.264 7.4.1.2.3).
+
+    :param nal_type (int): nal_unit_type of the NAL unit.
+    :param first_payload_byte (int): Byte after the NAL header, for slices its top bit is set
+                                     when first_mb_in_slice is 0.
+    :param seen_vcl (bool): Whether the current access unit already holds a slice.
+    """
+    if not seen_vcl:
+        return False
+    if nal_type in (6, 7, 8, 9) or 14 <= nal_type <= 18:
+        return True
+    return 1 <= nal_type <= 5 and first_payload_byte & 0x80 != 0
+
+
+def split_access_units(data):
+    """
+    Split a raw Annex-B h264 stream into access units.
+
+    :param data (bytes|bytearray): The stream.
+
+    :return: list of (start, end) offsets, one per access unit.
+    """
+    units = []
+    unit_start = 0
+    seen_vcl = False
+    pos = data.find(b'\x00\x00\x01')
+    while 0 <= pos < len(data) - 4:
+        nal_type = bytearray(data[pos + 3:pos + 4])[0] & 0x1f
+        first_payload_byte = bytearray(data[pos + 4:pos + 5])[0]
+        # a 4 byte start code belongs to the NAL unit that follows it
+        nal_start = pos - 1 if pos > 0 and data[pos - 1:pos] == b'\x00' else pos
+        if _nal_starts_access_unit(nal_type, first_payload_byte, seen_vcl):
+            units.append((unit_start, nal_start))
+            unit_start = nal_start
+            seen_vcl = False
+        if 1 <= nal_type <= 5:
+            seen_vcl = True
+        pos = data.find(b'\x00\x00\x01', pos + 3)
+    if unit_start < len(data):
+        units.append((unit_start, len(data)))
+    return units
+
+
+def yuv_planes(buf, w, h, linesizes):
+    """
+    Wrap the planes written by H264Decoder.decode_planes_into as numpy views, no data is copied.
+
+    :param buf (numpy.ndarray): Flat uint8 buffer passed to decode_planes_into.
+    :param w (int): Frame width.
+    :param h (int): Frame height.
+    :param linesizes (tuple): Linesize of the Y, U and V planes.
+
+    :return: (y, u, v) arrays of shape (h, w), (h/2, w/2) and (h/2, w/2).
+    """
+    chroma_w, chroma_h = (w + 1) // 2, (h + 1) // 2
+    y_end = linesizes[0] * h
+    u_end = y_end + linesizes[1] * chroma_h
+    v_end = u_end + linesizes[2] * chroma_h
+    y = buf[:y_end].reshape((h, linesizes[0]))[:, :w]
+    u = buf[y_end:u_end].reshape((chroma_h, linesizes[1]))[:, :chroma_w]
+    v = buf[u_end:v_end].reshape((chroma_h, linesizes[2]))[:, :chroma_w]
+    return y, u, v
+
+
+def ring_slots(queue_size):
+    """
+    Number of PacketRing slots a receive path feeding an AccessUnitQueue of queue_size needs.
+
+    Every queued access unit holds a slot, and so do the one being decoded and
+    the one being received. commit() needs one more to move on to, otherwise a
+    full queue stalls the ring and the newest access unit is lost before the
+    queue's drop policy gets to choose which one goes.
+    """
+    return queue_size + 3
+
+
+class AccessUnitQueue(object):
+    """Bounded queue handing access units from the video receive thread to the decode worker."""
+
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NON_KEYFRAMES = 'drop-non-keyframes'
+
+    def __init__(self, maxsize=4, policy=DROP_OLDEST, on_drop=None):
+        """
+        :param maxsize (int): Most access units waiting for the decoder.
+        :param policy (str): What to drop when the queue is full -- DROP_OLDEST discards the
+                             oldest access unit, DROP_NON_KEYFRAMES discards the oldest access
+                             unit that is not a keyframe and only falls back to the oldest one
+                             when everything queued is a keyframe.
+        :param on_drop (callable): Called with every dropped item, e.g. to release its ring slot.
+        """
+        if policy not in (self.DROP_OLDEST, self.DROP_NON_KEYFRAMES):
+            raise ValueError('unknown drop policy %r' % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_drop = on_drop
+        self.items = collections.deque()  # (item, keyframe) pairs, oldest first
+        self.cond = threading.Condition()
+        self.enqueued = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.puts = 0
+        self.depth_sum = 0  # queue depth summed over every put, for the mean depth
+
+    def put(self, item, keyframe=False):
+        """Queue an item, dropping one according to the policy if the queue is full. Never blocks."""
+        dropped = None
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                dropped = self._evict(item, keyframe)
+                self.dropped += 1
+            if dropped is not item:
+                self.items.append((item, keyframe))
+                self.enqueued += 1
+            depth = len(self.items)
+            self.puts += 1
+            self.max_depth = max(self.max_depth, depth)
+            self.depth_sum += depth
+            self.cond.notify()
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+
+    def _evict(self, item, keyframe):
+        """Remove and return the queued item to drop to make room, or return item itself if the new one should go."""
+        if self.policy == self.DROP_NON_KEYFRAMES:
+            for i in range(len(self.items)):
+                if not self.items[i][1]:
+                    dropped = self.items[i][0]
+                    del self.items[i]
+                    return dropped
+            if not keyframe:
+                return item
+        return self.items.popleft()[0]
+
+    def get(self, timeout=None):
+        """
+        Wait for the oldest queued item.
+
+        :param timeout (float): Seconds to wait, or None to wait forever.
+
+        :return: the item, or None if the timeout expired.
+        """
+        with self.cond:
+            if not self.items:
+                self.cond.wait(timeout)
+                if not self.items:
+                    return None
+            return self.items.popleft()[0]
+
+    def stats(self):
+        """Return a dict with the current, mean and maximum queue depth and the enqueue/drop counts."""
+        with self.cond:
+            return {'depth': len(self.items), 'max_depth': self.max_depth,
+                    'mean_depth': float(self.depth_sum) / self.puts if self.puts else 0.0,
+                    'enqueued': self.enqueued, 'dropped': self.dropped}
+
+
+class StreamResync(object):
+    """
+    Decides which access units are worth decoding after part of the stream was lost.
+
+    Once data is lost, every picture predicted from the missing one decodes
+    to garbage until the next keyframe, and decoding it only wastes CPU. After
+    a loss, access units are dropped undecoded until the next keyframe
+    (SPS/PPS/IDR), where the decoder is flushed and decoding resumes. The
+    stream starts out waiting, nothing before the first keyframe can be decoded;
+    waiting() counts that wait like one after a loss.
+
+    lost() may be called from any thread, admit() and decoded() from the decode thread.
+    """
+
+    SYNCED = 'synced'
+    WAITING = 'waiting'  # for a keyframe
+
+    # what admit() tells the decode thread to do with an access unit
+    DROP = 'drop'
+    DECODE = 'decode'
+    RESYNC = 'resync'  # flush the decoder, then decode
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = self.WAITING
+        self.lost_at = None  # time.time() of the first loss not recovered from yet
+        self.started_at = time.time()  # the wait for the first keyframe began
+        self.dropped = 0  # access units dropped undecoded while waiting for a keyframe
+        self.resyncs = 0
+        self.losses = {}  # reason -> losses reported
+        self.recover_times = collections.deque(maxlen=256)  # seconds from a loss to the next frame published
+
+    def lost(self, reason):
+        """
+        Report lost or damaged stream data.
+
+        :param reason (str): What was lost, e.g. 'queue', 'fragment' or 'decode', counted in stats().
+        """
+        with self.lock:
+            self.losses[reason] = self.losses.get(reason, 0) + 1
+            if self.lost_at is None:
+                self.lost_at = time.time()
+            self.state = self.WAITING
+
+    def admit(self, keyframe):
+        """
+        Decide what to do with the next access unit.
+
+        :param keyframe (bool): Whether it carries an IDR picture or sequence parameter set.
+
+        :return: DROP, DECODE or RESYNC.
+        """
+        with self.lock:
+            if self.state == self.SYNCED:
+                return self.DECODE
+            if not keyframe:
+                self.dropped += 1
+                return self.DROP
+            self.state = self.SYNCED
+            if self.lost_at is None:
+                return self.DECODE  # start of the stream, the decoder holds nothing stale
+            self.resyncs += 1
+            return self.RESYNC
+
+    def waiting(self, now=None):
+        """
+        Return the seconds since the loss the stream waits to recover from, or since the stream
+        was set up while it waits for its first keyframe. None while it is synced.
+        """
+        with self.lock:
+            if self.state == self.SYNCED:
+                return None
+            since = self.lost_at if self.lost_at is not None else self.started_at
+            return (now if now is not None else time.time()) - since
+
+    def decoded(self):
+        """Report a frame published, which ends the recovery from the last loss."""
+        with self.lock:
+            if self.lost_at is not None and self.state == self.SYNCED:
+                self.recover_times.append(time.time() - self.lost_at)
+                self.lost_at = None
+
+    def stats(self):
+        """Return a dict with the state, drop/resync/loss counts and the mean and worst time to recover."""
+        with self.lock:
+            times = list(self.recover_times)
+            return {'state': self.state, 'dropped': self.dropped, 'resyncs': self.resyncs,
+                    'losses': dict(self.losses),
+                    'mean_recover': sum(times) / len(times) if times else 0.0,
+                    'max_recover': max(times) if times else 0.0}
+
+
+class KeyframeRequester(object):
+    """
+    Rate-limited requests for a keyframe while a StreamResync waits for one.
+
+    The drone sends a keyframe on its own only every so often, and until then
+    the video stays frozen after a loss. Asking for one, on the Tello by
+    sending "streamon" again, bounds that wait.
+    """
+
+    def __init__(self, resync, request, min_interval=1.0, grace=0.1):
+        """
+        :param resync (StreamResync): Tells whether, and for how long, the stream waits for a keyframe.
+                                      A libh264decoder.StreamSession answers the same waiting() call.
+        :param request (callable): Asks the drone for a keyframe. Returns False if that cannot be done
+                                   right now, it is then tried again on the next poll.
+        :param min_interval (float): Seconds between two requests at least.
+        :param grace (float): Seconds after a loss before asking, e.g. for a keyframe already on its way.
+        """
+        self.resync = resync
+        self.request = request
+        self.min_interval = min_interval
+        self.grace = grace
+        self.last_request = None  # time.time() of the last request sent
+        self.requests = 0
+        self.deferred = 0  # polls a request was due but request() could not send it
+
+    def poll(self, now=None):
+        """
+        Send a request if the stream has been waiting for longer than grace and the rate limit allows.
+
+        :return: True if a request was sent.
+        """
+        now = now if now is not None else time.time()
+        waited = self.resync.waiting(now)
+        if waited is None or waited < self.grace:
+            return False
+        if self.last_request is not None and now - self.last_request < self.min_interval:
+            return False
+        if not self.request():
+            self.deferred += 1
+            return False
+        self.last_request = now
+        self.requests += 1
+        return True
+
+    def sent(self, now=None):
+        """Count a keyframe request made elsewhere, e.g. the "streamon" starting the stream, for the rate limit."""
+        self.last_request = now if now is not None else time.time()
+
+    def stats(self):
+        """Return a dict with the requests sent and deferred."""
+        return {'requests': self.requests, 'deferred': self.deferred}
+
+
+class FramePool(object):
+    """
+    Fixed-size pool of reusable buffers the decoder writes frames into.
+
+    Buffers come back to the pool either explicitly through release(), or
+    implicitly once nothing outside the pool references them any more.
+    """
+
+    # references held while a buffer is inspected in _reclaim(): the in-use
+    # list, the local variable and the argument of sys.getrefcount
+    _IDLE_REFCOUNT = 3
+
+    def __init__(self, frame_bytes, size=4):
+        """
+        :param frame_bytes (int): Size of one buffer in bytes.
+        :param size (int): Number of buffers kept by the pool.
+        """
+        self.frame_bytes = frame_bytes
+        self.size = size
+        self.lock = threading.Lock()
+        self.free = [np.empty(frame_bytes, dtype=np.ubyte) for _ in range(size)]
+        self.in_use = []
+        self.hits = 0
+        self.misses = 0
+        self.high_water = 0  # most buffers handed out at the same time
+
+    def acquire(self):
+        """
+        Hand out a buffer of frame_bytes bytes.
+
+        When every pooled buffer is still referenced a temporary buffer is
+        allocated instead and counted as a miss; it is never added to the pool.
+        """
+        with self.lock:
+            buf = self.free.pop() if self.free else self._reclaim()
+            if buf is None:
+                self.misses += 1
+                return np.empty(self.frame_bytes, dtype=np.ubyte)
+            self.hits += 1
+            self.in_use.append(buf)
+            self.high_water = max(self.high_water, len(self.in_use))
+            return buf
+
+    def release(self, buf):
+        """Give a buffer back to the pool. Buffers that do not belong to the pool are ignored."""
+        with self.lock:
+            for i in range(len(self.in_use)):
+                if self.in_use[i] is buf:
+                    del self.in_use[i]
+                    self.free.append(buf)
+                    return
+
+    def _reclaim(self):
+        """Take back an in-use buffer that is no longer referenced, e.g. a frame nobody reads any more."""
+        for i in range(len(self.in_use)):
+            buf = self.in_use[i]
+            if sys.getrefcount(buf) <= self._IDLE_REFCOUNT:
+                del self.in_use[i]
+                return buf
+        return None
+
+    def stats(self):
+        """Return a dict with the pool hits, misses, buffers in use and high-water mark."""
+        with self.lock:
+            return {'size': self.size, 'hits': self.hits, 'misses': self.misses,
+                    'in_use': len(self.in_use), 'high_water': self.high_water}
+
+
+class FrameSlot(object):
+    """
+    Latest-frame-wins handoff between the decode worker and its consumers.
+
+    Every published frame gets the next sequence number, so a consumer can
+    wait for a frame newer than the one it already has instead of polling.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.frame = None
+        self.seq = 0  # sequence number of self.frame, 0 until the first frame arrives
+        self.timestamp = None  # time.time() when self.frame was published
+
+    def publish(self, frame):
+        """Replace the current frame and wake every waiting consumer."""
+        with self.cond:
+            self.frame = frame
+            self.seq += 1
+            self.timestamp = time.time()
+            self.cond.notify_all()
+
+    def latest(self):
+        """Return (seq, frame) of the most recent frame without waiting."""
+        with self.cond:
+            return self.seq, self.frame
+
+    def wait_next(self, seq, timeout=None):
+        """
+        Wait for a frame newer than seq.
+
+        :param seq (int): Sequence number of the last frame the caller has seen.
+        :param timeout (float): Seconds to wait, or None to wait forever.
+
+        :return: (seq, frame) of the newest frame, or (seq, None) with the caller's seq if the timeout expired.
+        """
+        with self.cond:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while self.seq <= seq:
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return seq, None
+                    self.cond.wait(remaining)
+            return self.seq, self.frame
+
+
+class H264Recorder(object):
+    """
+    Tees the raw access units of the video stream into .h264 files, without re-encoding.
+
+    write() runs in the video receive thread. It copies the access unit onto a
+    bounded queue and returns; a background thread drains the queue, opens,
+    writes, fsyncs and closes the files, so a slow disk never blocks the
+    receive path. If the disk falls so far behind that the queue fills up,
+    access units are dropped up to the next keyframe, so the file skips
+    ahead cleanly instead of holding pictures whose references are missing.
+    Files are rotated by size or age, always at a keyframe, so every file can
+    be decoded on its own, e.g. with ffplay or benchmarks/decoder_threads.py.
+    """
+
+    def __init__(self, directory, prefix='flight', max_bytes=512 * 1024 * 1024, max_seconds=600.0,
+                 fsync_interval=2.0, buffer_size=1024 * 1024, max_queue=256):
+        """
+        :param directory (str): Directory the files go to, created if needed.
+        :param prefix (str): File names are <prefix>-<date>-<time>-<n>.h264.
+        :param max_bytes (int): Start a new file at the next keyframe once a file reaches this size.
+        :param max_seconds (float): Start a new file at the next keyframe once a file is this old.
+        :param fsync_interval (float): Seconds between fsyncs of the current file.
+        :param buffer_size (int): Bytes buffered in memory before they are written to the file.
+        :param max_queue (int): Access units that may wait for the writer thread, about 8 s of video
+                                at the default.
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.fsync_interval = fsync_interval
+        self.buffer_size = buffer_size
+        self.max_queue = max_queue
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.lock = threading.Lock()  # guards everything below, and stats
+        self.cond = threading.Condition(self.lock)
+        self.queue = collections.deque()  # path of a file to start, or an access unit, oldest first
+        self.recording = False  # False until the first keyframe and after an overflow
+        self.file_bytes = 0  # bytes queued for the current file
+        self.file_opened = None
+        self.paths = []  # every file written, in order
+        self.closed = False
+        self.stats = {'access_units': 0, 'bytes': 0, 'skipped': 0, 'dropped': 0, 'max_depth': 0,
+                      'files': 0, 'fsyncs': 0, 'fsync_time': 0.0}
+
+        self.write_thread = threading.Thread(target=self._write_thread)
+        self.write_thread.daemon = True
+        self.write_thread.start()
+
+    def write(self, access_unit, keyframe):
+        """
+        Append one access unit. Never blocks on the disk.
+
+        :param access_unit: The access unit, any object supporting the buffer protocol.
+        :param keyframe (bool): Whether it holds an IDR picture or parameter sets, see is_keyframe.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            if len(self.queue) >= self.max_queue:
+                # the disk cannot keep up -- resume at the next keyframe that fits
+                self.recording = False
+                self.stats['dropped'] += 1
+                return
+            if keyframe and (self.file_opened is None or self.file_bytes >= self.max_bytes or
+                             time.time() - self.file_opened >= self.max_seconds):
+                self._rotate()
+            if keyframe:
+                self.recording = True
+            if not self.recording:
+                # a file has to start with a keyframe to be decodable
+                self.stats['skipped'] += 1
+                return
+            # the slot the access unit lives in is reused once this returns
+            self.queue.append(bytearray(access_unit))
+            nbytes = len(access_unit)
+            self.file_bytes += nbytes
+            self.stats['bytes'] += nbytes
+            self.stats['access_units'] += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'], len(self.queue))
+            self.cond.notify()
+
+    def _rotate(self):
+        """Queue the start of the next file. Called with self.lock held."""
+        path = os.path.join(self.directory, '%s-%s-%d.h264' % (
+            self.prefix, time.strftime('%Y%m%d-%H%M%S'), len(self.paths)))
+        self.queue.append(path)
+        self.file_bytes = 0
+        self.file_opened = time.time()
+        self.paths.append(path)
+        self.stats['files'] += 1
+
+    def depth(self):
+        """Number of access units and file rotations waiting for the writer thread."""
+        with self.lock:
+            return len(self.queue)
+
+    def close(self):
+        """Finish the current file and wait until everything is on disk."""
+        with self.lock:
+            self.closed = True
+            self.cond.notify()
+        self.write_thread.join()
+
+    def _write_thread(self):
+        f = None
+        synced_at = time.time()
+        while True:
+            with self.lock:
+                if not self.queue and not self.closed:
+                    self.cond.wait(self.fsync_interval)
+                items = list(self.queue)
+                self.queue.clear()
+                done = self.closed
+            for item in items:
+                if isinstance(item, bytearray):
+                    f.write(item)
+                    continue
+                if f is not None:
+                    self._sync(f)
+                    f.close()
+                f = open(item, 'wb', self.buffer_size)
+            if f is not None and (done or time.time() - synced_at >= self.fsync_interval):
+                self._sync(f)
+                synced_at = time.time()
+            if done:
+                if f is not None:
+                    f.close()
+                return
+
+    def _sync(self, f):
+        """Write out the buffer of f and wait until it is on disk."""
+        start = time.time()
+        f.flush()
+        os.fsync(f.fileno())
+        with self.lock:
+            self.stats['fsyncs'] += 1
+            self.stats['fsync_time'] += time.time() - start
@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tello_command import PendingCommands
+from tello_fleet import FleetDrone
+
+
+class PendingCommandsTest(unittest.TestCase):
+
+    def test_late_response_is_dropped(self):
+        pending = PendingCommands()
+        cw = pending.add('cw 90')
+        self.assertIsNone(cw.result(0.01))
+        pending.abandon(cw)
+        battery = pending.add('battery?')
+        self.assertEqual(len(pending), 1)
+        # the answer to "cw 90" arrives after its timeout
+        self.assertIsNone(pending.resolve('ok'))
+        self.assertFalse(battery.done())
+        self.assertIs(pending.resolve('87'), battery)
+        self.assertEqual(battery.result(0), '87')
+        self.assertEqual(pending.late, 1)
+
+    def test_lost_response_shifts_one_command_only(self):
+        pending = PendingCommands()
+        first = pending.add('command')
+        pending.abandon(first)  # its response was lost
+        second = pending.add('speed?')
+        # taken for the late response of the first command
+        self.assertIsNone(pending.resolve('50'))
+        pending.abandon(second)
+        third = pending.add('battery?')
+        self.assertIs(pending.resolve('87'), third)
+        self.assertEqual(third.result(0), '87')
+
+    def test_timed_out_command_expires(self):
+        pending = PendingCommands(late_window=0.01)
+        pending.abandon(pending.add('command'))
+        time.sleep(0.05)
+        battery = pending.add('battery?')
+        self.assertIs(pending.resolve('87'), battery)
+        self.assertEqual(pending.late, 0)
+
+
+class _Socket(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append(data.decode())
+
+
+class FleetDroneTest(unittest.TestCase):
+
+    def test_late_response_is_dropped(self):
+        sock = _Socket()
+        drone = FleetDrone('drone', ('127.0.0.1', 8889), sock, 11111)
+        drone.fly(['command', 'battery?'], now=0.0)
+        drone.poll(0.0)
+        # "command" times out, "battery?" goes out
+        drone.poll(1.0)
+        self.assertEqual(sock.sent, ['command', 'battery?'])
+        drone.on_response('ok', 1.1)
+        self.assertEqual(drone.in_flight.message, 'battery?')
+        drone.on_response('87', 1.2)
+        self.assertIsNone(drone.in_flight)
+        self.assertEqual(drone.stats['late'], 1)
+        self.assertEqual(drone.stats['timeouts'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
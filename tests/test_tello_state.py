@@ -0,0 +1,64 @@
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tello_state import STATE_FIELDS, StateRing, parse_state
+
+PACKET = (b'pitch:1;roll:-2;yaw:-12;vgx:0;vgy:0;vgz:0;templ:60;temph:62;tof:90;h:80;bat:87;'
+          b'baro:12.43;time:14;agx:-5.00;agy:3.00;agz:-998.00;\r\n')
+# Tello EDU puts the mission pad fields first
+EDU_PACKET = b'mid:-1;x:0;y:0;z:0;mpry:0,0,0;' + PACKET
+
+
+class ParseStateTest(unittest.TestCase):
+
+    def test_packet(self):
+        values = parse_state(PACKET)
+        self.assertEqual(len(values), len(STATE_FIELDS))
+        state = dict(zip(STATE_FIELDS, values))
+        self.assertEqual(state['roll'], -2.0)
+        self.assertEqual(state['bat'], 87.0)
+        self.assertAlmostEqual(state['baro'], 12.43)
+        self.assertEqual(state['agz'], -998.0)
+
+    def test_edu_mission_pad_prefix(self):
+        self.assertEqual(parse_state(EDU_PACKET), parse_state(PACKET))
+
+    def test_missing_and_reordered_fields(self):
+        values = parse_state(b'bat:50;h:30;')
+        state = dict(zip(STATE_FIELDS, values))
+        self.assertEqual(state['bat'], 50.0)
+        self.assertEqual(state['h'], 30.0)
+        self.assertTrue(math.isnan(state['pitch']))
+
+    def test_garbage(self):
+        self.assertIsNone(parse_state(b'ok'))
+
+
+class StateRingTest(unittest.TestCase):
+
+    def test_feed_and_latest(self):
+        ring = StateRing(capacity=4)
+        self.assertIsNone(ring.latest())
+        self.assertIsNone(ring.feed(b'error'))
+        record = ring.feed(EDU_PACKET, timestamp=100.0)
+        self.assertEqual(record[0], 100.0)
+        latest = ring.latest()
+        self.assertEqual(latest['timestamp'], 100.0)
+        self.assertEqual(latest['h'], 80.0)
+        self.assertEqual((ring.packets, ring.parse_errors), (2, 1))
+
+    def test_wraps_around(self):
+        ring = StateRing(capacity=4)
+        for i in range(6):
+            ring.feed(('h:%d;' % i).encode(), timestamp=float(i))
+        self.assertEqual(list(ring.last(10)['h']), [2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(list(ring.last(2)['timestamp']), [4.0, 5.0])
+        self.assertEqual(list(ring.window(1.5, now=5.0)['h']), [4.0, 5.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tello_state import StateRing
+from tello_telemetry import TelemetryRecorder, load
+
+
+class TelemetryRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        # batches smaller than the records, so full and partly filled batches are both written
+        recorder = TelemetryRecorder(self.directory, batch_size=4)
+        for i in range(10):
+            recorder.record_frame(float(i), i + 0.5, 0.01, 1000 + i)
+        recorder.record_command('battery?')
+        recorder.record_ack('battery?', '87', 0.02)
+        recorder.record_ack('cw 90', None, None)
+        state = StateRing().feed(b'h:80;bat:87;', timestamp=12.0)
+        recorder.record_state(state)
+        recorder.close()
+        self.assertEqual(recorder.stats['written'], 14)
+
+        frames = load(self.directory, 'frames')
+        self.assertEqual(list(frames['received_at']), [float(i) for i in range(10)])
+        self.assertEqual(list(frames['access_unit_bytes']), list(range(1000, 1010)))
+        # every column is a file of its own
+        column = np.fromfile(os.path.join(self.directory, 'frames.published_at.bin'), dtype=np.float64)
+        self.assertEqual(list(column), [i + 0.5 for i in range(10)])
+
+        self.assertEqual(list(load(self.directory, 'commands')['message']), [b'battery?'])
+        acks = load(self.directory, 'acks')
+        self.assertEqual(list(acks['response']), [b'87', b''])
+        self.assertTrue(np.isnan(acks['rtt'][1]))
+        states = load(self.directory, 'state')
+        self.assertEqual((states['timestamp'][0], states['h'][0], states['bat'][0]), (12.0, 80.0, 87.0))
+
+    def test_appends_to_recording(self):
+        for i in range(2):
+            recorder = TelemetryRecorder(self.directory)
+            recorder.record_command('command')
+            recorder.close()
+        self.assertEqual(len(load(self.directory, 'commands')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
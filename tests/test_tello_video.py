@@ -0,0 +1,181 @@
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tello_video import AccessUnitQueue, PacketRing, StreamResync, ring_slots
+
+IDR = b'\x00\x00\x00\x01\x65\x88' + b'\x11' * 100
+P_SLICE = b'\x00\x00\x00\x01\x41\x9a' + b'\x22' * 100
+
+
+class BlockedDecoderTest(unittest.TestCase):
+    """The receive path of Tello with a decode worker stuck on one access unit."""
+
+    def receive(self, policy, units, queue_size=4):
+        ring = PacketRing(slots=ring_slots(queue_size), slot_size=8192)
+
+        def on_drop(item):
+            ring.release(item[0])
+
+        queue = AccessUnitQueue(queue_size, policy, on_drop=on_drop)
+        received = []
+        for i, unit in enumerate(units):
+            ring.write(unit)
+            slot, access_unit = ring.commit()
+            if access_unit is None:
+                continue
+            keyframe = ring.is_keyframe(slot, len(access_unit))
+            received.append(i)
+            queue.put((slot, i), keyframe)
+            if i == 0:
+                # the decoder takes the first access unit and never returns its slot
+                queue.get()
+        queued = [item[1] for item, _ in queue.items]
+        return ring, queue, received, queued
+
+    def test_drop_oldest_keeps_newest(self):
+        units = [IDR if i % 5 == 0 else P_SLICE for i in range(20)]
+        ring, queue, received, queued = self.receive(AccessUnitQueue.DROP_OLDEST, units)
+        self.assertEqual(ring.stalls, 0)
+        self.assertEqual(received, list(range(20)))
+        self.assertEqual(queue.stats()['dropped'], 15)
+        self.assertEqual(queued, [16, 17, 18, 19])
+
+    def test_drop_non_keyframes_keeps_keyframes(self):
+        units = [IDR if i % 5 == 0 else P_SLICE for i in range(20)]
+        ring, queue, received, queued = self.receive(AccessUnitQueue.DROP_NON_KEYFRAMES, units)
+        self.assertEqual(ring.stalls, 0)
+        self.assertEqual(received, list(range(20)))
+        self.assertEqual(queued, [5, 10, 15, 19])
+
+
+AUD = b'\x00\x00\x00\x01\x09\xf0'
+SPS = b'\x00\x00\x00\x01\x67\x4d\x40\x28\x95\xa0'
+PPS = b'\x00\x00\x01\x68\xee\x3c\x80'
+# first_mb_in_slice is 0 when the top bit of the byte after the NAL header is set
+SECOND_SLICE = b'\x00\x00\x01\x41\x12' + b'\x33' * 50
+GOP = [AUD + SPS + PPS + IDR, AUD + P_SLICE + SECOND_SLICE, P_SLICE, AUD + P_SLICE]
+
+
+class PacketRingScanTest(unittest.TestCase):
+    """Access unit boundaries found by scan() however the stream is cut into datagrams."""
+
+    def assemble(self, packets):
+        ring = PacketRing(slots=4, slot_size=4096, packet_size=512)
+        units = []
+
+        def take(end=None):
+            slot, unit = ring.commit(end)
+            units.append(unit.tobytes())
+            ring.release(slot)
+
+        for packet in packets:
+            ring.write(packet)
+            boundary = ring.scan()
+            while boundary:
+                take(boundary)
+                boundary = ring.scan()
+        take()
+        return ring, units
+
+    def test_one_unit_per_packet(self):
+        _, units = self.assemble(GOP)
+        self.assertEqual(units, GOP)
+
+    def test_boundaries_inside_a_packet(self):
+        ring, units = self.assemble([b''.join(GOP)])
+        self.assertEqual(units, GOP)
+        # every commit moves what follows the boundary to the next slot
+        self.assertEqual(ring.bytes_moved, sum(len(b''.join(GOP[i:])) for i in range(1, len(GOP))))
+
+    def test_start_code_split_across_packets(self):
+        stream = b''.join(GOP)
+        for cut in range(1, len(stream)):
+            _, units = self.assemble([stream[:cut], stream[cut:]])
+            self.assertEqual(units, GOP, 'cut at %d' % cut)
+
+    def test_tiny_packets(self):
+        stream = b''.join(GOP)
+        for size in range(1, 8):
+            _, units = self.assemble([stream[i:i + size] for i in range(0, len(stream), size)])
+            self.assertEqual(units, GOP, 'packets of %d bytes' % size)
+
+    def test_keyframe_grouping(self):
+        ring = PacketRing(slots=2, slot_size=4096, packet_size=512)
+        ring.write(GOP[0])
+        self.assertIsNone(ring.scan())
+        ring.write(GOP[1])
+        boundary = ring.scan()
+        self.assertEqual(boundary, len(GOP[0]))
+        slot, unit = ring.commit(boundary)
+        # AUD, SPS and PPS stay with the IDR picture they announce
+        self.assertEqual(unit.tobytes(), GOP[0])
+        self.assertTrue(ring.is_keyframe(slot, len(unit)))
+        ring.release(slot)
+        slot, unit = ring.commit()
+        self.assertEqual(unit.tobytes(), GOP[1])
+        self.assertFalse(ring.is_keyframe(slot, len(unit)))
+
+    def test_overflow_only_counted_when_a_datagram_arrives(self):
+        ring = PacketRing(slots=2, slot_size=1024, packet_size=512)
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            receiver.bind(('127.0.0.1', 0))
+            receiver.setblocking(False)
+            ring.write(P_SLICE * 5)  # no room left for another datagram
+            with self.assertRaises(socket.error):
+                ring.recv_into(receiver)
+            self.assertEqual((ring.overflows, ring.length), (0, len(P_SLICE) * 5))
+            sender.sendto(IDR, receiver.getsockname())
+            receiver.settimeout(1.0)
+            self.assertEqual(ring.recv_into(receiver), len(IDR))
+            self.assertEqual((ring.overflows, ring.length), (1, len(IDR)))
+            self.assertEqual(ring.commit()[1].tobytes(), IDR)
+        finally:
+            receiver.close()
+            sender.close()
+
+
+class StreamResyncTest(unittest.TestCase):
+
+    def test_waits_for_first_keyframe(self):
+        resync = StreamResync()
+        self.assertIsNotNone(resync.waiting())
+        self.assertEqual(resync.admit(False), StreamResync.DROP)
+        # nothing decoded yet, no need to flush the decoder
+        self.assertEqual(resync.admit(True), StreamResync.DECODE)
+        self.assertIsNone(resync.waiting())
+        self.assertEqual(resync.admit(False), StreamResync.DECODE)
+        self.assertEqual(resync.stats()['resyncs'], 0)
+
+    def test_loss_drops_until_keyframe(self):
+        resync = StreamResync()
+        resync.admit(True)
+        resync.decoded()
+        resync.lost('queue')
+        self.assertEqual(resync.state, StreamResync.WAITING)
+        self.assertGreaterEqual(resync.waiting(), 0.0)
+        self.assertEqual(resync.admit(False), StreamResync.DROP)
+        self.assertEqual(resync.admit(False), StreamResync.DROP)
+        # a second loss while waiting is counted but does not move the start of the wait
+        lost_at = resync.lost_at
+        resync.lost('fragment')
+        self.assertEqual(resync.lost_at, lost_at)
+        self.assertEqual(resync.admit(True), StreamResync.RESYNC)
+        self.assertEqual(resync.admit(False), StreamResync.DECODE)
+        resync.decoded()
+        self.assertIsNone(resync.lost_at)
+        stats = resync.stats()
+        self.assertEqual(stats['state'], StreamResync.SYNCED)
+        self.assertEqual(stats['dropped'], 2)
+        self.assertEqual(stats['resyncs'], 1)
+        self.assertEqual(stats['losses'], {'queue': 1, 'fragment': 1})
+        self.assertEqual(len(resync.recover_times), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()